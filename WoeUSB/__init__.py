@@ -1,6 +1,15 @@
-from WoeUSB import \
-    core, \
-    list_devices, \
-    utils, \
-    workaround, \
-    miscellaneous
+import importlib
+
+#: Submodules imported on first access, e.g. WoeUSB.utils after a bare `import WoeUSB`; importing the engine
+#: with the package would make `woeusb --help` and device listing pay for all of it
+_submodules = ("core", "list_devices", "utils", "workaround", "miscellaneous")
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_submodules))
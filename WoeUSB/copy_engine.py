@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+"""
+Multi-worker copy engine behind utils.copy_files
+
+A single copying thread leaves both the source media and the target device idle most of the time,
+it is either waiting for a read or waiting for a write. The engine keeps several files in flight at once,
+so the target's write queue stays full while the source is being read.
+"""
+
+import hashlib
+import os
+import queue
+import threading
+
+from WoeUSB import manifest, wim, writeback
+
+#: Number of files copied concurrently when not specified with --copy-workers
+DEFAULT_COPY_WORKERS = 4
+
+#: Size of every buffer in the pool when not specified with --buffer-size
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024  # 4MiB
+
+_END_OF_WORK = None
+
+
+class BufferPool:
+    """
+    A fixed set of large, reusable buffers shared by the copy workers
+
+    Buffers are allocated once per job instead of once per read, which keeps the memory footprint bounded
+    and avoids handing fresh multi-megabyte allocations to the allocator for every chunk.
+    """
+
+    def __init__(self, count, size):
+        """
+        :param count: Number of buffers in the pool
+        :param size: Size of every buffer in bytes
+        """
+        self.size = size
+        self.__free = queue.Queue()
+        for __ in range(count):
+            self.__free.put(bytearray(size))
+
+    def acquire(self):
+        """
+        Take a buffer out of the pool, blocking until one is available
+
+        :return: bytearray
+        """
+        return self.__free.get()
+
+    def release(self, buffer):
+        """
+        Give a buffer back to the pool
+
+        :param buffer: Buffer previously returned by acquire()
+        """
+        self.__free.put(buffer)
+
+
+class CopyItem:
+    """
+    One unit of work for the copy workers: a single regular file
+
+    The source is either a path or an image_reader.ImageFile, whose content is written straight from the image mapping.
+    When split_wim is set the file is written as .swm parts next to target instead.
+    """
+    __slots__ = ("source", "target", "size", "split_wim")
+
+    def __init__(self, source, target, size, split_wim=False):
+        self.source = source
+        self.target = target
+        self.size = size
+        self.split_wim = split_wim
+
+
+class CopyEngine:
+    """
+    Copies files with a pool of worker threads fed from a bounded queue
+
+    Work items are queued largest file first, so the long sequential writes start immediately
+    and the small files fill the gaps at the end of the job instead of leaving a single large file as the tail.
+    """
+
+    def __init__(self, workers=DEFAULT_COPY_WORKERS, buffer_size=DEFAULT_BUFFER_SIZE, should_stop=None,
+                 split_wim=False, on_progress=None, hash_algorithm=None, on_file_copied=None, dirty_limit=None):
+        """
+        :param workers: Number of concurrent copy workers
+        :param buffer_size: Size in bytes of a single read/write
+        :param should_stop: Callable polled between chunks, the copy is abandoned when it returns True
+        :param split_wim: Split an install.wim too large for FAT32 into .swm parts
+        :param on_progress: Callable taking the number of source bytes just copied, called from the workers
+        :param hash_algorithm: hashlib name of a hash computed over every file while it is written
+        :param on_file_copied: Callable taking the target path, the number of bytes written and their hex digest,
+                               called from the workers once a file is complete and closed
+        :param dirty_limit: Most bytes written to the target but not yet on the device, None to leave it to the
+                            kernel and flush once at the end
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if buffer_size < 4096:
+            raise ValueError("buffer_size must be at least 4096 bytes")
+
+        self.workers = workers
+        self.buffer_size = buffer_size
+        self.should_stop = should_stop
+        self.split_wim = split_wim
+        self.on_progress = on_progress if on_progress is not None else lambda length: None
+        self.hash_algorithm = hash_algorithm
+        self.on_file_copied = on_file_copied
+        self.dirty_limit = writeback.DirtyLimit(dirty_limit, workers) if dirty_limit is not None else None
+
+        #: Set when the job is cancelled through should_stop
+        self.cancelled = False
+
+        self.__buffers = BufferPool(workers, buffer_size)
+        self.__stop = threading.Event()
+        self.__error = None
+        self.__error_lock = threading.Lock()
+
+    def copy_tree(self, source_directory, target_directory):
+        """
+        Copy the whole content of source_directory into target_directory
+
+        :param source_directory: Directory to copy from
+        :param target_directory: Existing directory to copy into
+        """
+        self.copy_manifest(manifest.scan_directory(source_directory), target_directory)
+
+    def copy_manifest(self, source_manifest, target_directory):
+        """
+        Copy every file of a source manifest into target_directory
+
+        :param source_manifest: manifest.SourceManifest of a mounted source or of a disc image
+        :param target_directory: Existing directory to copy into
+        """
+        for directory in source_manifest.directories:
+            os.makedirs(os.path.join(target_directory, directory), exist_ok=True)
+
+        self.copy_items([CopyItem(file.source, os.path.join(target_directory, file.path), file.size,
+                                  self.split_wim and wim.needs_split(file.path, file.size))
+                         for file in source_manifest.files])
+
+    def copy_items(self, items):
+        """
+        Copy every item, largest first, then re-raise the first error raised by any worker
+
+        :param items: List of CopyItem
+        """
+        items = sorted(items, key=lambda item: item.size, reverse=True)
+
+        # Bounded so the producer never runs far ahead of the workers
+        work_queue = queue.Queue(maxsize=self.workers * 2)
+
+        threads = [threading.Thread(target=self.__worker, args=(work_queue,), daemon=True)
+                   for __ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        for item in items:
+            if self.__stop.is_set():
+                break
+            work_queue.put(item)
+
+        for __ in threads:
+            work_queue.put(_END_OF_WORK)
+
+        for thread in threads:
+            thread.join()
+
+        if self.__error is not None:
+            raise self.__error
+
+    def __worker(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is _END_OF_WORK:
+                return
+            if self.__stop.is_set():
+                continue
+
+            try:
+                self.copy_file(item)
+            except BaseException as e:
+                with self.__error_lock:
+                    if self.__error is None:
+                        self.__error = e
+                self.__stop.set()
+
+    def copy_file(self, item):
+        """
+        Copy a single file through a pooled buffer, or straight from the image mapping for image files
+
+        :param item: CopyItem
+        """
+        if item.split_wim:
+            self.split_wim_file(item)
+            return
+
+        if not isinstance(item.source, str):
+            self.copy_image_file(item)
+            return
+
+        hasher = self.__new_hash()
+        size = 0
+
+        buffer = self.__buffers.acquire()
+        view = memoryview(buffer)
+        try:
+            source_fd = os.open(item.source, os.O_RDONLY)
+            try:
+                os.posix_fadvise(source_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                target_fd = os.open(item.target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                write_behind = self.dirty_limit.open(target_fd) if self.dirty_limit is not None else None
+                try:
+                    while True:
+                        if self.__check_stop():
+                            return
+
+                        length = os.readv(source_fd, [view])
+                        if length == 0:
+                            break
+
+                        written = 0
+                        while written < length:
+                            written += os.write(target_fd, view[written:length])
+                        if write_behind is not None:
+                            write_behind.written(length)
+                        if hasher is not None:
+                            hasher.update(view[:length])
+                        size += length
+                        self.on_progress(length)
+
+                    if write_behind is not None:
+                        self.dirty_limit.close(write_behind)
+                finally:
+                    os.close(target_fd)
+            finally:
+                os.close(source_fd)
+        finally:
+            view.release()
+            self.__buffers.release(buffer)
+
+        self.__file_copied(item.target, size, hasher)
+
+    def copy_image_file(self, item):
+        """
+        Copy a single image_reader.ImageFile, the chunks are slices of the image mapping so no buffer is needed
+
+        :param item: CopyItem
+        """
+        hasher = self.__new_hash()
+        size = 0
+
+        target_fd = os.open(item.target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        write_behind = self.dirty_limit.open(target_fd) if self.dirty_limit is not None else None
+        try:
+            for chunk in item.source.chunks(self.buffer_size):
+                with chunk:
+                    if self.__check_stop():
+                        return
+
+                    written = 0
+                    while written < len(chunk):
+                        written += os.write(target_fd, chunk[written:])
+                    if write_behind is not None:
+                        write_behind.written(written)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    size += written
+                    self.on_progress(written)
+
+            if write_behind is not None:
+                self.dirty_limit.close(write_behind)
+        finally:
+            os.close(target_fd)
+
+        self.__file_copied(item.target, size, hasher)
+
+    def split_wim_file(self, item):
+        """
+        Write an install.wim as .swm parts next to item.target
+
+        :param item: CopyItem
+        """
+        copied = [0]
+
+        def on_progress(length):
+            copied[0] += length
+            self.on_progress(length)
+
+        target_directory, name = os.path.split(item.target)
+        wim.split_wim(item.source, target_directory, os.path.splitext(name)[0], buffer_size=self.buffer_size,
+                      should_stop=self.__check_stop, on_progress=on_progress,
+                      hash_algorithm=self.hash_algorithm,
+                      on_part_written=self.on_file_copied, dirty_limit=self.dirty_limit)
+
+        # Headers and tables are rewritten rather than copied, account for them so the total adds up
+        if not self.__stop.is_set():
+            self.on_progress(item.size - copied[0])
+
+    def __new_hash(self):
+        if self.hash_algorithm is None:
+            return None
+        return hashlib.new(self.hash_algorithm)
+
+    def __file_copied(self, target, size, hasher):
+        if self.on_file_copied is not None:
+            self.on_file_copied(target, size, hasher.hexdigest() if hasher is not None else None)
+
+    def __check_stop(self):
+        if self.__stop.is_set():
+            return True
+
+        if self.should_stop is not None and self.should_stop():
+            self.cancelled = True
+            self.__stop.set()
+            return True
+
+        return False
+
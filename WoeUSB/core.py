@@ -1,21 +1,19 @@
 #!/usr/bin/env python3
 
 import os
-import time
-import shutil
 import argparse
-import tempfile
-import traceback
-import threading
-import subprocess
-import urllib.request
-import urllib.error
-from datetime import datetime
+import itertools
 
-from WoeUSB import utils, workaround, miscellaneous
+from WoeUSB import miscellaneous, copy_engine, events, manifest, writeback
 
 _ = miscellaneous.i18n
 
+# Only jobs need the rest of the engine, --help, --about and --version never load it
+utils = miscellaneous.lazy_import("WoeUSB.utils")
+workaround = miscellaneous.lazy_import("WoeUSB.workaround")
+image_reader = miscellaneous.lazy_import("WoeUSB.image_reader")
+trace = miscellaneous.lazy_import("WoeUSB.trace")
+
 application_name = 'WoeUSB'
 application_version = miscellaneous.__version__
 DEFAULT_NEW_FS_LABEL = 'Windows USB'
@@ -24,17 +22,606 @@ application_site_url = 'https://github.com/slacka/WoeUSB'
 application_copyright_declaration = "Copyright © Colin GILLE / congelli501 2013\\nCopyright © slacka et.al. 2017"
 application_copyright_notice = application_name + " is free software licensed under the GNU General Public License version 3(or any later version of your preference) that gives you THE 4 ESSENTIAL FREEDOMS\\nhttps://www.gnu.org/philosophy/"
 
-#: Increase verbosity, provide more information when required
-verbose = False
+#: Ids of the jobs of the process, they keep the mountpoints of jobs running side by side apart
+_job_ids = itertools.count(1)
+
+
+def load_engine():
+    """
+    Load the modules imported lazily right away, several threads must not load one at the same time: call it
+    before jobs run side by side
+    """
+    for module in (utils, workaround, image_reader, trace):
+        # Any attribute runs the module
+        module.__doc__
+
+
+class Job:
+    """
+    A single run of WoeUSB: its options, its mountpoints and temporary directory, the state it is in and whether
+    it was cancelled
+
+    Nothing is kept in module globals, several jobs can run at the same time in one process, each from its own
+    thread. Everything a job publishes on the event bus carries its id.
+    """
+
+    def __init__(self, source_media, target_medias, install_mode="device", target_filesystem_type="FAT",
+                 filesystem_label=DEFAULT_NEW_FS_LABEL, workaround_bios_boot_flag=False, skip_legacy_bootloader=False,
+                 copy_workers=copy_engine.DEFAULT_COPY_WORKERS, buffer_size=copy_engine.DEFAULT_BUFFER_SIZE,
+                 direct_write=False, verify_files=False, resume=False, refresh=False, uefi_ntfs_image=None,
+                 dirty_limit=None, discard=False, verbose=False, debug=False, parser=None, commands=None):
+        """
+        :param source_media: Optical disk drive or disk image
+        :param target_medias: Entire USB storage devices, or a single partition in --partition mode
+        :param install_mode: "device" or "partition"
+        :param target_filesystem_type: "FAT" or "NTFS"
+        :param filesystem_label: Label of the new filesystem in --device creation method
+        :param workaround_bios_boot_flag:
+        :param skip_legacy_bootloader:
+        :param copy_workers: Number of files copied concurrently
+        :param buffer_size: Size in bytes of a single read/write
+        :param direct_write: Build the FAT32 filesystem in userspace and write it to the partition without mounting it
+        :param verify_files: Read the copied files back from the target and compare them with the source
+        :param resume: Continue an interrupted job on the same target, copying only the files not yet written
+                       correctly
+        :param refresh: Update the files an earlier job left on the target partition to the source, writing only
+                        the files that changed
+        :param uefi_ntfs_image: Local uefi-ntfs.img to cache and install on NTFS targets instead of the cached one
+        :param dirty_limit: Most bytes written to the target but not yet on the device during the copy, None to
+                            leave it to the kernel
+        :param discard: Discard the blocks of the target device before partitioning it, in --device mode
+        :param verbose: Increase verbosity, provide more information when required
+        :param debug:
+        :param parser: argparse.ArgumentParser, its help is printed when the parameters are wrong
+        :param commands: [mkdosfs, mkntfs, grub-install] commands from utils.check_runtime_dependencies(), looked
+                         up when the job starts when None
+        """
+        if isinstance(target_medias, str):
+            target_medias = [target_medias]
+
+        self.id = next(_job_ids)
+
+        self.source_media = source_media
+        self.target_medias = target_medias
+        self.target_media = target_medias[0]
+        self.install_mode = install_mode
+        self.target_filesystem_type = target_filesystem_type
+        self.filesystem_label = filesystem_label
+        self.workaround_bios_boot_flag = workaround_bios_boot_flag
+        self.skip_legacy_bootloader = skip_legacy_bootloader
+        self.copy_workers = copy_workers
+        self.buffer_size = buffer_size
+        self.direct_write = direct_write
+        self.verify_files = verify_files
+        self.resume = resume
+        self.refresh = refresh
+        self.uefi_ntfs_image = uefi_ntfs_image
+        self.dirty_limit = dirty_limit
+        self.discard = discard
+        self.verbose = verbose
+        self.debug = debug
+        self.parser = parser
+        self.commands = commands
+
+        import datetime
+        import tempfile
+
+        timestamp = round((datetime.datetime.today() - datetime.datetime.fromtimestamp(0)).total_seconds())
+        self.source_fs_mountpoint = f"/media/woeusb_source_{timestamp}_{os.getpid()}_{self.id}"
+        self.target_fs_mountpoint = f"/media/woeusb_target_{timestamp}_{os.getpid()}_{self.id}"
+
+        self.temp_directory = tempfile.mkdtemp(prefix="WoeUSB.")
+
+        #: Execution state for cleanup functions to determine if clean up is required
+        self.state = "pre-init"
+
+        self.target_device = None
+        self.target_partition = None
+
+        #: image_reader.DiscImage the source is read from without mounting it, closed by cleanup() at the latest
+        self.source_image = None
+
+        #: Set by cancel(), polled by the copy
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Stop the job at the next chunk it copies, it then fails and cleanup() has to be called as usual
+        """
+        self.cancelled = True
+
+    def should_stop(self):
+        return self.cancelled
+
+    def enter_state(self, state):
+        """
+        Record the state the job is in, cleanup() looks at it, --trace times every state as a phase and the
+        subscribers of the event bus are told about it
+
+        :param state: e.g. "start-copying"
+        """
+        self.state = state
+        trace.phase(state)
+        events.publish(events.PhaseChanged(state))
+
+    def run(self):
+        """
+        Write the target, or every target at once when several are given
+
+        :return: 0 - success; 1 - failure
+        """
+        with events.job_context(self.id):
+            try:
+                if len(self.target_medias) > 1:
+                    return self.main_fan_out()
+                return self.main()
+            except SystemExit:
+                # Raised by utils.check_kill_signal() once the job is cancelled
+                return 1
+
+    def main(self):
+        """
+        Write a single target
+
+        :return: 0 - success; 1 - failure
+        """
+        import concurrent.futures
+
+        self.enter_state("enter-init")
+
+        command_mkdosfs, command_mkntfs, command_grubinstall = \
+            self.commands or utils.check_runtime_dependencies(application_name)
+        if command_grubinstall == "grub-install":
+            name_grub_prefix = "grub"
+        else:
+            name_grub_prefix = "grub2"
+
+        utils.print_with_color(application_name + " v" + application_version)
+        utils.print_with_color("==============================")
+
+        if os.getuid() != 0:
+            utils.print_with_color(_("Warning: You are not running {0} as root!").format(application_name), "yellow")
+            utils.print_with_color(_("Warning: This might be the reason of the following failure."), "yellow")
+
+        if utils.check_runtime_parameters(self.install_mode, self.source_media, self.target_media):
+            if self.parser is not None:
+                self.parser.print_help()
+            return 1
+
+        self.target_device, self.target_partition = utils.determine_target_parameters(self.install_mode,
+                                                                                      self.target_media, self.verbose)
+        target_device, target_partition = self.target_device, self.target_partition
+        source_fs_mountpoint, target_fs_mountpoint = self.source_fs_mountpoint, self.target_fs_mountpoint
+
+        if utils.check_source_and_target_not_busy(self.install_mode, self.source_media, target_device,
+                                                  target_partition):
+            return 1
+
+        self.enter_state("start-mounting")
+
+        # Read the image in-process when possible, the source only has to be mounted when it can't be parsed
+        # or when the BIOS boot flag workaround needs its files on a real filesystem
+        source_image = self.source_image = image_reader.open_image(self.source_media)
+        if source_image is not None and self.verbose:
+            utils.print_with_color(_("Info: Reading source media directly as {0} image").format(source_image.filesystem))
+
+        if source_image is None or self.workaround_bios_boot_flag:
+            if mount_source_filesystem(self.source_media, source_fs_mountpoint):
+                utils.print_with_color(_("Error: Unable to mount source filesystem"), "red")
+                return 1
+
+        # Walk the source once, every check and the copy read from the manifest
+        with trace.span("manifest") as span:
+            source_manifest = manifest.build_manifest(source_image or source_fs_mountpoint)
+            span.set(files=len(source_manifest), bytes=source_manifest.total_size)
+
+        if self.target_filesystem_type == "FAT":
+            if utils.check_fat32_filesize_limitation(source_manifest):
+                self.target_filesystem_type = "NTFS"
+
+        if self.direct_write and (self.install_mode != "device" or self.target_filesystem_type != "FAT"):
+            utils.print_with_color(
+                _("Warning: --direct-write only applies to --device with a FAT target filesystem, ignoring it"),
+                "yellow")
+            self.direct_write = False
+
+        if self.refresh and self.install_mode != "partition":
+            utils.print_with_color(_("Warning: --refresh only applies to --partition, ignoring it"), "yellow")
+            self.refresh = False
+
+        if self.refresh and self.resume:
+            # Files already refreshed compare equal, running the refresh again is how it is resumed
+            utils.print_with_color(_("Warning: --resume is ignored with --refresh, an interrupted refresh is resumed "
+                                     "by refreshing again"), "yellow")
+            self.resume = False
+
+        if self.discard and (self.install_mode != "device" or self.resume):
+            utils.print_with_color(_("Warning: --discard only applies to --device without --resume, ignoring it"),
+                                   "yellow")
+            self.discard = False
+
+        if self.resume and self.direct_write:
+            utils.print_with_color(_("Warning: --direct-write writes the whole filesystem at once, it is ignored with "
+                                     "--resume"), "yellow")
+            self.direct_write = False
+
+        if self.direct_write and self.verify_files:
+            utils.print_with_color(_("Warning: --verify is not supported with --direct-write, ignoring it"), "yellow")
+            self.verify_files = False
+
+        target_filesystem_type = self.target_filesystem_type
+        direct_write = self.direct_write
+
+        if self.resume:
+            # Nothing is wiped or formatted, the layout left by the interrupted job must still be there
+            if check_resume_target(self.install_mode, target_device, target_partition, target_filesystem_type):
+                return 1
+        elif self.install_mode == "device":
+            if check_target_device_size(source_manifest, target_device, target_filesystem_type, self.verbose):
+                return 1
+
+            if wipe_existing_partition_table_and_filesystem_signatures(target_device):
+                return 1
+            if self.discard and discard_target_device(target_device, self.should_stop, self.verbose):
+                return 1
+            if create_target_partition_table(target_device, "legacy"):
+                return 1
+
+            # The kernel names the partition, mkfs, mount and everything after them use its node
+            target_partition = create_target_partition(target_device, target_partition, target_filesystem_type,
+                                                       self.filesystem_label,
+                                                       command_mkdosfs,
+                                                       command_mkntfs,
+                                                       create_filesystem=not direct_write)
+            if target_partition is None:
+                return 1
+            self.target_partition = target_partition
+
+            if target_filesystem_type == "NTFS":
+                if create_uefi_ntfs_support_partition(target_device) or \
+                        install_uefi_ntfs_support_partition(target_device, self.uefi_ntfs_image):
+                    return 1
+
+        if self.install_mode == "partition":
+            if utils.check_target_partition(target_partition, target_device):
+                return 1
+
+        if direct_write:
+            self.enter_state("start-copying")
+
+            # The whole filesystem goes to the partition in one sequential pass, nothing is mounted for the copy
+            if write_fat32_filesystem(source_manifest, target_partition, self.filesystem_label, self.buffer_size,
+                                      self.should_stop):
+                utils.print_with_color(_("Error: Writing the FAT32 filesystem failed."), "red")
+                return 1
+
+        # With --direct-write the target is only mounted for the BIOS boot flag workaround
+        if (not direct_write or self.workaround_bios_boot_flag) and \
+                mount_target_filesystem(target_partition, target_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to mount target filesystem"), "red")
+            return 1
+
+        # Every completed file goes to a journal on the target, so an interrupted job can be resumed
+        job_journal = None
+        files_to_copy = source_manifest
+        if not direct_write:
+            job = open_job_journal(target_fs_mountpoint, source_manifest, target_filesystem_type, self.resume,
+                                   self.buffer_size)
+            if job is None:
+                return 1
+            job_journal, files_to_copy = job
+
+        try:
+            if self.refresh:
+                # Obsolete files and the old versions of changed files are deleted before the free space check
+                files_to_copy = refresh_target(source_manifest, target_fs_mountpoint, target_filesystem_type,
+                                               self.buffer_size)
+                if files_to_copy is None:
+                    return 1
+
+            if self.install_mode == "partition":
+                if utils.check_target_filesystem_free_space(target_fs_mountpoint, files_to_copy, target_partition,
+                                                            target_filesystem_type == "FAT"):
+                    return 1
+
+            if self.workaround_bios_boot_flag and self.install_mode == "device":
+                if apply_workaround_bios_boot_flag(source_fs_mountpoint, target_fs_mountpoint, target_device,
+                                                   target_partition, command_grubinstall, name_grub_prefix,
+                                                   self.skip_legacy_bootloader):
+                    utils.print_with_color(_("Error: Unable to apply workaround for BIOS boot flag"), "red")
+                    return 1
+
+            if self.install_mode == "device" and not direct_write:
+                self.enter_state("start-copying")
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                           thread_name_prefix="copy_files") as executor:
+                    copy_files_future = executor.submit(events.bind(copy_files), files_to_copy, target_fs_mountpoint,
+                                                        self.copy_workers, self.buffer_size,
+                                                        target_filesystem_type == "FAT", self.verify_files,
+                                                        job_journal, self.dirty_limit, self.should_stop)
+
+                    if self.debug:
+                        print(_("Started copy files thread. Waiting until it finishes..."))
+
+                    # Returns as soon as the copy does, there is nothing to poll
+                    copy_files_result = copy_files_future.result()
+
+                if self.debug:
+                    print(_("Copying finished"))
+
+                if copy_files_result:
+                    utils.print_with_color(_("Error: Copying process failed."), "red")
+                    return 1
+
+                # Only the target filesystem is flushed, not every filesystem of the host
+                try:
+                    with trace.span("sync", mountpoint=target_fs_mountpoint):
+                        writeback.flush_filesystem(target_fs_mountpoint)
+                except OSError:
+                    utils.print_with_color(_("Warning: Synchronization before unmounting failed."), "yellow")
+            elif self.install_mode == "partition":
+                self.enter_state("start-copying")
+
+                if copy_files(files_to_copy, target_fs_mountpoint, self.copy_workers, self.buffer_size,
+                              target_filesystem_type == "FAT", self.verify_files, job_journal, self.dirty_limit,
+                              self.should_stop):
+                    utils.print_with_color(_("Error: Copying process failed."), "red")
+                    return 1
+
+            # The job is complete, there is nothing left to resume
+            if job_journal is not None:
+                job_journal.remove()
+        finally:
+            # Otherwise the journal stays on the target for --resume, closed so the target can be unmounted
+            if job_journal is not None:
+                job_journal.close()
+
+        self.close_source_image()
+
+        self.enter_state("start-unmounting")
+
+        if os.path.ismount(target_fs_mountpoint) and unmount_target_filesystem(target_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to unmount target filesystem"), "red")
+            return 1
+
+        if os.path.ismount(source_fs_mountpoint) and unmount_source_filesystem(source_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to unmount source filesystem"), "red")
+            return 1
+
+        if self.install_mode == "device":
+            if update_partition_info(target_device, target_partition):
+                utils.print_with_color(_("Error: Unable to update partition info"), "red")
+                return 1
+
+        if self.install_mode == "device":
+            utils.print_with_color(_("The target device has been successfully prepared"), "green")
+        else:
+            utils.print_with_color(_("The target partition has been successfully prepared"), "green")
+
+        self.enter_state("finished")
+
+        return 0
+
+    def main_fan_out(self):
+        """
+        Write the same source to several devices at once, in --device mode
+
+        Every device is prepared in its own thread, then the source is read once and copied to all of them.
+        A device failing at any step is left behind while the others go on. Every target filesystem is mounted
+        under target_fs_mountpoint.
+
+        :return: 0 - every device succeeded; 1 - at least one failed
+        """
+        import concurrent.futures
 
-debug = False
+        self.enter_state("enter-init")
 
-CopyFiles_handle = threading.Thread()
+        command_mkdosfs, command_mkntfs, command_grubinstall = \
+            self.commands or utils.check_runtime_dependencies(application_name)
 
-#: Execution state for cleanup functions to determine if clean up is required
-current_state = 'pre-init'
+        utils.print_with_color(application_name + " v" + application_version)
+        utils.print_with_color("==============================")
 
-gui = None
+        if os.getuid() != 0:
+            utils.print_with_color(_("Warning: You are not running {0} as root!").format(application_name), "yellow")
+            utils.print_with_color(_("Warning: This might be the reason of the following failure."), "yellow")
+
+        if len(set(os.path.realpath(target_media) for target_media in self.target_medias)) != len(self.target_medias):
+            utils.print_with_color(_("Error: The same target device is given more than once"), "red")
+            return 1
+
+        targets = []
+        for target_media in self.target_medias:
+            if utils.check_runtime_parameters("device", self.source_media, target_media):
+                return 1
+
+            target_device, target_partition = utils.determine_target_parameters("device", target_media, self.verbose)
+            if utils.check_source_and_target_not_busy("device", self.source_media, target_device, target_partition):
+                return 1
+
+            targets.append((target_device, target_partition,
+                            os.path.join(self.target_fs_mountpoint, os.path.basename(target_device))))
+
+        self.enter_state("start-mounting")
+
+        source_image = self.source_image = image_reader.open_image(self.source_media)
+        if source_image is None and mount_source_filesystem(self.source_media, self.source_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to mount source filesystem"), "red")
+            return 1
+
+        with trace.span("manifest") as span:
+            source_manifest = manifest.build_manifest(source_image or self.source_fs_mountpoint)
+            span.set(files=len(source_manifest), bytes=source_manifest.total_size)
+
+        if self.target_filesystem_type == "FAT":
+            if utils.check_fat32_filesize_limitation(source_manifest):
+                self.target_filesystem_type = "NTFS"
+
+        for target in targets:
+            if check_target_device_size(source_manifest, target[0], self.target_filesystem_type, self.verbose):
+                return 1
+
+        # parted, mkfs and mount only wait on their own device, run them side by side
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets),
+                                                   thread_name_prefix="prepare_target") as executor:
+            target_partitions = list(executor.map(
+                events.bind(lambda target: self.prepare_fan_out_target(target[0], target[1], target[2],
+                                                                       command_mkdosfs, command_mkntfs)),
+                targets))
+
+        failed = [target[0] for target, target_partition in zip(targets, target_partitions)
+                  if target_partition is None]
+        # From here on every target goes with the partition node the kernel created
+        targets = [(target_device, target_partition or guessed_partition, mountpoint)
+                   for (target_device, guessed_partition, mountpoint), target_partition
+                   in zip(targets, target_partitions)]
+        prepared = [target for target in targets if target[0] not in failed]
+
+        if prepared:
+            self.enter_state("start-copying")
+
+            copy_results = utils.fan_out_copy_files(source_manifest,
+                                                    [(target_device, mountpoint)
+                                                     for target_device, __, mountpoint in prepared],
+                                                    self.buffer_size, self.target_filesystem_type == "FAT",
+                                                    self.dirty_limit, self.should_stop)
+            # Every target filesystem was flushed by its own writer, a failed flush fails the target
+            failed.extend(target_device for target_device, error in copy_results.items() if error is not None)
+
+        self.close_source_image()
+
+        self.enter_state("start-unmounting")
+
+        for target_device, target_partition, mountpoint in prepared:
+            if os.path.ismount(mountpoint) and unmount_target_filesystem(mountpoint):
+                failed.append(target_device)
+                continue
+
+            if target_device not in failed and update_partition_info(target_device, target_partition):
+                failed.append(target_device)
+
+        if os.path.ismount(self.source_fs_mountpoint) and unmount_source_filesystem(self.source_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to unmount source filesystem"), "red")
+            return 1
+
+        for target_device, __, __ in targets:
+            if target_device in failed:
+                utils.print_with_color(_("Error: {0} failed").format(target_device), "red")
+            else:
+                utils.print_with_color(_("{0} has been successfully prepared").format(target_device), "green")
+
+        if failed:
+            return 1
+
+        self.enter_state("finished")
+
+        return 0
+
+    def prepare_fan_out_target(self, target_device, target_partition, target_fs_mountpoint, command_mkdosfs,
+                               command_mkntfs):
+        """
+        Wipe, partition, format and mount one device of a fan-out job
+
+        :param target_device:
+        :param target_partition:
+        :param target_fs_mountpoint:
+        :param command_mkdosfs:
+        :param command_mkntfs:
+        :return: Device node of the new partition; None - failure
+        """
+        if wipe_existing_partition_table_and_filesystem_signatures(target_device) or \
+                (self.discard and discard_target_device(target_device, self.should_stop, self.verbose)) or \
+                create_target_partition_table(target_device, "legacy"):
+            return None
+
+        target_partition = create_target_partition(target_device, target_partition, self.target_filesystem_type,
+                                                   self.filesystem_label, command_mkdosfs, command_mkntfs)
+        if target_partition is None:
+            return None
+
+        if self.target_filesystem_type == "NTFS":
+            if create_uefi_ntfs_support_partition(target_device) or \
+                    install_uefi_ntfs_support_partition(target_device, self.uefi_ntfs_image):
+                return None
+
+        if mount_target_filesystem(target_partition, target_fs_mountpoint):
+            utils.print_with_color(_("Error: Unable to mount target filesystem of {0}").format(target_device), "red")
+            return None
+
+        return target_partition
+
+    def close_source_image(self):
+        """
+        Release the mapping of the source image, if the job opened one
+        """
+        if self.source_image is not None:
+            self.source_image.close()
+            self.source_image = None
+
+    def cleanup(self):
+        """
+        Unmount and remove whatever the job left behind, it is safe to call after both success and failure
+
+        :return: 0 - success; 1 - failure
+        """
+        import shutil
+
+        # Early failures leave the image open
+        self.close_source_image()
+
+        with events.job_context(self.id):
+            if self.state == "pre-init":
+                shutil.rmtree(self.temp_directory, ignore_errors=True)
+                return 0
+
+            flag_unclean = False
+            flag_unsafe = False
+
+            mountpoints = [self.source_fs_mountpoint]
+            # Fan-out jobs mount every target under target_fs_mountpoint
+            if os.path.isdir(self.target_fs_mountpoint) and not os.path.ismount(self.target_fs_mountpoint):
+                mountpoints.extend(entry.path for entry in os.scandir(self.target_fs_mountpoint) if entry.is_dir())
+            mountpoints.append(self.target_fs_mountpoint)
+
+            for mountpoint in mountpoints:
+                if os.path.ismount(mountpoint):
+                    utils.print_with_color(_("Unmounting and removing {0}...").format(mountpoint))
+                    if trace.run(["umount", mountpoint]).returncode != 0:
+                        utils.print_with_color(_("Warning: Unable to unmount filesystem."), "yellow")
+                        flag_unclean = True
+                        if mountpoint != self.source_fs_mountpoint:
+                            flag_unsafe = True
+                        continue
+
+                if os.path.isdir(mountpoint):
+                    try:
+                        os.rmdir(mountpoint)
+                    except OSError:
+                        utils.print_with_color(_("Warning: Unable to remove source mountpoint"), "yellow")
+                        flag_unclean = True
+
+            shutil.rmtree(self.temp_directory, ignore_errors=True)
+
+            if flag_unclean:
+                utils.print_with_color(
+                    _("Some mountpoints are not unmount/cleaned successfully and must be done manually"), "yellow")
+
+            if flag_unsafe:
+                utils.print_with_color(
+                    _("We unable to unmount target filesystem for you, please make sure target filesystem is unmounted before detaching to prevent data corruption"),
+                    "yellow")
+                utils.print_with_color(
+                    _("Target device is busy, please make sure you unmount all filesystems on target device or shutdown the computer before detaching it."),
+                    "yellow")
+                return 1
+
+            if self.state == "finished":
+                utils.print_with_color(_("You may now safely detach the target device"), "green")
+                utils.print_with_color(_("Done :)"), "green")
+                utils.print_with_color(_("The target device should be bootable now"), "green")
+
+            return 0
 
 
 def init(from_cli=True, install_mode=None, source_media=None, target_media=None, workaround_bios_boot_flag=False,
@@ -48,21 +635,42 @@ def init(from_cli=True, install_mode=None, source_media=None, target_media=None,
     :param workaround_bios_boot_flag:
     :param target_filesystem_type:
     :param filesystem_label:
-    :return: List
+    :return: [Job, progress format, no color, trace file] from the command line, Job otherwise
     """
-    source_fs_mountpoint = f"/media/woeusb_source_{round((datetime.today() - datetime.fromtimestamp(0)).total_seconds())}_{os.getpid()}"
-    target_fs_mountpoint = f"/media/woeusb_target_{round((datetime.today() - datetime.fromtimestamp(0)).total_seconds())}_{os.getpid()}"
-
-    temp_directory = tempfile.mkdtemp(prefix="WoeUSB.")
-
     verbose = False
 
-    no_color = True
+    no_color = False
 
     debug = False
 
     parser = None
 
+    skip_legacy_bootloader = False
+
+    copy_workers = copy_engine.DEFAULT_COPY_WORKERS
+
+    buffer_size = copy_engine.DEFAULT_BUFFER_SIZE
+
+    progress_format = "text"
+
+    direct_write = False
+
+    verify_files = False
+
+    resume = False
+
+    refresh = False
+
+    uefi_ntfs_image = None
+
+    dirty_limit = None
+
+    discard = False
+
+    trace_file = None
+
+    target_medias = [target_media]
+
     if from_cli:
         parser = setup_arguments()
         args = parser.parse_args()
@@ -71,6 +679,16 @@ def init(from_cli=True, install_mode=None, source_media=None, target_media=None,
             print_application_info()
             return 0
 
+        if args.daemon:
+            # Imported here, the daemon builds its jobs from this module
+            from WoeUSB import daemon
+            return daemon.run(args.socket or daemon.DEFAULT_SOCKET_PATH, args.max_jobs or daemon.DEFAULT_MAX_JOBS,
+                              args.no_color)
+
+        if args.source is None or not args.target:
+            parser.print_usage()
+            return 1
+
         if args.device:
             install_mode = "device"
         elif args.partition:
@@ -81,8 +699,19 @@ def init(from_cli=True, install_mode=None, source_media=None, target_media=None,
 
         #: source_media may be an optical disk drive or a disk image
         source_media = args.source
-        #: target_media may be an entire USB storage device or just a partition
-        target_media = args.target
+        #: In --device mode several devices may be written at once, target_media may otherwise be an entire USB
+        #: storage device or just a partition
+        target_medias = args.target
+
+        if len(target_medias) > 1 and install_mode != "device":
+            utils.print_with_color(_("Error: Several targets can only be written in --device mode"), "red")
+            return 1
+        if len(target_medias) > 1 and (args.workaround_bios_boot_flag or args.direct_write or args.verify
+                                       or args.resume):
+            utils.print_with_color(
+                _("Warning: --workaround-bios-boot-flag, --direct-write, --verify and --resume are ignored when "
+                  "writing several targets"),
+                "yellow")
 
         workaround_bios_boot_flag = args.workaround_bios_boot_flag
 
@@ -98,155 +727,54 @@ def init(from_cli=True, install_mode=None, source_media=None, target_media=None,
 
         debug = args.debug
 
-    utils.no_color = no_color
-    utils.verbose = verbose
-    utils.gui = gui
-
-    if from_cli:
-        return [source_fs_mountpoint, target_fs_mountpoint, temp_directory, install_mode, source_media, target_media,
-                workaround_bios_boot_flag, skip_legacy_bootloader, target_filesystem_type, filesystem_label, verbose, debug, parser]
-    else:
-        return [source_fs_mountpoint, target_fs_mountpoint, temp_directory, target_media]
-
-
-def main(source_fs_mountpoint, target_fs_mountpoint, source_media, target_media, install_mode, temp_directory,
-         target_filesystem_type, workaround_bios_boot_flag, parser=None, skip_legacy_bootloader=False):
-    """
-    :param parser:
-    :param source_fs_mountpoint:
-    :param target_fs_mountpoint:
-    :param source_media:
-    :param target_media:
-    :param install_mode:
-    :param temp_directory:
-    :param target_filesystem_type:
-    :param workaround_bios_boot_flag:
-    :return: 0 - success; 1 - failure
-    """
-    global debug
-    global verbose
-    global no_color
-    global current_state
-    global target_device
-
-    current_state = 'enter-init'
+        copy_workers = args.copy_workers
 
-    command_mkdosfs, command_mkntfs, command_grubinstall = utils.check_runtime_dependencies(application_name)
-    if command_grubinstall == "grub-install":
-        name_grub_prefix = "grub"
-    else:
-        name_grub_prefix = "grub2"
+        buffer_size = args.buffer_size
 
-    utils.print_with_color(application_name + " v" + application_version)
-    utils.print_with_color("==============================")
+        progress_format = args.progress
 
-    if os.getuid() != 0:
-        utils.print_with_color(_("Warning: You are not running {0} as root!").format(application_name), "yellow")
-        utils.print_with_color(_("Warning: This might be the reason of the following failure."), "yellow")
+        direct_write = args.direct_write
 
-    if utils.check_runtime_parameters(install_mode, source_media, target_media):
-        parser.print_help()
-        return 1
+        verify_files = args.verify
 
-    target_device, target_partition = utils.determine_target_parameters(install_mode, target_media)
+        resume = args.resume
 
-    if utils.check_source_and_target_not_busy(install_mode, source_media, target_device, target_partition):
-        return 1
+        refresh = args.refresh
 
-    current_state = "start-mounting"
+        uefi_ntfs_image = args.uefi_ntfs_image
 
-    if mount_source_filesystem(source_media, source_fs_mountpoint):
-        utils.print_with_color(_("Error: Unable to mount source filesystem"), "red")
-        return 1
-
-    if target_filesystem_type == "FAT":
-        if utils.check_fat32_filesize_limitation(source_fs_mountpoint):
-            target_filesystem_type = "NTFS"
-
-    if install_mode == "device":
-        wipe_existing_partition_table_and_filesystem_signatures(target_device)
-        create_target_partition_table(target_device, "legacy")
-        create_target_partition(target_device, target_partition, target_filesystem_type, target_filesystem_type,
-                                command_mkdosfs,
-                                command_mkntfs)
+        dirty_limit = args.dirty_limit
 
-        if target_filesystem_type == "NTFS":
-            create_uefi_ntfs_support_partition(target_device)
-            install_uefi_ntfs_support_partition(target_device + "2", temp_directory)
+        discard = args.discard
 
-    if install_mode == "partition":
-        utils.check_target_partition(target_partition, target_device)
-        utils.check_target_partition(target_partition, target_device)
+        trace_file = args.trace
 
-    if mount_target_filesystem(target_partition, target_fs_mountpoint):
-        utils.print_with_color(_("Error: Unable to mount target filesystem"), "red")
-        return 1
-
-    if workaround_bios_boot_flag and install_mode == "device":
-        if apply_workaround_bios_boot_flag(source_fs_mountpoint, target_fs_mountpoint, target_device,
-                                           target_partition, command_grubinstall, name_grub_prefix,
-                                           skip_legacy_bootloader):
-            utils.print_with_color(_("Error: Unable to apply workaround for BIOS boot flag"), "red")
-            return 1
+    job = Job(source_media, target_medias, install_mode, target_filesystem_type, filesystem_label,
+              workaround_bios_boot_flag, skip_legacy_bootloader, copy_workers, buffer_size, direct_write, verify_files,
+              resume, refresh, uefi_ntfs_image, dirty_limit, discard, verbose, debug, parser)
 
-    current_state = "start-copying"
-
-    if install_mode == "device":
-        copy_files_thread = threading.Thread(target=copy_files, args=(source_fs_mountpoint, target_fs_mountpoint,))
-        copy_files_thread.start()
-
-        if debug:
-            print(_("Started copy files thread. Waiting until it finishes..."))
-        if gui:
-            gui.toggle_button()
-            utils.print_with_color(
-                _("Info: Writing in progress, do not remove the media until the process is complete."),
-                "yellow")
-
-        while copy_files_thread.is_alive():
-            time.sleep(1)
-            if debug:
-                print(".", end="", flush=True)
-
-        copy_files_thread.join()
-
-        if gui:
-            gui.toggle_button()
-
-        if debug:
-            print()
-            print(_("Copying finished"))
-
-        if CopyFiles_handle.is_alive():
-            utils.print_with_color(_("Error: Copying process failed."), "red")
-            return 1
-
-        if os.system("sync") != 0:
-            utils.print_with_color(_("Warning: Synchronization before unmounting failed."), "yellow")
+    if from_cli:
+        return [job, progress_format, no_color, trace_file]
     else:
-        copy_files(source_fs_mountpoint, target_fs_mountpoint)
-
-    current_state = "start-unmounting"
+        return job
 
-    if unmount_target_filesystem(target_fs_mountpoint):
-        utils.print_with_color(_("Error: Unable to unmount target filesystem"), "red")
-        return 1
 
-    if unmount_source_filesystem(source_fs_mountpoint):
-        utils.print_with_color(_("Error: Unable to unmount source filesystem"), "red")
-        return 1
+def main(job):
+    """
+    :param job: Job, from init()
+    :return: 0 - success; 1 - failure
+    """
+    return job.run()
 
-    if install_mode == "device":
-        if update_partition_info(target_device, target_partition):
-            utils.print_with_color(_("Error: Unable to update partition info"), "red")
-            return 1
 
-    if install_mode == "device":
-        utils.print_with_color(_("The target device has been successfully prepared"), "green")
-    else:
-        utils.print_with_color(_("The target partition has been successfully prepared"), "green")
+def cleanup(job):
+    """
+    Unmount and remove whatever main left behind, it is safe to call after both success and failure
 
-    return 0
+    :param job: Job given to main()
+    :return: 0 - success; 1 - failure
+    """
+    return job.cleanup()
 
 
 def mount_source_filesystem(source_media, source_fs_mountpoint):
@@ -316,6 +844,21 @@ def wipe_existing_partition_table_and_filesystem_signatures(target_device):
         return 1
 
 
+def discard_target_device(target_device, should_stop=None, verbose=False):
+    """
+    :param target_device:
+    :param should_stop: Callable returning True once the job is cancelled
+    :param verbose:
+    :return: 0 - success or discard not supported; 1 - failure
+    """
+    try:
+        utils.discard_target_device(target_device, should_stop, verbose)
+        return 0
+    except Exception as e:
+        utils.print_with_color(str(e), "red")
+        return 1
+
+
 def create_target_partition_table(target_device, target_partition_table_type):
     """
     :param target_device:
@@ -331,7 +874,7 @@ def create_target_partition_table(target_device, target_partition_table_type):
 
 
 def create_target_partition(target_device, target_partition, target_filesystem_type, filesystem_label,
-                            command_mkdosfs, command_mkntfs):
+                            command_mkdosfs, command_mkntfs, create_filesystem=True):
     """
     :param target_device:
     :param target_partition:
@@ -339,15 +882,15 @@ def create_target_partition(target_device, target_partition, target_filesystem_t
     :param filesystem_label:
     :param command_mkdosfs:
     :param command_mkntfs:
-    :return: 0 - success; 1 - failure
+    :param create_filesystem: Leave the partition unformatted when False
+    :return: Device node of the new partition; None - failure
     """
     try:
-        utils.create_partition(target_device, target_partition, target_filesystem_type, filesystem_label,
-                               command_mkdosfs, command_mkntfs)
-        return 0
+        return utils.create_partition(target_device, target_partition, target_filesystem_type, filesystem_label,
+                                      command_mkdosfs, command_mkntfs, create_filesystem)
     except Exception as e:
         utils.print_with_color(str(e), "red")
-        return 1
+        return None
 
 
 def create_uefi_ntfs_support_partition(target_device):
@@ -363,14 +906,14 @@ def create_uefi_ntfs_support_partition(target_device):
         return 1
 
 
-def install_uefi_ntfs_support_partition(target_device, temp_directory):
+def install_uefi_ntfs_support_partition(target_device, uefi_ntfs_image=None):
     """
     :param target_device:
-    :param temp_directory:
+    :param uefi_ntfs_image: Path of a local uefi-ntfs.img, the cached image is used when None
     :return: 0 - success; 1 - failure
     """
     try:
-        utils.install_uefi_ntfs_support_partition(target_device, temp_directory)
+        utils.install_uefi_ntfs_support_partition(target_device, uefi_ntfs_image)
         return 0
     except Exception as e:
         utils.print_with_color(str(e), "red")
@@ -399,20 +942,115 @@ def apply_workaround_bios_boot_flag(source_fs_mountpoint, target_fs_mountpoint,
         return 1
 
 
-def copy_files(source_fs_mountpoint, target_fs_mountpoint):
+def copy_files(source_manifest, target_fs_mountpoint, copy_workers=copy_engine.DEFAULT_COPY_WORKERS,
+               buffer_size=copy_engine.DEFAULT_BUFFER_SIZE, split_wim=False, verify_files=False, job_journal=None,
+               dirty_limit=None, should_stop=None):
     """
-    :param source_fs_mountpoint:
+    :param source_manifest: manifest.SourceManifest of the source
     :param target_fs_mountpoint:
+    :param copy_workers:
+    :param buffer_size:
+    :param split_wim: Split an install.wim too large for FAT32 into .swm parts
+    :param verify_files: Read the copied files back from the target and compare them with the source
+    :param job_journal: journal.Journal recording every completed file
+    :param dirty_limit: Most bytes written to the target but not yet on the device
+    :param should_stop: Callable returning True once the job is cancelled
+    :return: 0 - success; 1 - failure
+    """
+    try:
+        utils.copy_files(source_manifest, target_fs_mountpoint, copy_workers, buffer_size, split_wim, verify_files,
+                         job_journal, dirty_limit, should_stop)
+        return 0
+    except Exception as e:
+        utils.print_with_color(str(e), "red")
+        return 1
+
+
+def write_fat32_filesystem(source_manifest, target_partition, filesystem_label,
+                           buffer_size=copy_engine.DEFAULT_BUFFER_SIZE, should_stop=None):
+    """
+    :param source_manifest: manifest.SourceManifest of the source
+    :param target_partition:
+    :param filesystem_label:
+    :param buffer_size:
+    :param should_stop: Callable returning True once the job is cancelled
+    :return: 0 - success; 1 - failure
+    """
+    try:
+        utils.write_fat32_filesystem(source_manifest, target_partition, filesystem_label, buffer_size,
+                                     should_stop=should_stop)
+        return 0
+    except Exception as e:
+        utils.print_with_color(str(e), "red")
+        return 1
+
+
+def check_target_device_size(source_manifest, target_device, target_filesystem_type, verbose=False):
+    """
+    :param source_manifest: manifest.SourceManifest of the source
+    :param target_device:
+    :param target_filesystem_type:
+    :param verbose:
     :return: 0 - success; 1 - failure
     """
     try:
-        utils.copy_files(source_fs_mountpoint, target_fs_mountpoint)
+        utils.check_target_device_size(source_manifest, target_device, target_filesystem_type,
+                                       target_filesystem_type == "FAT", verbose)
         return 0
     except Exception as e:
         utils.print_with_color(str(e), "red")
         return 1
 
 
+def check_resume_target(install_mode, target_device, target_partition, target_filesystem_type):
+    """
+    :param install_mode:
+    :param target_device:
+    :param target_partition:
+    :param target_filesystem_type:
+    :return: 0 - success; 1 - failure
+    """
+    try:
+        utils.check_resume_target(install_mode, target_device, target_partition, target_filesystem_type)
+        return 0
+    except Exception as e:
+        utils.print_with_color(str(e), "red")
+        return 1
+
+
+def open_job_journal(target_fs_mountpoint, source_manifest, target_filesystem_type, resume, buffer_size):
+    """
+    :param target_fs_mountpoint:
+    :param source_manifest: manifest.SourceManifest of the source
+    :param target_filesystem_type:
+    :param resume: Reopen the journal of an interrupted job instead of starting a new one
+    :param buffer_size:
+    :return: [journal.Journal, manifest.SourceManifest of the files to copy], None on failure
+    """
+    try:
+        return list(utils.open_job_journal(target_fs_mountpoint, source_manifest, target_filesystem_type,
+                                           target_filesystem_type == "FAT", resume, buffer_size))
+    except Exception as e:
+        utils.print_with_color(str(e), "red")
+        return None
+
+
+def refresh_target(source_manifest, target_fs_mountpoint, target_filesystem_type, buffer_size):
+    """
+    :param source_manifest: manifest.SourceManifest of the source
+    :param target_fs_mountpoint:
+    :param target_filesystem_type:
+    :param buffer_size:
+    :return: manifest.SourceManifest of the files to copy, None on failure
+    """
+    try:
+        return utils.refresh_target(source_manifest, target_fs_mountpoint, target_filesystem_type == "FAT",
+                                    buffer_size)
+    except Exception as e:
+        utils.print_with_color(str(e), "red")
+        return None
+
+
 def update_partition_info(target_device, target_partition):
     """
     :param target_device:
@@ -438,3 +1076,128 @@ def check_target_partition(target_device, target_partition):
     except Exception as e:
         utils.print_with_color(str(e), "red")
         return 1
+
+
+def print_application_info():
+    print(application_name + " v" + application_version)
+    print(application_site_url)
+    print(application_copyright_declaration.replace("\\n", "\n"))
+    print(application_copyright_notice.replace("\\n", "\n"))
+
+
+def setup_arguments():
+    """
+    :return: argparse.ArgumentParser
+    """
+
+    def size(text):
+        # Named for the error messages of argparse, utils is only loaded once a size is actually given
+        return utils.parse_size(text)
+
+    parser = argparse.ArgumentParser(
+        description="WoeUSB can create a bootable Microsoft Windows(R) USB storage device from an existing Windows optical disk or an ISO disk image.")
+    parser.add_argument("source", nargs="?", help="Source")
+    parser.add_argument("target", nargs="*",
+                        help="Target, several devices can be given in --device mode to write all of them at once")
+    parser.add_argument("--device", "-d", action="store_true",
+                        help="Completely WIPE the entire USB storage device, then build a bootable Windows USB device from scratch.")
+    parser.add_argument("--partition", "-p", action="store_true",
+                        help="Copy Windows files to an existing partition of a USB storage device and make it bootable. This allows files to coexist as long as no filename conflict exists.")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose mode")
+    parser.add_argument("--version", "-V", action="version", version=application_version)
+    parser.add_argument("--about", "-ab", action="store_true", help="Show info about this application")
+    parser.add_argument("--no-color", action="store_true", help="Disable message coloring")
+    parser.add_argument("--debug", action="store_true", help="Enable script debugging")
+    parser.add_argument("--label", "-l", default=DEFAULT_NEW_FS_LABEL,
+                        help="Specify label for the newly created file system in --device creation method")
+    parser.add_argument("--workaround-bios-boot-flag", action="store_true",
+                        help="Workaround BIOS bug that won't include the device in boot menu if non of the partition's boot flag is toggled")
+    parser.add_argument("--workaround-skip-grub", action="store_true",
+                        help="This will skip the legacy grub bootloader creation step.")
+    parser.add_argument("--target-filesystem", "--tgt-fs", choices=["FAT", "NTFS"], default="FAT", type=str.upper,
+                        help="Specify the filesystem to use as the target partition's filesystem.")
+    parser.add_argument("--copy-workers", type=int, default=copy_engine.DEFAULT_COPY_WORKERS, metavar="N",
+                        help="Number of files copied concurrently (default: %(default)s)")
+    parser.add_argument("--buffer-size", type=size, default=copy_engine.DEFAULT_BUFFER_SIZE,
+                        metavar="SIZE",
+                        help="Size of a single read/write while copying, e.g. 4M or 512K (default: 4M)")
+    parser.add_argument("--progress", choices=["text", "json", "none"], default="text",
+                        help="How to report copy progress on standard output, json writes one JSON object per line "
+                             "for progress updates and messages (default: %(default)s)")
+    parser.add_argument("--direct-write", action="store_true",
+                        help="Build the FAT32 filesystem in memory and write it to the new partition as large "
+                             "sequential writes, instead of formatting, mounting and copying file by file "
+                             "(--device with FAT only)")
+    parser.add_argument("--verify", action="store_true",
+                        help="Read every file back from the target, bypassing the page cache, and compare it with "
+                             "a hash of the source computed while copying")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue a job interrupted by an unplug or a crash: nothing is wiped or formatted, "
+                             "files the job journal on the target proves to be written correctly are skipped")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Update a target partition written by an earlier job to a newer source: files are "
+                             "compared by size and hash, only the ones that changed are written and files the "
+                             "new source no longer has are deleted (--partition only)")
+    parser.add_argument("--uefi-ntfs-image", metavar="PATH",
+                        help="Local copy of uefi-ntfs.img for NTFS targets, added to the local cache so later jobs "
+                             "don't need it; without it the cached image is used and only downloaded when there is "
+                             "none")
+    parser.add_argument("--dirty-limit", type=size, metavar="SIZE",
+                        help="Most data written to the target but not yet on the device during the copy, e.g. 64M; "
+                             "the final flush stays short and the progress follows what is actually on the device "
+                             "(default: no limit)")
+    parser.add_argument("--discard", action="store_true",
+                        help="Discard (TRIM) the blocks of the target device before partitioning it, many flash "
+                             "drives write faster to discarded blocks; skipped when the device doesn't support it "
+                             "(--device only)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Time every phase of the job and every external tool it runs, and write the spans to "
+                             "FILE as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Run as a daemon taking jobs as JSON requests on a UNIX socket and streaming their "
+                             "progress back, instead of writing a single target")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="UNIX socket of --daemon, only root can connect to it (default: /run/woeusb.sock)")
+    parser.add_argument("--max-jobs", type=int, metavar="N",
+                        help="Jobs --daemon runs at the same time, the others wait for their turn (default: 4)")
+    parser.add_argument('--for-gui', action="store_true", help=argparse.SUPPRESS)
+
+    return parser
+
+
+def run():
+    result = init()
+    if not isinstance(result, list):
+        return result
+
+    job, progress_format, no_color, trace_file = result
+
+    if trace_file is not None:
+        trace.start()
+
+    # Messages and progress are printed from the bus, the copy never waits for the terminal
+    output = utils.subscribe_output(progress_format, no_color)
+
+    result = 1
+    try:
+        result = main(job)
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc()
+
+    trace.phase("cleanup")
+    cleanup(job)
+
+    if trace_file is not None:
+        try:
+            trace.stop(trace_file)
+        except OSError as e:
+            utils.print_with_color(_("Warning: Unable to write the trace to {0}: {1}").format(trace_file, e.strerror),
+                                   "yellow")
+
+    events.bus.unsubscribe(output)
+
+    return result
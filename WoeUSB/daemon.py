@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+"""
+Flashing daemon: jobs submitted over a local UNIX socket and run side by side in one long-lived process
+
+woeusb --daemon listens on a UNIX socket only root can connect to. A client sends a single JSON request on one
+line and reads JSON lines back until the daemon closes the connection:
+
+    {"command": "submit", "source": "/srv/win11.iso", "targets": ["/dev/sdb"], "filesystem": "NTFS"}
+        {"event": "accepted", "job": 3}, then the phase, message and progress events of the job as
+        --progress json writes them, then {"event": "finished", "job": 3, "result": 0}
+    {"command": "watch", "job": 3}
+        The events of a submitted job until it finishes; without "job" the events of every job, until the
+        client disconnects
+    {"command": "cancel", "job": 3}
+        {"event": "cancelled", "job": 3}
+    {"command": "status"}
+        {"event": "status", "jobs": [{"job": 3, "state": "start-copying", ...}, ...]}
+    {"command": "devices"}
+        {"event": "devices", "devices": [{"path": "/dev/sdb", ...}, ...]}
+
+A submit takes "target" or "targets", "mode" ("device" or "partition") and the options of the command line
+named as in _JOB_OPTIONS. A request that can't be served gets {"event": "error", "text": "..."}. A job keeps
+running when its client disconnects, it can be watched again.
+
+What every woeusb process used to find again on each run stays warm: the tool paths are looked up once and
+the device inventory follows kernel uevents, the probe of a device is only dropped when it changes. At most
+max_jobs jobs run at once, the others wait in submission order, and a device is never the target of two
+unfinished jobs.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import os
+import signal
+import socket
+import stat
+import sys
+
+from WoeUSB import core, events, list_devices, miscellaneous, probe, progress, utils
+
+_ = miscellaneous.i18n
+
+DEFAULT_SOCKET_PATH = "/run/woeusb.sock"
+
+#: Jobs running at the same time
+DEFAULT_MAX_JOBS = 4
+
+#: Finished jobs still listed by status requests
+MAX_FINISHED_JOBS = 100
+
+#: Most event deliveries per second to the clients
+MAX_EVENT_RATE = 20
+
+#: Bytes waiting to be sent to a client before its progress events are skipped
+MAX_CLIENT_BUFFER = 1024 * 1024
+
+#: Longest request line
+MAX_REQUEST_SIZE = 64 * 1024
+
+#: Submit request keys and the core.Job argument each one sets
+_JOB_OPTIONS = {
+    "filesystem": "target_filesystem_type",
+    "label": "filesystem_label",
+    "workaround_bios_boot_flag": "workaround_bios_boot_flag",
+    "skip_legacy_bootloader": "skip_legacy_bootloader",
+    "copy_workers": "copy_workers",
+    "buffer_size": "buffer_size",
+    "direct_write": "direct_write",
+    "verify": "verify_files",
+    "resume": "resume",
+    "refresh": "refresh",
+    "uefi_ntfs_image": "uefi_ntfs_image",
+    "dirty_limit": "dirty_limit",
+    "discard": "discard",
+    "verbose": "verbose",
+}
+
+_BOOLEAN_OPTIONS = {"workaround_bios_boot_flag", "skip_legacy_bootloader", "direct_write", "verify", "resume",
+                    "refresh", "discard", "verbose"}
+
+#: Options given in bytes, as a number or as on the command line, e.g. "4M"
+_SIZE_OPTIONS = {"buffer_size", "dirty_limit"}
+
+#: Options a job writing several targets at once can't honour, the command line only warns about them
+_SINGLE_TARGET_OPTIONS = ["workaround_bios_boot_flag", "direct_write", "verify", "resume"]
+
+
+class RequestError(RuntimeError):
+    """
+    A request the daemon can't serve, the message is sent back to the client
+    """
+
+
+class DaemonJob:
+    """
+    A submitted core.Job and what the daemon tracks about it
+    """
+
+    def __init__(self, job, devices):
+        """
+        :param job: core.Job
+        :param devices: Kernel names of the whole devices the job writes to
+        """
+        self.job = job
+        self.devices = devices
+
+        self.started = False
+        #: 0 or 1 once the job is over
+        self.result = None
+        self.finished = asyncio.Event()
+
+    def as_dict(self):
+        if self.result is not None:
+            state = "finished"
+        elif self.started:
+            state = self.job.state
+        else:
+            state = "queued"
+
+        return {"job": self.job.id, "source": self.job.source_media, "targets": self.job.target_medias,
+                "mode": self.job.install_mode, "state": state, "cancelled": self.job.cancelled,
+                "result": self.result}
+
+
+class Daemon:
+    """
+    Serves the requests of the clients and runs their jobs
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, max_jobs=DEFAULT_MAX_JOBS, commands=None):
+        """
+        :param socket_path: Where to create the UNIX socket
+        :param max_jobs: Jobs running at the same time, the others wait
+        :param commands: [mkdosfs, mkntfs, grub-install] from utils.check_runtime_dependencies(), given to every job
+        """
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.commands = commands
+
+        #: Dictionary of job id to DaemonJob, in submission order
+        self.jobs = {}
+
+        self.__watchers = {}
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job")
+        self.__inventory = list_devices.DeviceInventory(on_change=self.__devices_changed)
+        self.__subscriber = None
+        self.__loop = None
+
+    async def serve(self):
+        """
+        Serve until SIGINT or SIGTERM, then cancel the jobs and wait until they are cleaned up
+        """
+        self.__loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+
+        remove_stale_socket(self.socket_path)
+        # Whoever can connect can wipe any device, the socket is created accessible to root only
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.__handle_client, path=self.socket_path,
+                                                     limit=MAX_REQUEST_SIZE)
+        finally:
+            os.umask(umask)
+
+        self.__subscriber = events.bus.subscribe(self.__event_published, max_rate=MAX_EVENT_RATE)
+        self.__inventory.start()
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            self.__loop.add_signal_handler(signal_number, stopping.set)
+
+        utils.print_with_color(_("Listening on {0}, running up to {1} jobs at once").format(
+            self.socket_path, self.max_jobs), "green")
+
+        try:
+            await stopping.wait()
+        finally:
+            utils.print_with_color(_("Stopping, running jobs are cancelled..."), "yellow")
+            server.close()
+
+            # Cancelled jobs stop at their next chunk and clean up after themselves, queued ones don't start
+            for daemon_job in self.jobs.values():
+                daemon_job.job.cancel()
+            await self.__loop.run_in_executor(None, self.__executor.shutdown)
+
+            for writers in self.__watchers.values():
+                for writer in writers:
+                    writer.close()
+            await server.wait_closed()
+
+            self.__inventory.stop()
+            events.bus.unsubscribe(self.__subscriber)
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    async def __handle_client(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            if not isinstance(request, dict):
+                raise RequestError(_("Error: A request is a JSON object"))
+
+            handler = {"submit": self.__submit,
+                       "watch": self.__watch,
+                       "cancel": self.__cancel,
+                       "status": self.__status,
+                       "devices": self.__devices}.get(request.get("command"))
+            if handler is None:
+                raise RequestError(_("Error: Unknown command {0}").format(request.get("command")))
+
+            await handler(request, reader, writer)
+        except (RequestError, ValueError) as e:
+            # ValueError: not JSON, or a line longer than MAX_REQUEST_SIZE
+            self.__send(writer, {"event": "error", "text": str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            for writers in self.__watchers.values():
+                writers.discard(writer)
+            writer.close()
+
+    async def __submit(self, request, reader, writer):
+        daemon_job = self.__create_job(request)
+        job_id = daemon_job.job.id
+        self.jobs[job_id] = daemon_job
+
+        self.__watchers.setdefault(job_id, set()).add(writer)
+        self.__send(writer, {"event": "accepted", "job": job_id})
+
+        future = self.__loop.run_in_executor(self.__executor, self.__run_job, daemon_job)
+        future.add_done_callback(functools.partial(self.__job_finished, daemon_job))
+
+        await self.__until_finished(writer, daemon_job.finished)
+
+    async def __watch(self, request, reader, writer):
+        job_id = request.get("job")
+        if job_id is None:
+            self.__watchers.setdefault(None, set()).add(writer)
+            await self.__until_finished(writer)
+            return
+
+        daemon_job = self.__find_job(job_id)
+        if daemon_job.result is not None:
+            self.__send(writer, {"event": "finished", "job": job_id, "result": daemon_job.result})
+            return
+
+        self.__watchers.setdefault(job_id, set()).add(writer)
+        await self.__until_finished(writer, daemon_job.finished)
+
+    async def __cancel(self, request, reader, writer):
+        daemon_job = self.__find_job(request.get("job"))
+        if daemon_job.result is not None:
+            raise RequestError(_("Error: Job {0} is already finished").format(daemon_job.job.id))
+
+        daemon_job.job.cancel()
+        self.__send(writer, {"event": "cancelled", "job": daemon_job.job.id})
+
+    async def __status(self, request, reader, writer):
+        self.__send(writer, {"event": "status", "jobs": [daemon_job.as_dict() for daemon_job in self.jobs.values()]})
+
+    async def __devices(self, request, reader, writer):
+        self.__send(writer, {"event": "devices", "devices": [
+            {"path": device.path, "description": device.description, "size": device.size, "model": device.model,
+             "removable": device.removable, "read_only": device.read_only, "optical": device.is_optical,
+             "target_candidate": list_devices.is_target_candidate(device)}
+            for device in self.__inventory.devices]})
+
+    async def __until_finished(self, writer, finished=None):
+        """
+        Wait until the job is finished, or forever without one, returns early when the connection is lost
+
+        A client closing its end for writing once the request is sent, as nc and socat do, still gets the events.
+        """
+        waiters = [asyncio.ensure_future(writer.wait_closed())]
+        if finished is not None:
+            waiters.append(asyncio.ensure_future(finished.wait()))
+
+        done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        for waiter in done:
+            # The connection error, if any, doesn't matter any more
+            waiter.exception()
+
+    def __create_job(self, request):
+        """
+        :return: DaemonJob, not started yet
+        """
+        source = request.get("source")
+        targets = request.get("targets", [request["target"]] if "target" in request else [])
+        if not isinstance(source, str) or not isinstance(targets, list) or not targets \
+                or not all(isinstance(target, str) for target in targets):
+            raise RequestError(_("Error: A job needs a source and at least one target"))
+
+        # The daemon doesn't run in the directory of the client
+        for path in [source] + targets + [request.get("uefi_ntfs_image") or "/"]:
+            if not os.path.isabs(path):
+                raise RequestError(_("Error: {0} is not an absolute path").format(path))
+
+        install_mode = request.get("mode", "device")
+        if install_mode not in ["device", "partition"]:
+            raise RequestError(_("Error: mode is either device or partition"))
+        if len(targets) > 1 and install_mode != "device":
+            raise RequestError(_("Error: Several targets can only be written in --device mode"))
+
+        options = {}
+        for key, value in request.items():
+            if key in ["command", "source", "target", "targets", "mode"]:
+                continue
+            if key not in _JOB_OPTIONS:
+                raise RequestError(_("Error: Unknown option {0}").format(key))
+            options[_JOB_OPTIONS[key]] = _option_value(key, value)
+
+        if len(targets) > 1:
+            for key in _SINGLE_TARGET_OPTIONS:
+                if options.get(_JOB_OPTIONS[key]):
+                    raise RequestError(_("Error: {0} can't be used when writing several targets").format(key))
+
+        devices = [probe.parent_device(os.path.basename(os.path.realpath(target))) for target in targets]
+        for daemon_job in self.jobs.values():
+            busy = set(daemon_job.devices).intersection(devices)
+            if daemon_job.result is None and busy:
+                raise RequestError(_("Error: /dev/{0} is already the target of job {1}").format(
+                    busy.pop(), daemon_job.job.id))
+
+        return DaemonJob(core.Job(source, targets, install_mode, commands=self.commands, **options), devices)
+
+    def __find_job(self, job_id):
+        # bool is an int too, anything else isn't hashable or can't be a job id
+        if not isinstance(job_id, int) or isinstance(job_id, bool):
+            raise RequestError(_("Error: A job id is a number"))
+
+        daemon_job = self.jobs.get(job_id)
+        if daemon_job is None:
+            raise RequestError(_("Error: There is no job {0}").format(job_id))
+        return daemon_job
+
+    def __run_job(self, daemon_job):
+        """
+        Run a job and clean up after it, from a thread of the executor
+
+        :return: 0 - success; 1 - failure
+        """
+        job = daemon_job.job
+        daemon_job.started = True
+
+        result = 1
+        with events.job_context(job.id):
+            try:
+                if job.cancelled:
+                    utils.print_with_color(_("Job {0} was cancelled before it started").format(job.id), "yellow")
+                else:
+                    result = job.run()
+            except Exception as e:
+                utils.print_with_color(str(e), "red")
+            finally:
+                job.cleanup()
+
+        # Every event of the job reaches the clients before the job is reported finished
+        self.__subscriber.flush()
+        return result
+
+    def __job_finished(self, daemon_job, future):
+        daemon_job.result = future.result() if future.exception() is None else 1
+        job_id = daemon_job.job.id
+
+        self.__dispatch(job_id, {"event": "finished", "job": job_id, "result": daemon_job.result})
+        daemon_job.finished.set()
+        self.__watchers.pop(job_id, None)
+
+        finished = [other_id for other_id, other in self.jobs.items() if other.result is not None]
+        for other_id in finished[:-MAX_FINISHED_JOBS]:
+            del self.jobs[other_id]
+
+    def __event_published(self, event):
+        # Called from the delivery thread of the subscriber
+        line = utils.event_as_dict(event)
+        if line is not None:
+            self.__loop.call_soon_threadsafe(self.__dispatch, event.job, line)
+
+    def __dispatch(self, job_id, line):
+        writers = self.__watchers.get(job_id, set()) | self.__watchers.get(None, set())
+        for writer in writers:
+            # A client that doesn't keep up misses progress reports, never messages
+            if line["event"] == "progress" and writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                continue
+            self.__send(writer, line)
+
+    def __devices_changed(self, added, removed, changed):
+        # A stick plugged in may get the name of the one pulled out, what was probed before is forgotten
+        for device in added + removed + changed:
+            probe.invalidate(device.name)
+
+    @staticmethod
+    def __send(writer, line):
+        if not writer.is_closing():
+            writer.write(progress.json_line(line).encode("utf-8"))
+
+
+def _option_value(key, value):
+    """
+    :return: The value of a submit option as core.Job takes it
+    """
+    if key in _BOOLEAN_OPTIONS:
+        if not isinstance(value, bool):
+            raise RequestError(_("Error: {0} is either true or false").format(key))
+    elif key in _SIZE_OPTIONS:
+        if isinstance(value, str):
+            value = utils.parse_size(value)
+        if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+            raise RequestError(_("Error: {0} is a size in bytes").format(key))
+    elif key == "copy_workers":
+        if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+            raise RequestError(_("Error: {0} is a positive number").format(key))
+    elif key == "filesystem":
+        if not isinstance(value, str) or value.upper() not in ["FAT", "NTFS"]:
+            raise RequestError(_("Error: filesystem is either FAT or NTFS"))
+        value = value.upper()
+    elif not isinstance(value, str):
+        raise RequestError(_("Error: {0} is a string").format(key))
+    return value
+
+
+def remove_stale_socket(path):
+    """
+    Remove the socket a daemon that is no longer running left behind
+
+    :param path: Socket path
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise RuntimeError(_("Error: {0} exists and is not a socket").format(path))
+    except FileNotFoundError:
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise RuntimeError(_("Error: Another daemon is already listening on {0}").format(path))
+
+
+def log_message(event, no_color=False):
+    """
+    Console subscriber of the daemon: the messages of every job, prefixed with the job id
+
+    :param event: events.Event
+    :param no_color: Print messages without color
+    """
+    if not isinstance(event, events.Message):
+        return
+    if event.job is not None:
+        event = events.Message("[{0}] {1}".format(event.job, event.text), event.level, event.color)
+    utils.print_event(event, "none", no_color)
+
+
+def request(message, socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Send a request to a running daemon, for client scripts
+
+    :param message: Dictionary, e.g. {"command": "submit", "source": "/srv/win11.iso", "targets": ["/dev/sdb"]}
+    :param socket_path: Socket of the daemon
+    :return: Generator of the reply dictionaries, until the daemon closes the connection
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(progress.json_line(message).encode("utf-8"))
+        with client.makefile("r", encoding="utf-8") as replies:
+            for line in replies:
+                yield json.loads(line)
+
+
+def run(socket_path=DEFAULT_SOCKET_PATH, max_jobs=DEFAULT_MAX_JOBS, no_color=False):
+    """
+    Run the daemon until SIGINT or SIGTERM
+
+    :param socket_path: Where to create the UNIX socket
+    :param max_jobs: Jobs running at the same time
+    :param no_color: Log messages without color
+    :return: 0 - success; 1 - failure
+    """
+    output = events.bus.subscribe(functools.partial(log_message, no_color=no_color))
+    try:
+        # Looked up once for every job the daemon runs
+        commands = utils.check_runtime_dependencies(core.application_name)
+        # Jobs run from the threads of the executor, the engine must be loaded before the first one starts
+        core.load_engine()
+        asyncio.run(Daemon(socket_path, max_jobs, commands).serve())
+        return 0
+    except RuntimeError as e:
+        utils.print_with_color(str(e), "red")
+        return 1
+    except OSError as e:
+        utils.print_with_color(_("Error: Unable to listen on {0}: {1}").format(socket_path, e.strerror), "red")
+        return 1
+    finally:
+        events.bus.unsubscribe(output)
+        sys.stdout.flush()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Discarding (TRIM) the blocks of the target
+
+wipefs only clears the signatures, the flash translation layer of the stick still maps every block ever written
+and later writes can cost the controller a read-modify-write. BLKDISCARD tells the device the blocks are unused,
+many USB and SD controllers then write them much faster. The ioctl is issued in-process, without forking
+blkdiscard, and support is read from queue/discard_max_bytes in sysfs.
+"""
+
+import fcntl
+import os
+import struct
+
+from WoeUSB import probe
+
+#: _IO(0x12, 119) from linux/fs.h, takes a {start, length} pair of 64-bit byte counts
+BLKDISCARD = 0x1277
+
+#: Bytes discarded by a single ioctl, so a slow device gets a chance to be cancelled between two of them
+DISCARD_CHUNK_SIZE = 1024 * 1024 * 1024
+
+
+class DiscardError(RuntimeError):
+    """
+    Raised when the device can't discard or a discard fails
+    """
+
+
+def discard_limits(device):
+    """
+    :param device: Device node of a whole device or of a partition
+    :return: (discard granularity, largest single discard) in bytes, (0, 0) when the device can't discard
+    """
+    # Partitions have no queue/ of their own, it belongs to the whole device
+    queue = os.path.join(probe.SYSFS_CLASS_BLOCK, probe.parent_device(os.path.basename(os.path.realpath(device))),
+                         "queue")
+    try:
+        with open(os.path.join(queue, "discard_max_bytes")) as discard_max_bytes:
+            max_bytes = int(discard_max_bytes.read())
+        with open(os.path.join(queue, "discard_granularity")) as discard_granularity:
+            granularity = int(discard_granularity.read())
+    except (OSError, ValueError):
+        return 0, 0
+
+    if max_bytes == 0:
+        return 0, 0
+    return granularity, max_bytes
+
+
+def supports_discard(device):
+    """
+    :param device: Device node of a whole device or of a partition
+    :return: Whether BLKDISCARD can be issued on the device
+    """
+    return discard_limits(device)[1] > 0
+
+
+def discard(device, start=0, length=None, should_stop=None):
+    """
+    Discard a range of the device, shrunk to whole discard granules
+
+    :param device: Device node, not mounted
+    :param start: Offset in bytes of the range
+    :param length: Length in bytes of the range, None up to the end of the device
+    :param should_stop: Callable polled between two ioctls, discarding is abandoned when it returns True
+    :return: Number of bytes discarded
+    """
+    granularity, max_bytes = discard_limits(device)
+    if max_bytes == 0:
+        raise DiscardError("{0} doesn't support discard".format(device))
+
+    # O_EXCL fails while the device or one of its partitions is mounted
+    fd = os.open(device, os.O_WRONLY | os.O_EXCL)
+    try:
+        device_size = os.lseek(fd, 0, os.SEEK_END)
+        end = device_size if length is None else min(start + length, device_size)
+
+        granularity = max(granularity, 512)
+        start = -(-start // granularity) * granularity
+        end = end // granularity * granularity
+
+        offset = start
+        while offset < end:
+            if should_stop is not None and should_stop():
+                break
+
+            chunk_length = min(end - offset, DISCARD_CHUNK_SIZE)
+            try:
+                fcntl.ioctl(fd, BLKDISCARD, struct.pack("=QQ", offset, chunk_length))
+            except OSError as e:
+                raise DiscardError("Discarding {0} failed at offset {1}: {2}".format(device, offset, e.strerror))
+            offset += chunk_length
+    finally:
+        os.close(fd)
+
+    return max(offset - start, 0)
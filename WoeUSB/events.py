@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+In-process event bus between the engine and whatever shows what it does
+
+The engine publishes typed events (phase changed, copy progress, info and warning messages, errors) and
+never calls into the GUI or the terminal itself. Every subscriber, the console printer, the wx GUI or the
+JSON logger, gets its own queue and its own delivery thread, so publishing never waits for a slow
+subscriber. Progress events are coalesced, a subscriber only ever gets the latest one per target, and a
+subscriber can be given a maximum delivery rate: events published in between are delivered together at the
+next slot. When a subscriber falls far behind, the oldest info messages are dropped first; warnings and
+errors are always delivered.
+
+Several jobs can run in the same process, every event carries the id of the job that published it. The job
+is taken from the context of the publishing thread, see job_context(); threads a job starts for itself get
+it through bind().
+"""
+
+import collections
+import contextlib
+import contextvars
+import threading
+import time
+
+#: Undelivered events a subscriber keeps before dropping info messages
+DEFAULT_MAX_PENDING = 1000
+
+_current_job = contextvars.ContextVar("job", default=None)
+
+
+class Event:
+    """
+    Base class of everything published on the bus
+    """
+    #: Id of the job that published the event, None outside of any job; set by EventBus.publish()
+    __slots__ = ("job",)
+
+    def coalesce_key(self):
+        """
+        :return: Events with the same key replace each other while waiting for delivery, None never coalesces
+        """
+        return None
+
+
+class PhaseChanged(Event):
+    """
+    The job entered a new state, see core.Job.enter_state()
+    """
+    __slots__ = ("phase",)
+
+    def __init__(self, phase):
+        """
+        :param phase: e.g. "start-copying"
+        """
+        self.phase = phase
+
+
+class Progress(Event):
+    """
+    Bytes copied so far
+    """
+    __slots__ = ("report", "target")
+
+    def __init__(self, report, target=None):
+        """
+        :param report: progress.ProgressReport
+        :param target: Target the report is about when several are written at once
+        """
+        self.report = report
+        self.target = target
+
+    def coalesce_key(self):
+        return "progress", self.job, self.target
+
+
+class Message(Event):
+    """
+    A line for the user
+    """
+    __slots__ = ("text", "level", "color")
+
+    def __init__(self, text, level="info", color=""):
+        """
+        :param text: Message, already translated
+        :param level: "info", "warning" or "error"
+        :param color: Color of the message on a terminal, "" for the default one
+        """
+        self.text = text
+        self.level = level
+        self.color = color
+
+
+class Subscriber:
+    """
+    Delivers the events of a bus to one callback, from its own thread
+    """
+
+    def __init__(self, callback, max_rate=None, max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param callback: Callable taking an Event, called from the delivery thread only
+        :param max_rate: Most deliveries per second, None for no limit
+        :param max_pending: Undelivered events kept before the oldest info messages are dropped
+        """
+        self.callback = callback
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.max_pending = max_pending
+
+        #: Info messages dropped because the subscriber fell behind
+        self.dropped = 0
+
+        self.__pending = collections.deque()
+        self.__coalesced = {}
+        self.__delivering = False
+        self.__closed = False
+        self.__condition = threading.Condition()
+
+        self.__thread = threading.Thread(target=self.__deliver, daemon=True, name="events")
+        self.__thread.start()
+
+    def put(self, event):
+        """
+        Queue an event, never blocks
+
+        :param event: Event
+        """
+        with self.__condition:
+            key = event.coalesce_key()
+            if key is not None:
+                if key in self.__coalesced:
+                    # Already queued, only the latest is delivered, at the place of the first
+                    self.__coalesced[key] = event
+                    return
+                self.__coalesced[key] = event
+                self.__pending.append(key)
+            else:
+                if len(self.__pending) >= self.max_pending:
+                    self.__drop_info_message()
+                self.__pending.append(event)
+            self.__condition.notify()
+
+    def flush(self, timeout=None):
+        """
+        Wait until every event queued so far is delivered
+
+        :param timeout: Seconds to wait at most, None to wait as long as it takes
+        :return: Whether everything was delivered
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: not self.__pending and not self.__delivering, timeout)
+
+    def close(self, timeout=None):
+        """
+        Deliver what is queued, then stop the delivery thread
+        """
+        self.flush(timeout)
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join(timeout)
+
+    def __drop_info_message(self):
+        for index, queued in enumerate(self.__pending):
+            if isinstance(queued, Message) and queued.level == "info":
+                del self.__pending[index]
+                self.dropped += 1
+                return
+
+    def __deliver(self):
+        last_delivery = 0.0
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__pending or self.__closed)
+                if self.__closed and not self.__pending:
+                    return
+
+            # Rate limited: whatever is published meanwhile is delivered in the same batch
+            delay = last_delivery + self.min_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.__condition:
+                batch = [self.__coalesced.pop(queued) if not isinstance(queued, Event) else queued
+                         for queued in self.__pending]
+                self.__pending.clear()
+                self.__delivering = True
+
+            try:
+                for event in batch:
+                    try:
+                        self.callback(event)
+                    except Exception:
+                        # A broken subscriber must not take the others or the job down
+                        pass
+            finally:
+                last_delivery = time.monotonic()
+                with self.__condition:
+                    self.__delivering = False
+                    self.__condition.notify_all()
+
+
+class EventBus:
+    """
+    Fans every published event out to the subscribers
+    """
+
+    def __init__(self):
+        self.__subscribers = []
+        self.__lock = threading.Lock()
+
+    def subscribe(self, callback, max_rate=None, max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param callback: Callable taking an Event, called from a thread of its own
+        :param max_rate: Most deliveries per second, None for no limit
+        :param max_pending: Undelivered events kept before the oldest info messages are dropped
+        :return: Subscriber, to give to unsubscribe()
+        """
+        subscriber = Subscriber(callback, max_rate, max_pending)
+        with self.__lock:
+            self.__subscribers = self.__subscribers + [subscriber]
+        return subscriber
+
+    def unsubscribe(self, subscriber, timeout=None):
+        """
+        Deliver what the subscriber has queued, then remove it
+
+        :param subscriber: Subscriber returned by subscribe()
+        """
+        with self.__lock:
+            self.__subscribers = [other for other in self.__subscribers if other is not subscriber]
+        subscriber.close(timeout)
+
+    def publish(self, event):
+        """
+        :param event: Event
+        :return: Number of subscribers the event was queued for
+        """
+        event.job = _current_job.get()
+
+        # The list is replaced, never changed in place, publishing doesn't need the lock
+        subscribers = self.__subscribers
+        for subscriber in subscribers:
+            subscriber.put(event)
+        return len(subscribers)
+
+    def flush(self, timeout=None):
+        """
+        Wait until every subscriber got every event published so far
+        """
+        for subscriber in self.__subscribers:
+            subscriber.flush(timeout)
+
+
+#: Bus of the running process, the engine publishes everything on it
+bus = EventBus()
+
+
+def publish(event):
+    """
+    Publish on the bus of the process
+
+    :return: Number of subscribers the event was queued for
+    """
+    return bus.publish(event)
+
+
+@contextlib.contextmanager
+def job_context(job):
+    """
+    Tag everything the current thread publishes in the body of a with statement with a job
+
+    :param job: Id of the job
+    """
+    token = _current_job.set(job)
+    try:
+        yield
+    finally:
+        _current_job.reset(token)
+
+
+def bind(function):
+    """
+    Keep the job of the calling thread for a callable run from other threads, e.g. a progress reporter
+    called from the copy workers
+
+    :param function: Callable
+    :return: Callable publishing for the job function was bound in
+    """
+    job = _current_job.get()
+
+    def bound(*args, **kwargs):
+        with job_context(job):
+            return function(*args, **kwargs)
+
+    return bound
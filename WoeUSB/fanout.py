@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+Fan-out copy: one source, many targets
+
+Writing the same image to a batch of USB sticks one after the other reads the source once per stick.
+Here the source is read once: every chunk is handed to a bounded queue per target and every target has
+its own writer thread. The reader goes at the pace of the slowest target, so the batch takes as long as
+the slowest stick instead of the sum of all of them, and a target that fails is dropped without stopping
+the others.
+"""
+
+import os
+import queue
+import threading
+
+from WoeUSB import copy_engine, wim, writeback
+
+#: Chunks queued per target, the memory used is about targets * depth * buffer_size
+DEFAULT_QUEUE_DEPTH = 8
+
+_DIRECTORY = 0
+_OPEN = 1
+_DATA = 2
+_CLOSE = 3
+_END_OF_WORK = 4
+
+
+class FanOutTarget:
+    """
+    One target of a fan-out copy: where to write, and how it went
+    """
+
+    def __init__(self, name, directory, on_progress=None):
+        """
+        :param name: Name of the target in messages, usually the device
+        :param directory: Where the target filesystem is mounted
+        :param on_progress: Callable taking the number of source bytes just written to this target
+        """
+        self.name = name
+        self.directory = directory
+        self.on_progress = on_progress if on_progress is not None else lambda length: None
+
+        #: First exception raised while writing to this target, None while it is healthy
+        self.error = None
+
+        self.queue = None
+
+
+class FanOut:
+    """
+    Reads every file of the source once and writes it to all targets through one writer thread per target
+    """
+
+    def __init__(self, targets, buffer_size=copy_engine.DEFAULT_BUFFER_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 split_wim=False, should_stop=None, dirty_limit=None):
+        """
+        :param targets: List of FanOutTarget
+        :param buffer_size: Size in bytes of a single read/write
+        :param queue_depth: Chunks queued per target before the reader waits for the slowest writer
+        :param split_wim: Split an install.wim too large for FAT32 into .swm parts
+        :param should_stop: Callable polled between chunks, the copy is abandoned when it returns True
+        :param dirty_limit: Most bytes written to each target but not yet on the device, None to leave it to the
+                            kernel
+        """
+        if buffer_size < 4096:
+            raise ValueError("buffer_size must be at least 4096 bytes")
+
+        self.targets = targets
+        self.buffer_size = buffer_size
+        self.queue_depth = queue_depth
+        self.split_wim = split_wim
+        self.should_stop = should_stop
+        self.dirty_limit = dirty_limit
+
+        #: Set when the copy is cancelled through should_stop
+        self.cancelled = False
+
+    def copy_manifest(self, source_manifest):
+        """
+        Copy every file of a source manifest to every target
+
+        :param source_manifest: manifest.SourceManifest of a mounted source or of a disc image
+        :return: List of the FanOutTarget that got a complete copy
+        """
+        threads = []
+        for target in self.targets:
+            target.queue = queue.Queue(maxsize=self.queue_depth)
+            threads.append(threading.Thread(target=self.__writer, args=(target,), daemon=True,
+                                            name="fan_out_" + os.path.basename(target.name)))
+        for thread in threads:
+            thread.start()
+
+        try:
+            for directory in source_manifest.directories:
+                self.__broadcast(_DIRECTORY, directory)
+
+            for path, chunks in self.__files(source_manifest):
+                if not self.__healthy_targets():
+                    break
+
+                self.__broadcast(_OPEN, path)
+                try:
+                    for chunk in chunks:
+                        if self.should_stop is not None and self.should_stop():
+                            self.cancelled = True
+                            return []
+                        self.__broadcast(_DATA, chunk)
+                finally:
+                    chunks.close()
+                self.__broadcast(_CLOSE, None)
+        finally:
+            # Failed targets get it as well, their writers drain the queue until then
+            for target in self.targets:
+                target.queue.put((_END_OF_WORK, None))
+            for thread in threads:
+                thread.join()
+
+        return self.__healthy_targets()
+
+    def __healthy_targets(self):
+        return [target for target in self.targets if target.error is None]
+
+    def __broadcast(self, kind, value):
+        for target in self.__healthy_targets():
+            target.queue.put((kind, value))
+
+    def __files(self, source_manifest):
+        """
+        :return: Generator of (relative path, generator of (bytes, source bytes)), split WIMs become one entry per part
+        """
+        for file in source_manifest.files:
+            if not (self.split_wim and wim.needs_split(file.path, file.size)):
+                yield file.path, self.__read(file)
+                continue
+
+            wim_source = wim.WimSource(file.source, self.buffer_size)
+            try:
+                parts = wim.plan_split(wim_source, file.path)
+
+                # Part headers and tables are rewritten, so progress is reported against the size of the original
+                budget = [file.size]
+                for part_path, part in parts:
+                    yield part_path, self.__read_part(part, budget, part is parts[-1][1])
+            finally:
+                wim_source.close()
+
+    def __read(self, file):
+        if not isinstance(file.source, str):
+            for chunk in file.source.chunks(self.buffer_size):
+                with chunk:
+                    yield bytes(chunk), len(chunk)
+            return
+
+        fd = os.open(file.source, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                # A new bytes object per read, every writer thread holds on to it until it is written
+                data = os.read(fd, self.buffer_size)
+                if not data:
+                    break
+                yield data, len(data)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def __read_part(part, budget, last):
+        for chunk in part.chunks():
+            progress = min(len(chunk), budget[0])
+            budget[0] -= progress
+            yield bytes(chunk), progress
+
+        if last and budget[0]:
+            yield b"", budget[0]
+
+    def __writer(self, target):
+        dirty_limit = writeback.DirtyLimit(self.dirty_limit, 1) if self.dirty_limit is not None else None
+        fd = None
+        write_behind = None
+        while True:
+            kind, value = target.queue.get()
+            if kind == _END_OF_WORK:
+                break
+
+            # A failed target keeps draining its queue so the reader never blocks on it
+            if target.error is not None:
+                continue
+
+            try:
+                if kind == _DIRECTORY:
+                    os.makedirs(os.path.join(target.directory, value), exist_ok=True)
+                elif kind == _OPEN:
+                    fd = os.open(os.path.join(target.directory, value), os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                 0o644)
+                    write_behind = dirty_limit.open(fd) if dirty_limit is not None else None
+                elif kind == _DATA:
+                    data, progress = value
+                    _write(fd, data)
+                    if write_behind is not None:
+                        write_behind.written(len(data))
+                    target.on_progress(progress)
+                elif kind == _CLOSE:
+                    if write_behind is not None:
+                        dirty_limit.close(write_behind)
+                    os.close(fd)
+                    fd = None
+            except Exception as e:
+                target.error = e
+                if fd is not None:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
+                    fd = None
+
+        if fd is not None:
+            os.close(fd)
+
+        # Every writer flushes its own target, side by side, instead of one sync of the whole host at the end
+        if target.error is None and not self.cancelled:
+            try:
+                writeback.flush_filesystem(target.directory)
+            except OSError as e:
+                target.error = e
+
+
+def _write(fd, data):
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
@@ -0,0 +1,684 @@
+#!/usr/bin/env python3
+
+"""
+Userspace FAT32 builder
+
+Formatting the partition, mounting it and copying file by file makes the kernel update the FAT, the directories
+and the free cluster count with thousands of small scattered writes, which is slow on USB flash.
+Here the complete volume is laid out in memory from the source manifest instead: every directory and every file
+gets a contiguous run of clusters, so the FAT is a precomputed list of chains, and the boot sector, the FATs,
+the directories and the file data are written to the partition front to back as large sequential writes.
+"""
+
+import array
+import fcntl
+import os
+import queue
+import stat
+import struct
+import sys
+import threading
+import time
+
+from WoeUSB import wim
+
+#: Reserved sectors before the first FAT, at least; the data region is aligned after them
+RESERVED_SECTORS = 32
+
+#: The data region starts on a multiple of this many bytes, erase blocks of flash memory are that large or smaller
+DATA_ALIGNMENT = 1024 * 1024
+
+#: Number of chunks read ahead of the writes
+DEFAULT_READ_AHEAD = 4
+
+_NUMBER_OF_FATS = 2
+_ROOT_CLUSTER = 2
+_MEDIA_DESCRIPTOR = 0xF8
+_END_OF_CHAIN = 0x0FFFFFFF
+
+_MIN_CLUSTERS = 65525
+_MAX_CLUSTERS = 0x0FFFFFF5 - 2
+
+_ATTRIBUTE_VOLUME_ID = 0x08
+_ATTRIBUTE_DIRECTORY = 0x10
+_ATTRIBUTE_ARCHIVE = 0x20
+_ATTRIBUTE_LONG_NAME = 0x0F
+
+_CASE_LOWER_BASE = 0x08
+_CASE_LOWER_EXTENSION = 0x10
+
+_DIRECTORY_ENTRY_SIZE = 32
+_MAX_DIRECTORY_ENTRIES = 65536
+_LONG_NAME_CHARACTERS = 13
+
+_BLKSSZGET = 0x1268
+
+_SHORT_NAME_INVALID = set('"*+,./:;<=>?[\\]| ')
+
+# int 18h (boot the next device) then halt, for firmwares that try to boot the partition
+_BOOT_CODE = b"\xcd\x18\xeb\xfe"
+
+_END_OF_DATA = None
+
+
+class Fat32Error(RuntimeError):
+    """
+    Raised when the source can't be laid out as a FAT32 volume
+    """
+
+
+class Fat32Layout:
+    """
+    Geometry of the volume: sector and cluster sizes, reserved region, FAT size and number of clusters
+    """
+
+    def __init__(self, volume_size, sector_size=512, hidden_sectors=0, cluster_size=None):
+        """
+        :param volume_size: Size of the partition in bytes
+        :param sector_size: Logical sector size of the device
+        :param hidden_sectors: Sectors before the partition on the device
+        :param cluster_size: Cluster size in bytes, chosen from volume_size like Windows does when None
+        """
+        self.sector_size = sector_size
+        self.hidden_sectors = hidden_sectors
+        self.total_sectors = volume_size // sector_size
+
+        if self.total_sectors > 0xFFFFFFFF:
+            raise Fat32Error("Partition is too large for FAT32")
+
+        if cluster_size is None:
+            cluster_size = default_cluster_size(volume_size)
+
+        # Small partitions get smaller clusters until there are enough of them for FAT32
+        cluster_size = max(cluster_size, sector_size)
+        while True:
+            self.__compute(cluster_size // sector_size)
+            if self.cluster_count >= _MIN_CLUSTERS or cluster_size == sector_size:
+                break
+            cluster_size //= 2
+
+        if self.cluster_count < _MIN_CLUSTERS:
+            raise Fat32Error("Partition is too small for FAT32")
+        if self.cluster_count > _MAX_CLUSTERS:
+            raise Fat32Error("Too many clusters for FAT32, use a larger cluster size")
+
+        #: Cluster size in bytes
+        self.cluster_size = self.sectors_per_cluster * sector_size
+
+        #: Offset of cluster 2 from the start of the partition in bytes
+        self.data_offset = (self.reserved_sectors + _NUMBER_OF_FATS * self.fat_sectors) * sector_size
+
+    def __compute(self, sectors_per_cluster):
+        self.sectors_per_cluster = sectors_per_cluster
+        self.reserved_sectors = RESERVED_SECTORS
+
+        # The FAT size and the number of clusters depend on each other, grow the FAT until every cluster has an entry
+        self.fat_sectors = 1
+        while True:
+            self.cluster_count = self.__clusters()
+            fat_sectors = -(-(self.cluster_count + 2) * 4 // self.sector_size)
+            if fat_sectors <= self.fat_sectors:
+                break
+            self.fat_sectors = fat_sectors
+
+        # Then push the data region to the next alignment boundary, which only removes clusters
+        alignment = max(DATA_ALIGNMENT // self.sector_size, 1)
+        data_start = self.reserved_sectors + _NUMBER_OF_FATS * self.fat_sectors
+        self.reserved_sectors += -data_start % alignment
+        self.cluster_count = max(self.__clusters(), 0)
+
+    def __clusters(self):
+        data_sectors = self.total_sectors - self.reserved_sectors - _NUMBER_OF_FATS * self.fat_sectors
+        return data_sectors // self.sectors_per_cluster
+
+    @classmethod
+    def for_device(cls, fd, partition_offset=0, cluster_size=None):
+        """
+        :param fd: File descriptor of the partition, or of a regular file holding a volume image
+        :param partition_offset: Offset of the partition on its device in bytes
+        :param cluster_size: Cluster size in bytes, chosen from the partition size when None
+        :return: Fat32Layout filling the whole partition
+        """
+        sector_size = 512
+        if stat.S_ISBLK(os.fstat(fd).st_mode):
+            sector_size = struct.unpack("i", fcntl.ioctl(fd, _BLKSSZGET, b"\0" * 4))[0]
+
+        volume_size = os.lseek(fd, 0, os.SEEK_END)
+        os.lseek(fd, 0, os.SEEK_SET)
+        return cls(volume_size, sector_size, partition_offset // sector_size, cluster_size)
+
+
+class _Entry:
+    """
+    A file or a directory of the volume and the clusters allocated to it
+    """
+    __slots__ = ("name", "short_name", "case", "long_name", "size", "is_directory", "parent", "children",
+                 "content", "first_cluster", "cluster_count")
+
+    def __init__(self, name, size, is_directory, parent, content=None):
+        self.name = name
+        self.short_name = None
+        self.case = 0
+        self.long_name = False
+        self.size = size
+        self.is_directory = is_directory
+        self.parent = parent
+        self.children = []
+        self.content = content
+        self.first_cluster = 0
+        self.cluster_count = 0
+
+
+class Fat32Volume:
+    """
+    A complete FAT32 volume laid out from a source manifest, ready to be streamed to the partition
+    """
+
+    def __init__(self, source_manifest, layout, label, split_wim=False, buffer_size=4 * 1024 * 1024,
+                 read_ahead=DEFAULT_READ_AHEAD):
+        """
+        :param source_manifest: manifest.SourceManifest of a mounted source or of a disc image
+        :param layout: Fat32Layout of the partition
+        :param label: Volume label, truncated to 11 characters
+        :param split_wim: Write an install.wim too large for FAT32 as .swm parts
+        :param buffer_size: Size in bytes of a single read/write
+        :param read_ahead: Number of chunks a separate thread reads ahead of the writes, 0 to read and write in turn
+        """
+        self.layout = layout
+        self.label = _volume_label(label)
+        self.buffer_size = buffer_size
+        self.read_ahead = read_ahead
+        self.timestamp = _dos_timestamp(time.localtime())
+
+        #: Set when the write is cancelled through should_stop
+        self.cancelled = False
+
+        self.__wim_sources = []
+
+        self.root = _Entry("", 0, True, None)
+        try:
+            self.__add_manifest(source_manifest, split_wim)
+            self.__assign_short_names(self.root)
+            self.__allocate()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Close the WIM files opened for splitting
+        """
+        for wim_source in self.__wim_sources:
+            wim_source.close()
+        self.__wim_sources = []
+
+    @property
+    def used_clusters(self):
+        return self.__next_cluster - _ROOT_CLUSTER
+
+    @property
+    def size(self):
+        """
+        Bytes written to the partition by write()
+        """
+        return self.layout.data_offset + self.used_clusters * self.layout.cluster_size
+
+    def __add_manifest(self, source_manifest, split_wim):
+        directories = {"": self.root}
+        for path in source_manifest.directories:
+            parent_path, name = os.path.split(path)
+            directory = _Entry(name, 0, True, directories[parent_path])
+            directory.parent.children.append(directory)
+            directories[path] = directory
+
+        for file in source_manifest.files:
+            parent_path, name = os.path.split(file.path)
+            parent = directories[parent_path]
+
+            if split_wim and wim.needs_split(file.path, file.size):
+                wim_source = wim.WimSource(file.source, self.buffer_size)
+                self.__wim_sources.append(wim_source)
+                parts = wim.plan_split(wim_source, file.path)
+
+                # Part headers and tables are rewritten, so progress is reported against the size of the original
+                budget = [file.size]
+                for part_path, part in parts:
+                    parent.children.append(_Entry(os.path.basename(part_path), part.size, False, parent,
+                                                  self.__part_content(part, budget, part is parts[-1][1])))
+                continue
+
+            if file.size > wim.FAT32_MAX_FILE_SIZE:
+                raise Fat32Error(f"{file.path} is too large for FAT32")
+
+            parent.children.append(_Entry(name, file.size, False, parent, self.__file_content(file)))
+
+    def __assign_short_names(self, directory):
+        taken = set()
+        for entry in directory.children:
+            entry.short_name, entry.case, entry.long_name = _short_name(entry.name, taken)
+            taken.add(entry.short_name)
+
+            if entry.is_directory:
+                self.__assign_short_names(entry)
+
+        entries = _directory_entry_count(directory)
+        if entries > _MAX_DIRECTORY_ENTRIES:
+            raise Fat32Error(f"Too many files in directory {directory.name}")
+        directory.size = entries * _DIRECTORY_ENTRY_SIZE
+
+    def __allocate(self):
+        cluster_size = self.layout.cluster_size
+
+        # Directories first, in breadth-first order, so the whole tree sits at the start of the data region
+        directories = [self.root]
+        for directory in directories:
+            directories.extend(entry for entry in directory.children if entry.is_directory)
+        files = [entry for directory in directories for entry in directory.children if not entry.is_directory]
+
+        self.__entries = directories + [file for file in files if file.size > 0]
+        self.__next_cluster = _ROOT_CLUSTER
+        for entry in self.__entries:
+            entry.first_cluster = self.__next_cluster
+            entry.cluster_count = max(-(-entry.size // cluster_size), 1)
+            self.__next_cluster += entry.cluster_count
+
+        if self.used_clusters > self.layout.cluster_count:
+            raise Fat32Error("Not enough space on the partition")
+
+    def write(self, fd, should_stop=None, on_progress=None):
+        """
+        Write the volume to the start of fd with large sequential writes
+
+        :param fd: File descriptor of the partition opened for writing
+        :param should_stop: Callable polled between chunks, the write is abandoned when it returns True
+        :param on_progress: Callable taking the number of source bytes just written
+        """
+        writer = _SequentialWriter(fd, self.buffer_size)
+        os.lseek(fd, 0, os.SEEK_SET)
+
+        writer.write(self.reserved_region())
+        fat = self.fat()
+        for __ in range(_NUMBER_OF_FATS):
+            writer.write(fat)
+            writer.zero_fill(self.layout.fat_sectors * self.layout.sector_size - len(fat))
+
+        chunks = self.__stream()
+        if self.read_ahead > 0:
+            chunks = _read_ahead(chunks, self.read_ahead)
+        try:
+            for data, progress in chunks:
+                if data is _END_OF_DATA:
+                    writer.pad(self.layout.cluster_size)
+                    continue
+
+                if should_stop is not None and should_stop():
+                    self.cancelled = True
+                    return
+
+                writer.write(data)
+                if progress and on_progress is not None:
+                    on_progress(progress)
+        finally:
+            chunks.close()
+
+        writer.flush()
+        os.fsync(fd)
+
+    def __stream(self):
+        """
+        :return: Generator of (bytes, source bytes for progress), (_END_OF_DATA, 0) ends every entry
+        """
+        for entry in self.__entries:
+            if entry.is_directory:
+                yield self.directory(entry), 0
+            else:
+                yield from entry.content()
+            yield _END_OF_DATA, 0
+
+    def __file_content(self, file):
+        def content():
+            if not isinstance(file.source, str):
+                for chunk in file.source.chunks(self.buffer_size):
+                    with chunk:
+                        yield bytes(chunk), len(chunk)
+                return
+
+            fd = os.open(file.source, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                remaining = file.size
+                while remaining > 0:
+                    data = os.read(fd, min(self.buffer_size, remaining))
+                    if not data:
+                        raise Fat32Error(f"{file.source} shrank while being written")
+                    remaining -= len(data)
+                    yield data, len(data)
+            finally:
+                os.close(fd)
+
+        return content
+
+    @staticmethod
+    def __part_content(part, budget, last):
+        def content():
+            for chunk in part.chunks():
+                progress = min(len(chunk), budget[0])
+                budget[0] -= progress
+                yield bytes(chunk), progress
+
+            if last:
+                yield b"", budget[0]
+
+        return content
+
+    def reserved_region(self):
+        """
+        :return: Boot sector, FSInfo sector and their backups, up to the first FAT
+        """
+        sector_size = self.layout.sector_size
+        region = bytearray(self.layout.reserved_sectors * sector_size)
+
+        boot_sector = self.boot_sector()
+        fs_info = self.fs_info_sector()
+        for sector, data in ((0, boot_sector), (1, fs_info), (6, boot_sector), (7, fs_info)):
+            region[sector * sector_size:sector * sector_size + len(data)] = data
+
+        return bytes(region)
+
+    def boot_sector(self):
+        layout = self.layout
+        sector = bytearray(512)
+        sector[0:3] = b"\xeb\x58\x90"
+        sector[3:11] = b"MSWIN4.1"
+        struct.pack_into("<HBHBHHBHHHII", sector, 11,
+                         layout.sector_size, layout.sectors_per_cluster, layout.reserved_sectors, _NUMBER_OF_FATS,
+                         0, 0, _MEDIA_DESCRIPTOR, 0, 63, 255, layout.hidden_sectors, layout.total_sectors)
+        struct.pack_into("<IHHIHH", sector, 36, layout.fat_sectors, 0, 0, _ROOT_CLUSTER, 1, 6)
+        struct.pack_into("<BBBI", sector, 64, 0x80, 0, 0x29, _volume_id(self.timestamp))
+        sector[71:82] = self.label
+        sector[82:90] = b"FAT32   "
+        sector[90:90 + len(_BOOT_CODE)] = _BOOT_CODE
+        sector[510:512] = b"\x55\xaa"
+        return bytes(sector)
+
+    def fs_info_sector(self):
+        sector = bytearray(512)
+        struct.pack_into("<I", sector, 0, 0x41615252)
+        struct.pack_into("<IIII", sector, 484, 0x61417272, self.layout.cluster_count - self.used_clusters,
+                         self.__next_cluster, 0)
+        struct.pack_into("<I", sector, 508, 0xAA550000)
+        return bytes(sector)
+
+    def fat(self):
+        """
+        :return: The used part of the FAT, every entry is chained to the next cluster but the last of every entry
+        """
+        fat = array.array("I", (0x0FFFFF00 | _MEDIA_DESCRIPTOR, _END_OF_CHAIN))
+        fat.extend(range(_ROOT_CLUSTER + 1, self.__next_cluster + 1))
+        for entry in self.__entries:
+            fat[entry.first_cluster + entry.cluster_count - 1] = _END_OF_CHAIN
+
+        if sys.byteorder != "little":
+            fat.byteswap()
+        return fat.tobytes()
+
+    def directory(self, directory):
+        """
+        :param directory: Directory entry of the volume
+        :return: Content of the directory, padded with free entries to its clusters
+        """
+        data = bytearray()
+        if directory is self.root:
+            data += self.__directory_entry(self.label, _ATTRIBUTE_VOLUME_ID, 0, 0, 0)
+        else:
+            parent_cluster = 0 if directory.parent is self.root else directory.parent.first_cluster
+            data += self.__directory_entry(b".          ", _ATTRIBUTE_DIRECTORY, 0, directory.first_cluster, 0)
+            data += self.__directory_entry(b"..         ", _ATTRIBUTE_DIRECTORY, 0, parent_cluster, 0)
+
+        for entry in directory.children:
+            if entry.long_name:
+                data += _long_name_entries(entry.name, entry.short_name)
+            data += self.__directory_entry(entry.short_name,
+                                           _ATTRIBUTE_DIRECTORY if entry.is_directory else _ATTRIBUTE_ARCHIVE,
+                                           entry.case, entry.first_cluster,
+                                           0 if entry.is_directory else entry.size)
+
+        return bytes(data)
+
+    def __directory_entry(self, short_name, attributes, case, first_cluster, size):
+        date, time_of_day = self.timestamp
+        return struct.pack("<11sBBBHHHHHHHI", short_name, attributes, case, 0, time_of_day, date, date,
+                           first_cluster >> 16, time_of_day, date, first_cluster & 0xFFFF, size)
+
+
+class _SequentialWriter:
+    """
+    Coalesces small writes into buffer_size writes, large writes go through untouched
+    """
+
+    def __init__(self, fd, buffer_size):
+        self.fd = fd
+        self.buffer_size = buffer_size
+        self.offset = 0
+        self.__buffer = bytearray()
+
+    def write(self, data):
+        self.offset += len(data)
+        if not self.__buffer and len(data) >= self.buffer_size:
+            _write(self.fd, data)
+            return
+
+        self.__buffer += data
+        if len(self.__buffer) >= self.buffer_size:
+            self.flush()
+
+    def pad(self, multiple):
+        """
+        Write zeros up to the next multiple of multiple bytes
+        """
+        self.zero_fill(-self.offset % multiple)
+
+    def zero_fill(self, length):
+        while length > 0:
+            step = min(length, self.buffer_size)
+            self.write(bytes(step))
+            length -= step
+
+    def flush(self):
+        if self.__buffer:
+            _write(self.fd, self.__buffer)
+            self.__buffer = bytearray()
+
+
+def _read_ahead(chunks, depth):
+    """
+    Iterate chunks in a separate thread, at most depth chunks ahead of the consumer
+
+    Reading the source (a mapped disc image or a file) then overlaps with writing to the device.
+    """
+    pending = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    error = []
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                pending.put(chunk)
+        except BaseException as e:
+            error.append(e)
+        finally:
+            chunks.close()
+            pending.put((_END_OF_DATA, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    finished = False
+    try:
+        while True:
+            chunk = pending.get()
+            if chunk[1] is None:
+                finished = True
+                break
+            yield chunk
+
+        if error:
+            raise error[0]
+    finally:
+        if not finished:
+            # Unblock the producer and wait for it to notice
+            stop.set()
+            while pending.get()[1] is not None:
+                pass
+        thread.join()
+
+
+def _short_name(name, taken):
+    """
+    :param name: Name of the file
+    :param taken: Short names already used in the same directory
+    :return: (11 byte short name, NT case flags, whether long name entries are needed)
+    """
+    base, dot, extension = name.rpartition(".")
+    if not dot or not base:
+        base, extension = name, ""
+
+    if _is_short_name_part(base, 8) and _is_short_name_part(extension, 3) and (extension or not dot):
+        case = 0
+        if base.islower():
+            case |= _CASE_LOWER_BASE
+        if extension.islower():
+            case |= _CASE_LOWER_EXTENSION
+        short_name = (base.upper().ljust(8) + extension.upper().ljust(3)).encode("ascii")
+        if short_name not in taken:
+            return short_name, case, False
+
+    # Numeric tail, like Windows: FILENA~1.EXT
+    base = _short_name_characters(base) or "_"
+    extension = _short_name_characters(extension)[:3]
+    for number in range(1, 1000000):
+        tail = f"~{number}"
+        short_name = (base[:8 - len(tail)] + tail).ljust(8) + extension.ljust(3)
+        short_name = short_name.encode("ascii")
+        if short_name not in taken:
+            return short_name, 0, True
+
+    raise Fat32Error(f"No short name left for {name}")
+
+
+def _is_short_name_part(text, length):
+    if len(text) > length or not text.isascii():
+        return False
+    if any(character in _SHORT_NAME_INVALID or ord(character) < 0x20 for character in text):
+        return False
+    return not (text != text.upper() and text != text.lower())
+
+
+def _short_name_characters(text):
+    return "".join("_" if not character.isascii() or character in _SHORT_NAME_INVALID or ord(character) < 0x20
+                   else character.upper()
+                   for character in text if character not in ". ")
+
+
+def _long_name_entries(name, short_name):
+    """
+    :return: Long name entries preceding the short name entry, last part of the name first
+    """
+    encoded = name.encode("utf-16-le")
+    if len(encoded) > 255 * 2:
+        raise Fat32Error(f"File name is too long: {name}")
+
+    characters = _LONG_NAME_CHARACTERS * 2
+    encoded += b"\0\0"
+    encoded += b"\xff" * (-len(encoded) % characters)
+    count = len(encoded) // characters
+
+    checksum = 0
+    for byte in short_name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+
+    entries = bytearray()
+    for number in range(count, 0, -1):
+        part = encoded[(number - 1) * characters:number * characters]
+        order = number | (0x40 if number == count else 0)
+        entries += struct.pack("<B10sBBB12sH4s", order, part[0:10], _ATTRIBUTE_LONG_NAME, 0, checksum,
+                               part[10:22], 0, part[22:26])
+    return entries
+
+
+def _directory_entry_count(directory):
+    # Volume label in the root, "." and ".." everywhere else
+    count = 1 if directory.parent is None else 2
+    for entry in directory.children:
+        count += 1
+        if entry.long_name:
+            count += -(-(len(entry.name.encode("utf-16-le")) // 2 + 1) // _LONG_NAME_CHARACTERS)
+    return count
+
+
+def _volume_label(label):
+    label = "".join("_" if not character.isascii() or character in '"*+,./:;<=>?[\\]|' else character
+                    for character in label.upper())
+    return label[:11].ljust(11).encode("ascii")
+
+
+def _dos_timestamp(local_time):
+    """
+    :return: (date, time) in the FAT directory entry encoding
+    """
+    date = ((max(local_time.tm_year, 1980) - 1980) << 9) | (local_time.tm_mon << 5) | local_time.tm_mday
+    time_of_day = (local_time.tm_hour << 11) | (local_time.tm_min << 5) | (local_time.tm_sec // 2)
+    return date, time_of_day
+
+
+def _volume_id(timestamp):
+    date, time_of_day = timestamp
+    return (date << 16) | time_of_day
+
+
+def default_cluster_size(volume_size):
+    """
+    :param volume_size: Size of the partition in bytes
+    :return: Cluster size Windows picks for a FAT32 volume of that size
+    """
+    gib = 1024 ** 3
+    if volume_size <= 8 * gib:
+        return 4 * 1024
+    if volume_size <= 16 * gib:
+        return 8 * 1024
+    if volume_size <= 32 * gib:
+        return 16 * 1024
+    return 32 * 1024
+
+
+def write_volume(fd, source_manifest, label, partition_offset=0, split_wim=False, buffer_size=4 * 1024 * 1024,
+                 should_stop=None, on_progress=None):
+    """
+    Lay out a FAT32 volume holding the source and write it to the partition
+
+    :param fd: File descriptor of the partition opened for writing
+    :param source_manifest: manifest.SourceManifest of the source
+    :param label: Volume label
+    :param partition_offset: Offset of the partition on its device in bytes
+    :param split_wim: Write an install.wim too large for FAT32 as .swm parts
+    :param buffer_size: Size in bytes of a single read/write
+    :param should_stop: Callable polled between chunks, the write is abandoned when it returns True
+    :param on_progress: Callable taking the number of source bytes just written
+    :return: False if the write was cancelled through should_stop
+    """
+    layout = Fat32Layout.for_device(fd, partition_offset)
+    volume = Fat32Volume(source_manifest, layout, label, split_wim, buffer_size)
+    try:
+        volume.write(fd, should_stop, on_progress)
+    finally:
+        volume.close()
+    return not volume.cancelled
+
+
+def _write(fd, data):
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
@@ -2,11 +2,11 @@
 
 import os
 import threading
-import time
 import wx
 import wx.adv
-from WoeUSB.core import init, main, cleanup
-from WoeUSB.list_devices import usb_drive, dvd_drive
+import wx.lib.newevent
+from WoeUSB import core, events
+from WoeUSB.list_devices import DeviceInventory, is_target_candidate
 
 data_directory = os.path.join(os.path.dirname(__file__), "data")
 
@@ -14,6 +14,15 @@ app = wx.App()
 
 _ = wx.GetTranslation
 
+#: Posted by WoeUSB_handler whenever its state or progress changes
+ProgressEvent, EVT_WOEUSB_PROGRESS = wx.lib.newevent.NewEvent()
+
+#: Posted by WoeUSB_handler once the job is over, successfully or not
+FinishedEvent, EVT_WOEUSB_FINISHED = wx.lib.newevent.NewEvent()
+
+#: Posted by the device inventory when block devices are plugged, unplugged or changed
+DevicesChangedEvent, EVT_DEVICES_CHANGED = wx.lib.newevent.NewEvent()
+
 class MainFrame(wx.Frame):
     def __init__(self, title, pos, size, style=wx.DEFAULT_FRAME_STYLE):
         super().__init__(None, title=title, pos=pos, size=size, style=style)
@@ -23,6 +32,8 @@ class MainFrame(wx.Frame):
 
         self.SetMenuBar(self.create_menu_bar())
 
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
     def create_menu_bar(self):
         file_menu = wx.Menu()
         self.__menuItemShowAll = file_menu.AppendCheckItem(wx.ID_ANY, _("Show all drives") + " \tCtrl+A",
@@ -48,15 +59,23 @@ class MainFrame(wx.Frame):
 
         self.Bind(wx.EVT_MENU, self.on_quit, exit_item)
         self.Bind(wx.EVT_MENU, self.on_about, help_item)
+        self.Bind(wx.EVT_MENU, self.on_show_all, self.__menuItemShowAll)
 
         return menu_bar
 
     def on_quit(self, event):
         self.Close(True)
 
+    def on_close(self, event):
+        self.__MainPanel.stop_device_inventory()
+        event.Skip()
+
     def on_about(self, event):
         DialogAbout(self).ShowModal()
 
+    def on_show_all(self, event):
+        self.__MainPanel.refresh_list_content()
+
     def is_show_all_checked(self):
         return self.__menuItemShowAll.IsChecked()
 
@@ -120,6 +139,16 @@ class MainPanel(wx.Panel):
         self.Bind(wx.EVT_RADIOBUTTON, self.on_source_option_changed, self.__isoChoice)
         self.Bind(wx.EVT_RADIOBUTTON, self.on_source_option_changed, self.__dvdChoice)
 
+        self.__woe = None
+        self.__progress_dialog = None
+
+        # Devices are read once, then kept up to date from hotplug events instead of being listed again
+        self.__inventory = DeviceInventory(
+            on_change=lambda added, removed, changed: wx.PostEvent(
+                self, DevicesChangedEvent(added=added, removed=removed, changed=changed)))
+        self.Bind(EVT_DEVICES_CHANGED, self.on_devices_changed)
+        self.__inventory.start()
+
         self.refresh_list_content()
         self.on_source_option_changed(wx.CommandEvent)
         self.__btInstall.Enable(self.is_install_ok())
@@ -129,20 +158,53 @@ class MainPanel(wx.Panel):
 
         show_all_checked = self.__parent.is_show_all_checked()
 
-        device_list = usb_drive(show_all_checked)
-
-        for device in device_list:
-            self.__usbStickList.Append(device[1])
+        # Each entry carries its device path, the selection never has to be matched against a new list
+        for device in self.__inventory.usb_drives(show_all_checked):
+            self.__usbStickList.Append(device.description, device.path)
 
         self.__dvdDriveList.Clear()
 
-        drive_list = dvd_drive()
+        for drive in self.__inventory.dvd_drives():
+            self.__dvdDriveList.Append(drive.description, drive.path)
+
+        self.__btInstall.Enable(self.is_install_ok())
+
+    def on_devices_changed(self, event):
+        show_all_checked = self.__parent.is_show_all_checked()
 
-        for drive in drive_list:
-            self.__dvdDriveList.Append(drive[1])
+        for device in event.removed:
+            for device_list in (self.__usbStickList, self.__dvdDriveList):
+                index = self.__find_device(device_list, device.path)
+                if index != wx.NOT_FOUND:
+                    device_list.Delete(index)
+
+        for device in event.added + event.changed:
+            if device.is_optical:
+                device_list, visible = self.__dvdDriveList, True
+            else:
+                device_list, visible = self.__usbStickList, is_target_candidate(device, show_all_checked)
+
+            index = self.__find_device(device_list, device.path)
+            if index == wx.NOT_FOUND:
+                if visible:
+                    device_list.Append(device.description, device.path)
+            elif visible:
+                device_list.SetString(index, device.description)
+            else:
+                device_list.Delete(index)
 
         self.__btInstall.Enable(self.is_install_ok())
 
+    @staticmethod
+    def __find_device(device_list, path):
+        for index in range(device_list.GetCount()):
+            if device_list.GetClientData(index) == path:
+                return index
+        return wx.NOT_FOUND
+
+    def stop_device_inventory(self):
+        self.__inventory.stop()
+
     def on_source_option_changed(self, event):
         is_iso = self.__isoChoice.GetValue()
 
@@ -167,47 +229,63 @@ class MainPanel(wx.Panel):
         if self.is_install_ok():
             is_iso = self.__isoChoice.GetValue()
 
-            device = usb_drive()[self.__usbStickList.GetSelection()][0]
+            device = self.__usbStickList.GetClientData(self.__usbStickList.GetSelection())
 
             if is_iso:
                 iso = self.__isoFile.GetPath()
             else:
-                iso = dvd_drive()[self.__dvdDriveList.GetSelection()][0]
+                iso = self.__dvdDriveList.GetClientData(self.__dvdDriveList.GetSelection())
 
             filesystem = "NTFS" if self.__parent.options_filesystem.IsChecked() else "FAT"
 
             boot_flag = self.__parent.options_boot.IsChecked()
             skip_grub = self.__parent.options_skip_grub.IsChecked()
 
-            woe = WoeUSB_handler(iso, device, boot_flag, filesystem, skip_grub)
-            woe.start()
-
-            dialog = wx.ProgressDialog(_("Installing"), _("Please wait..."), 101, self.GetParent(),
-                                       wx.PD_APP_MODAL | wx.PD_SMOOTH | wx.PD_CAN_ABORT)
-
-            while woe.is_alive():
-                if not woe.progress:
-                    status = dialog.Pulse(woe.state)[0]
-                    time.sleep(0.06)
-                else:
-                    status = dialog.Update(woe.progress, woe.state)[0]
-
-                if not status:
-                    if wx.MessageBox(_("Are you sure you want to cancel the installation?"), _("Cancel"),
-                                     wx.YES_NO | wx.ICON_QUESTION, self) == wx.NO:
-                        dialog.Resume()
-                    else:
-                        woe.kill = True
-                        break
-            dialog.Destroy()
-
-            if woe.error == "":
-                wx.MessageBox(_("Installation succeeded!"), _("Installation"), wx.OK | wx.ICON_INFORMATION, self)
+            self.__woe = WoeUSB_handler(iso, device, boot_flag, filesystem, skip_grub, notify_window=self)
+
+            self.__progress_dialog = wx.ProgressDialog(_("Installing"), _("Please wait..."), 101, self.GetParent(),
+                                                       wx.PD_APP_MODAL | wx.PD_SMOOTH | wx.PD_CAN_ABORT)
+
+            # The handler wakes the GUI up through events, the main loop stays idle in between
+            self.Bind(EVT_WOEUSB_PROGRESS, self.on_woeusb_progress)
+            self.Bind(EVT_WOEUSB_FINISHED, self.on_woeusb_finished)
+
+            self.__woe.start()
+
+    def on_woeusb_progress(self, event):
+        if self.__progress_dialog is None:
+            return
+
+        if not event.progress:
+            status = self.__progress_dialog.Pulse(event.state)[0]
+        else:
+            status = self.__progress_dialog.Update(event.progress, event.state)[0]
+
+        if not status and not self.__woe.job.cancelled:
+            if wx.MessageBox(_("Are you sure you want to cancel the installation?"), _("Cancel"),
+                             wx.YES_NO | wx.ICON_QUESTION, self) == wx.NO:
+                self.__progress_dialog.Resume()
             else:
-                wx.MessageBox(_("Installation failed!") + "\n" + str(woe.error), _("Installation"),
-                              wx.OK | wx.ICON_ERROR, self)
+                self.__woe.job.cancel()
+
+    def on_woeusb_finished(self, event):
+        self.Unbind(EVT_WOEUSB_PROGRESS)
+        self.Unbind(EVT_WOEUSB_FINISHED)
+
+        self.__progress_dialog.Destroy()
+        self.__progress_dialog = None
+
+        woe = self.__woe
+        woe.join()
+
+        if woe.error == "":
+            wx.MessageBox(_("Installation succeeded!"), _("Installation"), wx.OK | wx.ICON_INFORMATION, self)
+        else:
+            wx.MessageBox(_("Installation failed!") + "\n" + str(woe.error), _("Installation"),
+                          wx.OK | wx.ICON_ERROR, self)
 
     def on_refresh(self, event):
+        self.__inventory.rescan()
         self.refresh_list_content()
 
 class DialogAbout(wx.Dialog):
@@ -300,29 +378,70 @@ class PanelNoteBookAutors(wx.Panel):
         self.SetSizer(sizer_note_book_autors)
 
 class WoeUSB_handler(threading.Thread):
-    def __init__(self, source, target, boot_flag, filesystem, skip_grub=False):
+    """
+    Runs a core.Job in its own thread, state and progress changes are posted to notify_window as wx events
+    """
+
+    #: Most progress dialog updates per second, whatever the engine publishes
+    MAX_UPDATE_RATE = 10
+
+    def __init__(self, source, target, boot_flag, filesystem, skip_grub=False, notify_window=None):
         super().__init__()
 
+        self.notify_window = notify_window
+
         self.progress = False
         self.state = ""
         self.error = ""
-        self.kill = False
 
-        init(from_cli=False, install_mode="device", source_media=source, target_media=target)
-        self.source = source
-        self.target = target
-        self.boot_flag = boot_flag
-        self.filesystem = filesystem
-        self.skip_grub = skip_grub
+        self.job = core.Job(source, target, "device", filesystem, workaround_bios_boot_flag=boot_flag,
+                            skip_legacy_bootloader=skip_grub)
+
+    def on_event(self, event):
+        """
+        Subscriber of the event bus, called from its delivery thread
+        """
+        if event.job != self.job.id:
+            return
+
+        if isinstance(event, events.PhaseChanged):
+            if event.phase != "start-copying":
+                return
+            self.state = _("Info: Writing in progress, do not remove the media until the process is complete.")
+        elif isinstance(event, events.Progress):
+            self.progress = int(event.report.percent)
+            self.state = _("Copying files: {0}%").format(self.progress)
+        elif isinstance(event, events.Message):
+            self.state = event.text
+            if event.level == "error" and self.error == "":
+                self.error = event.text
+        else:
+            return
+
+        if self.notify_window is not None:
+            wx.PostEvent(self.notify_window, ProgressEvent(progress=self.progress, state=self.state))
 
     def run(self):
-        source_fs_mountpoint, target_fs_mountpoint, temp_directory, target_media = init(from_cli=False, install_mode="device", source_media=self.source, target_media=self.target)
-        try:
-            main(source_fs_mountpoint, target_fs_mountpoint, self.source, self.target, "device", temp_directory, self.filesystem, self.boot_flag, None, self.skip_grub)
-        except SystemExit:
-            pass
+        # Messages and progress of the job come from the event bus
+        subscriber = events.bus.subscribe(self.on_event, max_rate=self.MAX_UPDATE_RATE)
 
-        cleanup(source_fs_mountpoint, target_fs_mountpoint, temp_directory, target_media)
+        result = 1
+        try:
+            result = self.job.run()
+        except Exception as e:
+            # e.g. a missing runtime dependency, the dialog must still be told the job is over
+            self.error = str(e)
+        finally:
+            self.job.cleanup()
+
+            # Everything published by the job is shown before it is reported as finished
+            events.bus.unsubscribe(subscriber)
+            if result != 0 and self.error == "":
+                self.error = _("Installation was cancelled.") if self.job.cancelled \
+                    else _("An error occurred, see the log.")
+
+            if self.notify_window is not None:
+                wx.PostEvent(self.notify_window, FinishedEvent())
 
 def run():
     frameTitle = "WoeUSB-ng"
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+
+"""
+In-process reader for ISO9660 and UDF disc images
+
+Windows installation media are UDF-bridged: the ISO9660 side only carries a README, the real tree lives in
+the UDF filesystem. The image is memory-mapped and file content is served as memoryview slices of the mapping,
+so nothing is copied in userspace and no loop device, mountpoint or root privilege is needed to read it.
+Several jobs may read the same image at the same time.
+"""
+
+import mmap
+import os
+import struct
+
+SECTOR_SIZE = 2048
+
+#: Extent types stored in the two most significant bits of an UDF extent length
+_EXTENT_RECORDED = 0
+_EXTENT_NEXT = 3
+
+_ZEROS = bytes(1024 * 1024)
+
+
+class ImageError(RuntimeError):
+    """
+    Raised when the image is not an ISO9660/UDF image this reader understands
+    """
+
+
+class ImageFile:
+    """
+    A regular file inside a disc image
+    """
+    __slots__ = ("name", "size", "extents", "image")
+
+    def __init__(self, name, size, extents, image):
+        """
+        :param name: File name
+        :param size: Size in bytes
+        :param extents: List of [offset, length] in bytes from the start of the image, offset None for a sparse extent
+        :param image: DiscImage the file belongs to
+        """
+        self.name = name
+        self.size = size
+        self.extents = extents
+        self.image = image
+
+    def chunks(self, chunk_size, start=0, end=None):
+        """
+        Iterate over the file content
+
+        :param chunk_size: Maximum size of a single chunk
+        :param start: Offset in the file to start from
+        :param end: Offset in the file to stop at, the end of the file when None
+        :return: Generator of memoryview slices of the image mapping, release them once written
+        """
+        if end is None:
+            end = self.size
+
+        extent_end = 0
+        for offset, length in self.extents:
+            extent_start, extent_end = extent_end, extent_end + length
+            if extent_end <= start:
+                continue
+            if extent_start >= end:
+                break
+
+            # Clip the extent to [start, end)
+            skip = max(start - extent_start, 0)
+            length = min(extent_end, end) - extent_start - skip
+            if offset is not None:
+                offset += skip
+
+            while length > 0:
+                size = min(length, chunk_size)
+                if offset is None:
+                    size = min(size, len(_ZEROS))
+                    yield memoryview(_ZEROS)[:size]
+                else:
+                    yield self.image.view(offset, size)
+                    offset += size
+                length -= size
+
+
+class DiscImage:
+    """
+    A memory-mapped ISO9660 or UDF disc image, or an optical disc block device
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path to the disc image or optical disc block device
+        """
+        self.path = path
+        self.filesystem = None
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+            if size < 17 * SECTOR_SIZE:
+                raise ImageError(f"{path} is too small to be a disc image")
+            self.__map = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+        self.__map.madvise(mmap.MADV_SEQUENTIAL)
+        self.__view = memoryview(self.__map)
+
+        self.__root = None
+        try:
+            if self.__has_udf():
+                self.filesystem = "UDF"
+                self.__root = self.__udf_root()
+            else:
+                self.filesystem = "ISO9660"
+                self.__root = self.__iso9660_root()
+        except (struct.error, IndexError, ValueError) as e:
+            self.close()
+            raise ImageError(f"{path}: malformed {self.filesystem} filesystem: {e}")
+        except ImageError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.__view.release()
+        self.__map.close()
+
+    def view(self, offset, length):
+        """
+        :return: Zero-copy memoryview of length bytes at offset
+        """
+        if offset + length > len(self.__map):
+            raise ImageError(f"{self.path}: extent beyond the end of the image")
+        return self.__view[offset:offset + length]
+
+    def walk(self):
+        """
+        Walk the image tree top-down, like os.walk
+
+        :return: Generator of (dirpath, dirnames, files), dirpath relative to the image root ("" for the root)
+            and files a list of ImageFile
+        """
+        pending = [("", self.__root)]
+        while pending:
+            dirpath, directory = pending.pop()
+            dirnames = []
+            files = []
+            subdirectories = []
+
+            for name, is_directory, entry in self.__list_directory(directory):
+                if is_directory:
+                    dirnames.append(name)
+                    subdirectories.append((os.path.join(dirpath, name), entry))
+                else:
+                    files.append(entry)
+
+            yield dirpath, dirnames, files
+
+            pending.extend(reversed(subdirectories))
+
+    def __list_directory(self, directory):
+        if self.filesystem == "UDF":
+            return self.__udf_list_directory(directory)
+        return self.__iso9660_list_directory(directory)
+
+    def __read_extents(self, extents, size):
+        data = bytearray()
+        for offset, length in extents:
+            data += bytes(length) if offset is None else self.__map[offset:offset + length]
+        return bytes(data[:size])
+
+    # ISO9660 (ECMA-119), with Joliet names when available
+
+    def __iso9660_root(self):
+        primary = None
+        joliet = None
+
+        sector = 16
+        while True:
+            descriptor = self.__map[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+            if descriptor[1:6] != b"CD001":
+                break
+            if descriptor[0] == 1 and primary is None:
+                primary = descriptor
+            elif descriptor[0] == 2 and descriptor[88:90] == b"%/" and descriptor[90:91] in (b"@", b"C", b"E"):
+                joliet = descriptor
+            elif descriptor[0] == 255:
+                break
+            sector += 1
+
+        if primary is None:
+            raise ImageError(f"{self.path} is neither an ISO9660 nor an UDF image")
+
+        descriptor = joliet or primary
+        self.__joliet = joliet is not None
+        self.__block_size = struct.unpack_from("<H", descriptor, 128)[0]
+
+        root = descriptor[156:156 + 34]
+        return [[struct.unpack_from("<I", root, 2)[0] * self.__block_size, struct.unpack_from("<I", root, 10)[0]]]
+
+    def __iso9660_list_directory(self, extents):
+        data = self.__read_extents(extents, sum(length for __, length in extents))
+        pending_extents = {}
+
+        position = 0
+        while position < len(data):
+            length = data[position]
+            if length == 0:
+                # Records never cross a sector boundary, the rest of the sector is padding
+                position = (position // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+
+            record = data[position:position + length]
+            position += length
+
+            name_length = record[32]
+            raw_name = record[33:33 + name_length]
+            if raw_name in (b"\x00", b"\x01"):
+                continue
+
+            if self.__joliet:
+                name = raw_name.decode("utf-16-be")
+            else:
+                name = raw_name.decode("ascii", "replace")
+            name = name.split(";")[0]
+            if not self.__joliet:
+                name = name.rstrip(".")
+
+            flags = record[25]
+            extent = [struct.unpack_from("<I", record, 2)[0] * self.__block_size, struct.unpack_from("<I", record, 10)[0]]
+
+            if flags & 0x02:
+                yield name, True, [extent]
+                continue
+
+            file_extents = pending_extents.pop(name, []) + [extent]
+            if flags & 0x80:
+                # Multi-extent file, more records of the same name follow
+                pending_extents[name] = file_extents
+                continue
+
+            yield name, False, ImageFile(name, sum(extent[1] for extent in file_extents), file_extents, self)
+
+    # UDF (ECMA-167 / OSTA UDF)
+
+    def __has_udf(self):
+        sector = 16
+        while sector < 64:
+            identifier = self.__map[sector * SECTOR_SIZE + 1:sector * SECTOR_SIZE + 6]
+            if identifier in (b"NSR02", b"NSR03"):
+                return True
+            if identifier not in (b"BEA01", b"CD001", b"BOOT2", b"CDW02", b"TEA01"):
+                return False
+            sector += 1
+        return False
+
+    def __udf_descriptor(self, sector, expected_tag=None):
+        offset = sector * SECTOR_SIZE
+        tag = struct.unpack_from("<H", self.__map, offset)[0]
+        if expected_tag is not None and tag != expected_tag:
+            raise ImageError(f"{self.path}: expected UDF descriptor {expected_tag} at sector {sector}, found {tag}")
+        return tag, offset
+
+    def __udf_root(self):
+        __, anchor = self.__udf_descriptor(256, 2)
+        sequence_length, sequence_location = struct.unpack_from("<II", self.__map, anchor + 16)
+
+        partitions = {}
+        logical_volume = None
+        for sector in range(sequence_location, sequence_location + sequence_length // SECTOR_SIZE):
+            tag, offset = self.__udf_descriptor(sector)
+            if tag == 5:
+                number = struct.unpack_from("<H", self.__map, offset + 22)[0]
+                partitions[number] = struct.unpack_from("<I", self.__map, offset + 188)[0]
+            elif tag == 6 and logical_volume is None:
+                logical_volume = offset
+            elif tag == 8:
+                break
+
+        if logical_volume is None or not partitions:
+            raise ImageError(f"{self.path}: UDF volume descriptor sequence is incomplete")
+
+        self.__block_size = struct.unpack_from("<I", self.__map, logical_volume + 212)[0]
+        if self.__block_size != SECTOR_SIZE:
+            raise ImageError(f"{self.path}: unsupported UDF logical block size {self.__block_size}")
+
+        # Partition reference numbers index the partition maps, map them to partition start sectors
+        self.__partition_starts = []
+        map_count = struct.unpack_from("<I", self.__map, logical_volume + 268)[0]
+        position = logical_volume + 440
+        for __ in range(map_count):
+            map_type, map_length = self.__map[position], self.__map[position + 1]
+            if map_type != 1:
+                raise ImageError(f"{self.path}: UDF partition map type {map_type} is not supported")
+            self.__partition_starts.append(partitions[struct.unpack_from("<H", self.__map, position + 4)[0]])
+            position += map_length
+
+        file_set = self.__udf_block_offset(*self.__udf_long_ad(logical_volume + 248)[1:])
+        if struct.unpack_from("<H", self.__map, file_set)[0] != 256:
+            raise ImageError(f"{self.path}: UDF file set descriptor not found")
+
+        return self.__udf_file_entry(self.__udf_long_ad(file_set + 400))
+
+    def __udf_long_ad(self, offset):
+        length, block, partition = struct.unpack_from("<IIH", self.__map, offset)
+        return length, block, partition
+
+    def __udf_block_offset(self, block, partition):
+        return (self.__partition_starts[partition] + block) * self.__block_size
+
+    def __udf_file_entry(self, icb):
+        """
+        :return: [is_directory, size, extents]
+        """
+        __, block, partition = icb
+        offset = self.__udf_block_offset(block, partition)
+        tag = struct.unpack_from("<H", self.__map, offset)[0]
+
+        if tag == 261:
+            extended_attributes_length, descriptors_length = struct.unpack_from("<II", self.__map, offset + 168)
+            descriptors = offset + 176 + extended_attributes_length
+        elif tag == 266:
+            extended_attributes_length, descriptors_length = struct.unpack_from("<II", self.__map, offset + 208)
+            descriptors = offset + 216 + extended_attributes_length
+        else:
+            raise ImageError(f"{self.path}: expected UDF file entry at block {block}, found descriptor {tag}")
+
+        file_type = self.__map[offset + 27]
+        descriptor_type = struct.unpack_from("<H", self.__map, offset + 34)[0] & 0x07
+        size = struct.unpack_from("<Q", self.__map, offset + 56)[0]
+
+        if descriptor_type == 3:
+            # Data embedded in the file entry itself
+            extents = [[descriptors, size]]
+        else:
+            extents = self.__udf_extents(descriptors, descriptors_length, descriptor_type, partition, size)
+
+        return [file_type == 4, size, extents]
+
+    def __udf_extents(self, position, descriptors_length, descriptor_type, partition, size):
+        extents = []
+        remaining = size
+        end = position + descriptors_length
+
+        while position < end and remaining > 0:
+            if descriptor_type == 0:
+                raw_length, block = struct.unpack_from("<II", self.__map, position)
+                extent_partition = partition
+                position += 8
+            elif descriptor_type == 1:
+                raw_length, block, extent_partition = self.__udf_long_ad(position)
+                position += 16
+            else:
+                raise ImageError(f"{self.path}: UDF allocation descriptor type {descriptor_type} is not supported")
+
+            extent_type = raw_length >> 30
+            length = raw_length & 0x3FFFFFFF
+            if length == 0:
+                break
+
+            if extent_type == _EXTENT_NEXT:
+                # Continuation in an allocation extent descriptor
+                position = self.__udf_block_offset(block, extent_partition)
+                descriptors_length = struct.unpack_from("<I", self.__map, position + 20)[0]
+                position += 24
+                end = position + descriptors_length
+                continue
+
+            length = min(length, remaining)
+            if extent_type == _EXTENT_RECORDED:
+                extents.append([self.__udf_block_offset(block, extent_partition), length])
+            else:
+                extents.append([None, length])
+            remaining -= length
+
+        return extents
+
+    def __udf_list_directory(self, directory):
+        __, size, extents = directory
+        data = self.__read_extents(extents, size)
+
+        position = 0
+        while position + 38 <= len(data):
+            tag = struct.unpack_from("<H", data, position)[0]
+            if tag != 257:
+                raise ImageError(f"{self.path}: malformed UDF directory")
+
+            characteristics = data[position + 18]
+            identifier_length = data[position + 19]
+            icb = struct.unpack_from("<IIH", data, position + 20)
+            implementation_use_length = struct.unpack_from("<H", data, position + 36)[0]
+            identifier = data[position + 38 + implementation_use_length:
+                              position + 38 + implementation_use_length + identifier_length]
+            position += (38 + implementation_use_length + identifier_length + 3) & ~3
+
+            # Skip the parent directory and deleted entries
+            if characteristics & 0x08 or characteristics & 0x04:
+                continue
+
+            name = _decode_udf_name(identifier)
+            is_directory, file_size, file_extents = self.__udf_file_entry(icb)
+            if is_directory:
+                yield name, True, [is_directory, file_size, file_extents]
+            else:
+                yield name, False, ImageFile(name, file_size, file_extents, self)
+
+
+def _decode_udf_name(identifier):
+    """
+    Decode an OSTA CS0 compressed unicode file identifier
+    """
+    if not identifier:
+        return ""
+    if identifier[0] == 16:
+        return identifier[1:].decode("utf-16-be")
+    return identifier[1:].decode("latin-1")
+
+
+def open_image(path):
+    """
+    Open path as a disc image if this reader understands it
+
+    :param path: Path to the disc image or optical disc block device
+    :return: DiscImage, or None if path can't be read in-process and must be mounted instead
+    """
+    try:
+        return DiscImage(path)
+    except (ImageError, OSError, ValueError):
+        return None
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Job journal for --resume
+
+Every file the copy engine completes is appended to a small journal at the root of the target filesystem,
+with its size and the hash computed while it was written. The journal lives on the target rather than in
+the temporary directory because it must outlive the process: after an unplug or a crash, --resume reads it,
+checks the files it lists against the device and only copies what is missing or wrong.
+
+The journal is never trusted alone. A line may reach the device before the file data it describes,
+so every journaled file is read back and hashed before it is skipped.
+The journal is removed once the job completes.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from WoeUSB import progress, wim
+
+#: Name of the journal at the root of the target filesystem
+JOURNAL_NAME = ".woeusb-journal"
+
+_VERSION = 1
+
+
+class JournalError(RuntimeError):
+    """
+    Raised when there is no journal to resume from, or when it belongs to another job
+    """
+
+
+class Journal:
+    """
+    Append-only record of the files completely written to the target
+    """
+
+    def __init__(self, directory, header, records=None):
+        """
+        :param directory: Where the target filesystem is mounted
+        :param header: Description of the job, see job_header()
+        :param records: Dictionary of relative target path to (size, hex digest) already in the journal
+        """
+        self.directory = directory
+        self.header = header
+        self.records = records if records is not None else {}
+
+        self.__lock = threading.Lock()
+        self.__fd = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, JOURNAL_NAME)
+
+    @classmethod
+    def create(cls, directory, header):
+        """
+        Start a new journal, replacing any previous one
+
+        :param directory: Where the target filesystem is mounted
+        :param header: Description of the job, see job_header()
+        :return: Journal open for appending
+        """
+        journal = cls(directory, header)
+        journal.__fd = os.open(journal.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        journal.__append(dict(header, event="job"))
+        return journal
+
+    @classmethod
+    def load(cls, directory, header):
+        """
+        Reopen the journal of an interrupted job
+
+        :param directory: Where the target filesystem is mounted
+        :param header: Description of the job being resumed, see job_header()
+        :return: Journal open for appending, with the records of the interrupted job
+        """
+        path = os.path.join(directory, JOURNAL_NAME)
+        try:
+            with open(path, encoding="utf-8") as file:
+                lines = file.read().splitlines()
+        except FileNotFoundError:
+            raise JournalError("No job journal on the target, there is nothing to resume")
+
+        records = {}
+        for number, line in enumerate(lines):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # The last line may be cut short by the interruption
+                continue
+
+            if number == 0:
+                if event.pop("event", None) != "job" or event != header:
+                    raise JournalError("The job journal on the target belongs to another source or filesystem")
+            elif event.get("event") == "file":
+                records[event["path"]] = (event["size"], event["digest"])
+
+        if not lines:
+            raise JournalError("The job journal on the target is empty")
+
+        journal = cls(directory, header, records)
+        journal.__fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        return journal
+
+    def record(self, target_path, size, digest):
+        """
+        Append a completed file, meant to be the on_file_copied callback of the copy engine
+
+        :param target_path: Path of the target file
+        :param size: Number of bytes written
+        :param digest: Hex digest of the bytes written
+        """
+        path = os.path.relpath(target_path, self.directory)
+        with self.__lock:
+            self.records[path] = (size, digest)
+            self.__append({"event": "file", "path": path, "size": size, "digest": digest})
+
+    def close(self):
+        with self.__lock:
+            if self.__fd is not None:
+                os.close(self.__fd)
+                self.__fd = None
+
+    def remove(self):
+        """
+        Close and delete the journal, once the job is complete
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __append(self, event):
+        # A single write per line, O_APPEND keeps concurrent lines whole
+        os.write(self.__fd, progress.json_line(event).encode("utf-8"))
+
+
+def job_header(source_manifest, filesystem_type, split_wim, hash_algorithm):
+    """
+    Identify a job by its source and target filesystem, so a journal is never applied to another job
+
+    :param source_manifest: manifest.SourceManifest of the source
+    :param filesystem_type: "FAT" or "NTFS"
+    :param split_wim: Whether an install.wim too large for FAT32 is split into .swm parts
+    :param hash_algorithm: hashlib name of the hash in the records
+    :return: Dictionary
+    """
+    fingerprint = hashlib.sha256()
+    for file in source_manifest.files:
+        fingerprint.update(f"{file.path}\0{file.size}\n".encode("utf-8", "surrogateescape"))
+
+    return {
+        "version": _VERSION,
+        "source_files": len(source_manifest),
+        "source_size": source_manifest.total_size,
+        "source_fingerprint": fingerprint.hexdigest(),
+        "filesystem": filesystem_type,
+        "split_wim": split_wim,
+        "hash": hash_algorithm
+    }
+
+
+def target_paths(file, split_wim):
+    """
+    :param file: manifest.ManifestFile
+    :param split_wim: Whether an install.wim too large for FAT32 is split into .swm parts
+    :return: Paths relative to the target root the file is written to
+    """
+    if not (split_wim and wim.needs_split(file.path, file.size)):
+        return [file.path]
+
+    wim_source = wim.WimSource(file.source, 64 * 1024)
+    try:
+        return [part_path for part_path, __ in wim.plan_split(wim_source, file.path)]
+    finally:
+        wim_source.close()
@@ -2,76 +2,295 @@
 
 import os
 import re
-import subprocess
+import select
+import socket
+import threading
 
+#: Where the kernel lists whole block devices
+SYSFS_BLOCK = "/sys/block"
 
-def usb_drive(show_all=False):
-    devices_list = []
+#: Seconds between two scans of /sys/block when kernel uevents can't be received
+DEFAULT_POLL_INTERVAL = 2.0
 
-    lsblk = subprocess.run(["lsblk",
-                            "--output", "NAME,SIZE,MODEL",
-                            "--noheadings",
-                            "--nodeps"], capture_output=True, text=True).stdout
+_NETLINK_KOBJECT_UEVENT = 15
 
-    devices = re.sub("sr[0-9]|cdrom[0-9]", "", lsblk).split()
+_OPTICAL_DEVICE = re.compile("sr[0-9]+$")
 
-    for device in devices:
-        if is_removable_and_writable_device(device):
-            if not show_all:
-                continue
+#: Block devices that are never a source or a target
+_IGNORED_DEVICE = re.compile("(ram|zram|loop)[0-9]+$")
 
-        block_device = f"/dev/{device}"
 
-        device_capacity = subprocess.run(["lsblk",
-                                          "--output", "SIZE",
-                                          "--noheadings",
-                                          "--nodeps",
-                                          block_device], capture_output=True, text=True).stdout.strip()
+class BlockDevice:
+    """
+    A whole block device as described by sysfs
+    """
+    __slots__ = ("name", "size", "model", "removable", "read_only")
 
-        device_model = subprocess.run(["lsblk",
-                                       "--output", "MODEL",
-                                       "--noheadings",
-                                       "--nodeps",
-                                       block_device], capture_output=True, text=True).stdout.strip()
+    def __init__(self, name, size, model, removable, read_only):
+        """
+        :param name: Kernel name, e.g. "sdb"
+        :param size: Size in bytes, 0 for a drive without media
+        :param model: Model reported by the device, may be empty
+        :param removable: Whether the kernel flags the media as removable
+        :param read_only: Whether the device is read-only
+        """
+        self.name = name
+        self.size = size
+        self.model = model
+        self.removable = removable
+        self.read_only = read_only
 
-        if device_model != "":
-            devices_list.append([block_device, f"{block_device} ({device_model}, {device_capacity})"])
-        else:
-            devices_list.append([block_device, f"{block_device} ({device_capacity})"])
+    @property
+    def path(self):
+        return "/dev/" + self.name
 
-    return devices_list
+    @property
+    def is_optical(self):
+        return _OPTICAL_DEVICE.match(self.name) is not None
 
+    @property
+    def description(self):
+        """
+        :return: Text shown in device lists
+        """
+        if self.is_optical:
+            return f"{self.path} - {self.model}"
+        if self.model != "":
+            return f"{self.path} ({self.model}, {format_capacity(self.size)})"
+        return f"{self.path} ({format_capacity(self.size)})"
 
-def is_removable_and_writable_device(block_device_name):
-    sysfs_block_device_dir = f"/sys/block/{block_device_name}"
+    def __eq__(self, other):
+        return isinstance(other, BlockDevice) and all(
+            getattr(self, attribute) == getattr(other, attribute) for attribute in self.__slots__)
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+def read_block_device(name):
+    """
+    :param name: Kernel name of a whole block device, e.g. "sdb"
+    :return: BlockDevice, None if the device is gone
+    """
+    sysfs_block_device_dir = os.path.join(SYSFS_BLOCK, name)
+
+    try:
+        size = int(_read_attribute(sysfs_block_device_dir, "size")) * 512
+        removable = _read_attribute(sysfs_block_device_dir, "removable") == "1"
+        read_only = _read_attribute(sysfs_block_device_dir, "ro") == "1"
+    except (OSError, ValueError):
+        return None
+
+    try:
+        model = _read_attribute(sysfs_block_device_dir, "device/model")
+    except OSError:
+        model = ""
+
+    return BlockDevice(name, size, model, removable, read_only)
+
+
+def scan_block_devices():
+    """
+    :return: Dictionary of kernel name to BlockDevice, for every whole block device that may be a source or target
+    """
+    devices = {}
+    for name in os.listdir(SYSFS_BLOCK):
+        if _IGNORED_DEVICE.match(name):
+            continue
+
+        device = read_block_device(name)
+        if device is not None:
+            devices[name] = device
+    return devices
 
-    if os.path.exists(sysfs_block_device_dir):
-        removable_path = os.path.join(sysfs_block_device_dir, "removable")
-        ro_path = os.path.join(sysfs_block_device_dir, "ro")
 
-        if os.path.isfile(removable_path) and os.path.isfile(ro_path):
-            with open(removable_path) as removable, open(ro_path) as ro:
-                removable_content = removable.read().strip()
-                ro_content = ro.read().strip()
+def format_capacity(size):
+    """
+    :param size: Size in bytes
+    :return: Size the way lsblk prints it, e.g. "14.9G"
+    """
+    for unit in ["B", "K", "M", "G", "T", "P"]:
+        if size < 1024 or unit == "P":
+            break
+        size /= 1024
+    return f"{size:.1f}".rstrip("0").rstrip(".") + unit
 
-            return removable_content == "1" and ro_content == "0"
 
-    return False
+def is_target_candidate(device, show_all=False):
+    """
+    :param device: BlockDevice
+    :param show_all: Also accept devices not detected as USB sticks
+    :return: True if the device belongs to the list of target devices
+    """
+    if device.is_optical or device.size == 0:
+        return False
+    return show_all or (device.removable and not device.read_only)
+
+
+def usb_drive(show_all=False):
+    devices = scan_block_devices()
+    return [[device.path, device.description] for __, device in sorted(devices.items())
+            if is_target_candidate(device, show_all)]
+
+
+def is_removable_and_writable_device(block_device_name):
+    device = read_block_device(block_device_name)
+    return device is not None and device.removable and not device.read_only
 
 
 def dvd_drive():
-    devices_list = []
-    find = subprocess.run(["find", "/sys/block",
-                           "-maxdepth", "1",
-                           "-mindepth", "1"], capture_output=True, text=True).stdout.split()
-    devices = [device for device in find if re.findall("sr[0-9]", device)]
+    devices = scan_block_devices()
+    return [[device.path, device.description] for __, device in sorted(devices.items()) if device.is_optical]
+
+
+class DeviceInventory:
+    """
+    In-memory model of the block devices, kept up to date from kernel uevents
+
+    Listing devices used to cost several lsblk processes per device on every refresh. The inventory reads
+    sysfs once, then only re-reads the devices the kernel reports as added, removed or changed, and hands
+    the differences to a callback. Where the netlink socket can't be opened it scans sysfs periodically instead.
+    """
+
+    def __init__(self, on_change=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        """
+        :param on_change: Callable taking (added, removed, changed) lists of BlockDevice, called from the
+                          inventory thread
+        :param poll_interval: Seconds between two scans of sysfs when kernel uevents can't be received
+        """
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+
+        self.__devices = scan_block_devices()
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__wake_up = None
+
+    @property
+    def devices(self):
+        """
+        :return: List of BlockDevice, sorted by name
+        """
+        with self.__lock:
+            return [device for __, device in sorted(self.__devices.items())]
+
+    def usb_drives(self, show_all=False):
+        """
+        :return: List of BlockDevice that may be a target
+        """
+        return [device for device in self.devices if is_target_candidate(device, show_all)]
+
+    def dvd_drives(self):
+        """
+        :return: List of BlockDevice that are optical drives
+        """
+        return [device for device in self.devices if device.is_optical]
+
+    def start(self):
+        """
+        Start following kernel uevents in a background thread
+        """
+        uevents = None
+        try:
+            uevents = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, _NETLINK_KOBJECT_UEVENT)
+            uevents.bind((0, 1))
+        except (AttributeError, OSError):
+            if uevents is not None:
+                uevents.close()
+            uevents = None
+
+        self.__wake_up = os.pipe()
+        self.__thread = threading.Thread(target=self.__monitor, args=(uevents,), daemon=True,
+                                         name="device_inventory")
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        os.write(self.__wake_up[1], b"\0")
+        self.__thread.join()
+        self.__thread = None
+
+        for fd in self.__wake_up:
+            os.close(fd)
+        self.__wake_up = None
+
+    def rescan(self):
+        """
+        Read every device from sysfs again, e.g. on an explicit refresh
+        """
+        self.__update(scan_block_devices())
+
+    def __monitor(self, uevents):
+        try:
+            while True:
+                readable = select.select([self.__wake_up[0]] + ([uevents] if uevents is not None else []), [], [],
+                                         None if uevents is not None else self.poll_interval)[0]
+                if self.__wake_up[0] in readable:
+                    break
+
+                if uevents is None:
+                    self.rescan()
+                    continue
+
+                names = set()
+                while True:
+                    name = _parse_uevent(uevents.recv(65536))
+                    if name is not None:
+                        names.add(name)
+                    # Plugging a hub in sends a burst of events, handle it as one change
+                    if not select.select([uevents], [], [], 0)[0]:
+                        break
+
+                if names:
+                    self.__update_devices(names)
+        finally:
+            if uevents is not None:
+                uevents.close()
+
+    def __update_devices(self, names):
+        with self.__lock:
+            devices = dict(self.__devices)
+
+        for name in names:
+            device = read_block_device(name)
+            if device is None:
+                devices.pop(name, None)
+            else:
+                devices[name] = device
+
+        self.__update(devices)
+
+    def __update(self, devices):
+        with self.__lock:
+            previous = self.__devices
+            self.__devices = devices
+
+        added = [device for name, device in sorted(devices.items()) if name not in previous]
+        removed = [device for name, device in sorted(previous.items()) if name not in devices]
+        changed = [device for name, device in sorted(devices.items())
+                   if name in previous and previous[name] != device]
+
+        if (added or removed or changed) and self.on_change is not None:
+            self.on_change(added, removed, changed)
+
 
-    for device in devices:
-        optical_disk_drive_devfs_path = f"/dev/{re.findall('sr[0-9]', device)[0]}"
+def _read_attribute(directory, attribute):
+    with open(os.path.join(directory, attribute)) as file:
+        return file.read().strip()
 
-        with open(os.path.join(device, "device/model"), "r") as model:
-            model_content = model.read().strip()
 
-        devices_list.append([optical_disk_drive_devfs_path, f"{optical_disk_drive_devfs_path} - {model_content}"])
+def _parse_uevent(message):
+    """
+    :param message: Kernel uevent, "ACTION@DEVPATH" followed by NUL separated KEY=VALUE pairs
+    :return: Kernel name of the whole block device the event is about, None for any other event
+    """
+    fields = dict(field.split("=", 1) for field in message.decode("utf-8", "replace").split("\0") if "=" in field)
+    if fields.get("SUBSYSTEM") != "block" or fields.get("DEVTYPE") != "disk":
+        return None
 
-    return devices_list
+    name = fields.get("DEVNAME", "")
+    if _IGNORED_DEVICE.match(name):
+        return None
+    return name or None
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Source manifest: one walk of the source tree per job
+
+The FAT32 file size check, the free space check, the progress total and the copy scheduler all need
+the list of source files and their sizes. On an optical drive or an image on a network share every walk
+costs seconds, so the tree is walked once with os.scandir (or read from the disc image directory records)
+and every later step reads the result.
+"""
+
+import os
+
+
+class ManifestFile:
+    """
+    A regular file of the source
+    """
+    __slots__ = ("path", "size", "source")
+
+    def __init__(self, path, size, source):
+        """
+        :param path: Path relative to the root of the source
+        :param size: Size in bytes
+        :param source: Absolute path of the file, or an image_reader.ImageFile
+        """
+        self.path = path
+        self.size = size
+        self.source = source
+
+
+class SourceManifest:
+    """
+    Directory structure and files of the source, built once per job
+    """
+
+    def __init__(self, root, directories, files):
+        """
+        :param root: Where source filesystem is mounted, or the image_reader.DiscImage
+        :param directories: Paths of the directories relative to the root, parents before their children
+        :param files: List of ManifestFile
+        """
+        self.root = root
+        self.directories = directories
+        self.files = files
+
+        #: Sum of the size of all files in bytes
+        self.total_size = sum(file.size for file in files)
+
+        #: The largest ManifestFile, None for an empty source
+        self.largest_file = max(files, key=lambda file: file.size, default=None)
+
+    def __len__(self):
+        return len(self.files)
+
+    def files_larger_than(self, size):
+        """
+        :return: List of ManifestFile larger than size bytes
+        """
+        if self.largest_file is None or self.largest_file.size <= size:
+            return []
+        return [file for file in self.files if file.size > size]
+
+
+def build_manifest(source):
+    """
+    :param source: Where source filesystem is mounted, or an image_reader.DiscImage
+    :return: SourceManifest
+    """
+    if isinstance(source, str):
+        return scan_directory(source)
+    return scan_image(source)
+
+
+def scan_directory(root):
+    """
+    Walk a directory tree with os.scandir, which gets sizes and file types from the directory reads themselves
+
+    :param root: Where source filesystem is mounted
+    :return: SourceManifest
+    """
+    directories = []
+    files = []
+
+    pending = [""]
+    while pending:
+        relative_directory = pending.pop()
+        subdirectories = []
+
+        with os.scandir(os.path.join(root, relative_directory)) as entries:
+            for entry in entries:
+                path = os.path.join(relative_directory, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(path)
+                elif entry.is_file():
+                    files.append(ManifestFile(path, entry.stat().st_size, entry.path))
+
+        directories.extend(subdirectories)
+        pending.extend(reversed(subdirectories))
+
+    return SourceManifest(root, directories, files)
+
+
+def scan_image(image):
+    """
+    :param image: image_reader.DiscImage
+    :return: SourceManifest
+    """
+    directories = []
+    files = []
+
+    for dirpath, dirnames, image_files in image.walk():
+        directories.extend(os.path.join(dirpath, dirname) for dirname in dirnames)
+        files.extend(ManifestFile(os.path.join(dirpath, file.name), file.size, file) for file in image_files)
+
+    return SourceManifest(image, directories, files)
@@ -1,10 +1,60 @@
-import gettext
-import locale
+import importlib.util
 import os
+import sys
+import threading
 
 __version__ = "0.2.12"
 
 locale_dir = os.path.join(os.path.dirname(__file__), "locale")
-translation = gettext.translation("woeusb", localedir=locale_dir, languages=[locale.getlocale()[0]], fallback=True)
-translation.install()
-i18n = translation.gettext
+
+_translation = None
+_translation_lock = threading.Lock()
+
+
+def get_translation():
+    """
+    Load the message catalog of the current locale the first time a translated string is needed, --help,
+    --version and device listing never load it
+
+    :return: gettext.NullTranslations
+    """
+    global _translation
+    if _translation is None:
+        with _translation_lock:
+            if _translation is None:
+                import gettext
+                import locale
+
+                _translation = gettext.translation("woeusb", localedir=locale_dir,
+                                                   languages=[locale.getlocale()[0]], fallback=True)
+    return _translation
+
+
+def i18n(message):
+    """
+    :param message: Untranslated message
+    :return: message in the language of the current locale
+    """
+    return get_translation().gettext(message)
+
+
+def lazy_import(name):
+    """
+    Import a module the first time one of its attributes is used, e.g. the engine from the command line front
+    end, which `woeusb --help` never needs
+
+    The first use must not race with another thread, load the module from the main thread when in doubt.
+
+    :param name: Absolute name of the module
+    :return: Module, loaded already when something imported it before
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
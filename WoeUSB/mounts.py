@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+Which filesystems of a device are mounted
+
+Mounts are matched by device number rather than by name: /proc/self/mountinfo gives the major:minor of every
+mounted filesystem, and sysfs gives the device numbers of a disk, of its partitions and of whatever is stacked
+on them (device-mapper, md), found through the holders/ directories. A disk image is matched through the
+loop devices backed by it.
+"""
+
+import os
+import re
+
+from WoeUSB import probe, trace
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+_OCTAL_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+class MountEntry:
+    """
+    One line of /proc/self/mountinfo
+    """
+    __slots__ = ("device_number", "mountpoint", "fstype", "source")
+
+    def __init__(self, device_number, mountpoint, fstype, source):
+        """
+        :param device_number: (major, minor) of the mounted device
+        :param mountpoint: Where it is mounted
+        :param fstype: Filesystem type, e.g. "vfat"
+        :param source: Mount source as given to mount, e.g. "/dev/sdb1"
+        """
+        self.device_number = device_number
+        self.mountpoint = mountpoint
+        self.fstype = fstype
+        self.source = source
+
+
+def read_mountinfo(path=MOUNTINFO):
+    """
+    :param path: mountinfo file
+    :return: Dictionary of (major, minor) to the list of MountEntry of that device
+    """
+    index = {}
+    with open(path, encoding="utf-8", errors="surrogateescape") as mountinfo:
+        for line in mountinfo:
+            fields = line.split()
+            # The optional fields end with a lone "-", the filesystem type and source follow it
+            separator = fields.index("-", 6)
+            major, minor = fields[2].split(":")
+
+            entry = MountEntry((int(major), int(minor)), _unescape(fields[4]), fields[separator + 1],
+                               _unescape(fields[separator + 2]))
+            index.setdefault(entry.device_number, []).append(entry)
+    return index
+
+
+def device_numbers(path):
+    """
+    Device numbers a mount of a device or disk image may show up with
+
+    :param path: Block device or disk image
+    :return: Set of (major, minor) of the device, its partitions and their holders, or of the loop devices
+             backed by the image and theirs
+    """
+    if os.path.isfile(path):
+        names = _loop_devices_backed_by(os.path.realpath(path))
+    else:
+        names = [os.path.basename(os.path.realpath(path))]
+
+    numbers = set()
+    pending = list(names)
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+
+        sysfs_directory = os.path.join(probe.SYSFS_CLASS_BLOCK, name)
+        try:
+            with open(os.path.join(sysfs_directory, "dev")) as dev:
+                major, minor = dev.read().strip().split(":")
+            numbers.add((int(major), int(minor)))
+        except (OSError, ValueError):
+            continue
+
+        pending.extend(_listdir(os.path.join(sysfs_directory, "holders")))
+        for entry in _listdir(sysfs_directory):
+            if os.path.exists(os.path.join(sysfs_directory, entry, "partition")):
+                pending.append(entry)
+
+    return numbers
+
+
+def find_mounts(path, mountinfo=None):
+    """
+    :param path: Block device or disk image
+    :param mountinfo: Index returned by read_mountinfo(), read now when None
+    :return: List of MountEntry of every filesystem of the device, deepest mountpoint first
+    """
+    if mountinfo is None:
+        mountinfo = read_mountinfo()
+
+    mounts = [entry for number in device_numbers(path) for entry in mountinfo.get(number, [])]
+    return sorted(mounts, key=lambda entry: entry.mountpoint.count("/"), reverse=True)
+
+
+def unmount_all(mounts):
+    """
+    Unmount several filesystems with a single umount call
+
+    :param mounts: List of MountEntry, deepest mountpoint first so nested mounts go before their parents
+    :return: List of MountEntry still mounted afterwards
+    """
+    if not mounts:
+        return []
+
+    trace.run(["umount"] + [entry.mountpoint for entry in mounts])
+
+    mountinfo = read_mountinfo()
+    return [entry for entry in mounts
+            if any(mounted.mountpoint == entry.mountpoint for mounted in mountinfo.get(entry.device_number, []))]
+
+
+def _loop_devices_backed_by(image):
+    names = []
+    for name in _listdir(probe.SYSFS_CLASS_BLOCK):
+        try:
+            with open(os.path.join(probe.SYSFS_CLASS_BLOCK, name, "loop", "backing_file")) as backing_file:
+                if backing_file.read().rstrip("\n") == image:
+                    names.append(name)
+        except OSError:
+            continue
+    return names
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _unescape(field):
+    # Spaces, tabs, newlines and backslashes in paths are written as octal escapes
+    return _OCTAL_ESCAPE.sub(lambda match: chr(int(match.group(1), 8)), field)
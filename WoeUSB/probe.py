@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Block device probing
+
+Everything the checks need to know about the target device and its partitions comes from a single
+`lsblk --json --bytes -O` call on the whole device, kept in a cache until the device is partitioned or
+formatted again. Free space comes from statvfs on the mounted filesystem.
+"""
+
+import json
+import os
+import subprocess
+import threading
+
+from WoeUSB import trace
+
+#: Where the kernel lists every block device, partitions included
+SYSFS_CLASS_BLOCK = "/sys/class/block"
+
+
+class BlockDeviceInfo:
+    """
+    A block device or partition as lsblk describes it
+    """
+    __slots__ = ("name", "path", "type", "size", "model", "fstype", "label", "removable", "read_only", "start",
+                 "logical_sector_size", "physical_sector_size", "minimum_io_size", "optimal_io_size",
+                 "discard_granularity", "discard_max_bytes", "mountpoints", "children")
+
+    def __init__(self, name, path, type, size, model, fstype, label, removable, read_only, start,
+                 logical_sector_size, physical_sector_size, minimum_io_size, optimal_io_size,
+                 discard_granularity, discard_max_bytes, mountpoints, children):
+        """
+        :param name: Kernel name, e.g. "sdb1"
+        :param path: Device node, e.g. "/dev/sdb1"
+        :param type: "disk", "part", "rom", ...
+        :param size: Size in bytes
+        :param model: Model of the device, empty for partitions
+        :param fstype: Filesystem signature found on it, e.g. "vfat" or "ntfs", empty when there is none
+        :param label: Filesystem label, empty when there is none
+        :param removable: Whether the kernel flags the media as removable
+        :param read_only: Whether the device is read-only
+        :param start: Offset in bytes of a partition on its device, None for a whole device
+        :param logical_sector_size: Logical sector size in bytes
+        :param physical_sector_size: Physical sector size in bytes
+        :param minimum_io_size: Minimum I/O size in bytes
+        :param optimal_io_size: Optimal I/O size in bytes, 0 when the device doesn't report one
+        :param discard_granularity: Discard granularity in bytes, 0 when the device can't discard
+        :param discard_max_bytes: Largest single discard in bytes, 0 when the device can't discard
+        :param mountpoints: List of the places the device is mounted at
+        :param children: List of BlockDeviceInfo of the partitions
+        """
+        self.name = name
+        self.path = path
+        self.type = type
+        self.size = size
+        self.model = model
+        self.fstype = fstype
+        self.label = label
+        self.removable = removable
+        self.read_only = read_only
+        self.start = start
+        self.logical_sector_size = logical_sector_size
+        self.physical_sector_size = physical_sector_size
+        self.minimum_io_size = minimum_io_size
+        self.optimal_io_size = optimal_io_size
+        self.discard_granularity = discard_granularity
+        self.discard_max_bytes = discard_max_bytes
+        self.mountpoints = mountpoints
+        self.children = children
+
+    def walk(self):
+        """
+        :return: Generator of this device and all of its partitions
+        """
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    @classmethod
+    def from_lsblk(cls, entry):
+        """
+        :param entry: One entry of the "blockdevices" list of `lsblk --json --bytes -O`
+        :return: BlockDeviceInfo
+        """
+        mountpoints = entry.get("mountpoints")
+        if mountpoints is None:
+            # lsblk before 2.37 only knows a single mountpoint
+            mountpoints = [entry.get("mountpoint")]
+
+        start = entry.get("start")
+
+        return cls(name=entry["kname"],
+                   path=entry.get("path") or "/dev/" + entry["kname"],
+                   type=entry.get("type") or "",
+                   size=_integer(entry.get("size")),
+                   model=(entry.get("model") or "").strip(),
+                   fstype=entry.get("fstype") or "",
+                   label=entry.get("label") or "",
+                   removable=_flag(entry.get("rm")),
+                   read_only=_flag(entry.get("ro")),
+                   # lsblk counts 512-byte sectors whatever the logical sector size of the device
+                   start=_integer(start) * 512 if start is not None else None,
+                   logical_sector_size=_integer(entry.get("log-sec")),
+                   physical_sector_size=_integer(entry.get("phy-sec")),
+                   minimum_io_size=_integer(entry.get("min-io")),
+                   optimal_io_size=_integer(entry.get("opt-io")),
+                   discard_granularity=_integer(entry.get("disc-gran")),
+                   discard_max_bytes=_integer(entry.get("disc-max")),
+                   mountpoints=[mountpoint for mountpoint in mountpoints if mountpoint],
+                   children=[cls.from_lsblk(child) for child in entry.get("children", [])])
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def probe_device(device):
+    """
+    Describe a whole device and its partitions, from the cache when it was probed before
+
+    :param device: Device node of a whole device, e.g. "/dev/sdb"
+    :return: BlockDeviceInfo
+    """
+    name = os.path.basename(os.path.realpath(device))
+
+    with _cache_lock:
+        info = _cache.get(name)
+    if info is not None:
+        return info
+
+    lsblk = trace.run(["lsblk", "--json", "--bytes", "--output-all", device],
+                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if lsblk.returncode != 0:
+        raise RuntimeError("lsblk failed on {0}: {1}".format(device, lsblk.stderr.decode("utf-8").strip()))
+
+    info = BlockDeviceInfo.from_lsblk(json.loads(lsblk.stdout.decode("utf-8"))["blockdevices"][0])
+    with _cache_lock:
+        _cache[name] = info
+    return info
+
+
+def probe(path):
+    """
+    Describe a whole device or a partition, a partition is looked up in the probe of its device
+
+    :param path: Device node, e.g. "/dev/sdb" or "/dev/sdb1"
+    :return: BlockDeviceInfo
+    """
+    name = os.path.basename(os.path.realpath(path))
+    if not os.path.exists(os.path.join(SYSFS_CLASS_BLOCK, name)):
+        raise RuntimeError("{0} is not a block device".format(path))
+    device = parent_device(name)
+
+    for info in probe_device("/dev/" + device).walk():
+        if info.name == name:
+            return info
+
+    # Partitions the device had no entry for yet, e.g. created since it was probed
+    invalidate(device)
+    for info in probe_device("/dev/" + device).walk():
+        if info.name == name:
+            return info
+    raise RuntimeError("{0} is not a block device".format(path))
+
+
+def invalidate(device=None):
+    """
+    Forget what is known about a device, to be called once it is partitioned or formatted
+
+    :param device: Device node or kernel name of a whole device or of one of its partitions, None to forget everything
+    """
+    with _cache_lock:
+        if device is None:
+            _cache.clear()
+        else:
+            _cache.pop(parent_device(os.path.basename(os.path.realpath(device))), None)
+
+
+def parent_device(name):
+    """
+    :param name: Kernel name of a block device, e.g. "sdb1", "mmcblk0p1" or "sdb"
+    :return: Kernel name of the whole device, the name itself for a whole device
+    """
+    sysfs_path = os.path.join(SYSFS_CLASS_BLOCK, name)
+    if os.path.exists(os.path.join(sysfs_path, "partition")):
+        return os.path.basename(os.path.dirname(os.path.realpath(sysfs_path)))
+    return name
+
+
+def filesystem_free_space(mountpoint):
+    """
+    :param mountpoint: Where a filesystem is mounted
+    :return: Bytes available to unprivileged writers, as df reports them
+    """
+    stat = os.statvfs(mountpoint)
+    return stat.f_bavail * stat.f_frsize
+
+
+def _integer(value):
+    # lsblk before 2.33 writes numbers as strings in JSON
+    return int(value) if value not in (None, "") else 0
+
+
+def _flag(value):
+    # lsblk before 2.33 writes booleans as "0"/"1"
+    return value is True or value == "1"
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+Copy progress: bytes done against the manifest total, smoothed throughput and ETA
+
+Copy workers call ProgressTracker.add() for every chunk written. That call only adds to a counter,
+reports are produced at most once per interval so reporting never slows the copy down.
+"""
+
+import json
+import threading
+import time
+
+#: Seconds between two reports
+DEFAULT_INTERVAL = 0.5
+
+#: Weight of the latest interval in the smoothed throughput
+DEFAULT_SMOOTHING = 0.3
+
+
+class ProgressReport:
+    """
+    A snapshot of the copy progress
+    """
+    __slots__ = ("bytes_done", "bytes_total", "throughput", "eta", "elapsed", "finished")
+
+    def __init__(self, bytes_done, bytes_total, throughput, eta, elapsed, finished):
+        """
+        :param bytes_done: Bytes written so far
+        :param bytes_total: Bytes to write in total
+        :param throughput: Smoothed throughput in bytes per second
+        :param eta: Estimated seconds remaining, None while unknown
+        :param elapsed: Seconds since the copy started
+        :param finished: True for the last report
+        """
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.throughput = throughput
+        self.eta = eta
+        self.elapsed = elapsed
+        self.finished = finished
+
+    @property
+    def percent(self):
+        if self.bytes_total == 0:
+            return 100.0
+        return min(100.0, self.bytes_done * 100.0 / self.bytes_total)
+
+    def as_dict(self):
+        return {
+            "event": "progress",
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "percent": round(self.percent, 2),
+            "throughput": round(self.throughput),
+            "eta": None if self.eta is None else round(self.eta, 1),
+            "elapsed": round(self.elapsed, 1),
+            "finished": self.finished
+        }
+
+
+class ProgressTracker:
+    """
+    Thread-safe byte counter that calls a reporter with a ProgressReport at most once per interval
+    """
+
+    def __init__(self, bytes_total, reporter=None, interval=DEFAULT_INTERVAL, smoothing=DEFAULT_SMOOTHING):
+        """
+        :param bytes_total: Bytes to write in total, usually manifest.SourceManifest.total_size
+        :param reporter: Callable taking a ProgressReport
+        :param interval: Minimum seconds between two reports
+        :param smoothing: Weight of the latest interval in the smoothed throughput, between 0 and 1
+        """
+        self.bytes_total = bytes_total
+        self.reporter = reporter
+        self.interval = interval
+        self.smoothing = smoothing
+
+        self.bytes_done = 0
+        self.throughput = 0.0
+
+        self.__lock = threading.Lock()
+        self.__start = time.monotonic()
+        self.__last_time = self.__start
+        self.__last_bytes = 0
+
+    def add(self, length):
+        """
+        Account for length more bytes written, called from the copy workers
+
+        :param length: Number of bytes
+        """
+        with self.__lock:
+            self.bytes_done += length
+            now = time.monotonic()
+            if now - self.__last_time < self.interval:
+                return
+            report = self.__snapshot(now, False)
+
+        if self.reporter is not None:
+            self.reporter(report)
+
+    def finish(self):
+        """
+        Send the final report, regardless of the interval
+        """
+        with self.__lock:
+            report = self.__snapshot(time.monotonic(), True)
+
+        if self.reporter is not None:
+            self.reporter(report)
+
+    def __snapshot(self, now, finished):
+        elapsed = now - self.__start
+        interval = now - self.__last_time
+
+        if interval > 0:
+            current = (self.bytes_done - self.__last_bytes) / interval
+            if self.throughput == 0.0:
+                self.throughput = current
+            else:
+                self.throughput = self.smoothing * current + (1 - self.smoothing) * self.throughput
+
+        self.__last_time = now
+        self.__last_bytes = self.bytes_done
+
+        eta = None
+        if finished:
+            eta = 0.0
+        elif self.throughput > 0:
+            eta = max(self.bytes_total - self.bytes_done, 0) / self.throughput
+
+        return ProgressReport(self.bytes_done, self.bytes_total, self.throughput, eta, elapsed, finished)
+
+
+def format_duration(seconds):
+    """
+    :return: "1:02:03", "2:03", or "--:--" when seconds is None
+    """
+    if seconds is None:
+        return "--:--"
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+def json_line(event):
+    """
+    :param event: Dictionary with an "event" key
+    :return: One NDJSON line, newline included
+    """
+    return json.dumps(event, separators=(",", ":")) + "\n"
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Delta refresh of an existing target to a newer source
+
+Between two Windows builds most files under boot/, efi/ and sources/ are identical. Instead of reformatting
+the partition and writing everything again, the new source manifest is compared with what is already on the
+target: files whose size differs are rewritten, files of the same size are hashed on both sides (the target
+read back from the device), and only the ones that differ are rewritten. Files of the old build that are not
+in the new one are deleted, but only inside the top level directories the source owns, so unrelated files
+that share the partition are kept.
+
+Reading is much faster than writing on USB flash, so comparing everything still costs far less than
+rewriting everything.
+"""
+
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import threading
+
+from WoeUSB import manifest, verify, wim
+
+#: Top level directories rewritten whatever the comparison says, together with the files at the root:
+#: they are small, and a refreshed stick that no longer boots is the one outcome a refresh must never have
+ALWAYS_REWRITTEN = ("boot", "efi")
+
+#: Number of files compared concurrently
+DEFAULT_COMPARE_WORKERS = 4
+
+
+class RefreshPlan:
+    """
+    What a refresh has to do to turn the target into a copy of the new source
+    """
+
+    def __init__(self, source_manifest, unchanged, changed, obsolete, replaced):
+        """
+        :param source_manifest: manifest.SourceManifest of the new source
+        :param unchanged: List of manifest.ManifestFile already on the target as they are in the source
+        :param changed: List of manifest.ManifestFile to write
+        :param obsolete: Paths relative to the target root of files of the old build to delete
+        :param replaced: Paths relative to the target root of the old versions of the changed files
+        """
+        self.source_manifest = source_manifest
+        self.unchanged = unchanged
+        self.changed = changed
+        self.obsolete = obsolete
+        self.replaced = replaced
+
+    @property
+    def files_to_copy(self):
+        """
+        :return: manifest.SourceManifest of the changed files
+        """
+        return manifest.SourceManifest(self.source_manifest.root, self.source_manifest.directories, self.changed)
+
+
+def plan_refresh(source_manifest, target_directory, split_wim=False, workers=DEFAULT_COMPARE_WORKERS,
+                 buffer_size=4 * 1024 * 1024, hash_algorithm=verify.DEFAULT_HASH_ALGORITHM):
+    """
+    Compare the new source with the target
+
+    :param source_manifest: manifest.SourceManifest of the new source
+    :param target_directory: Where the target filesystem is mounted
+    :param split_wim: Whether an install.wim too large for FAT32 is split into .swm parts
+    :param workers: Number of files compared concurrently
+    :param buffer_size: Size in bytes of a single read
+    :param hash_algorithm: hashlib name of the hash used to compare files of the same size
+    :return: RefreshPlan
+    """
+    target_manifest = manifest.scan_directory(target_directory)
+
+    # FAT and NTFS as Windows sees them don't care about case
+    target_files = {file.path.lower(): file for file in target_manifest.files}
+
+    comparator = _Comparator(buffer_size, hash_algorithm)
+    expected = set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="refresh") as executor:
+        comparisons = []
+        for file in source_manifest.files:
+            existing = _existing_targets(file, target_files, split_wim)
+            expected.update(target.path.lower() for target in existing)
+
+            if not existing or _always_rewritten(file.path):
+                future = None
+            elif split_wim and wim.needs_split(file.path, file.size):
+                future = executor.submit(comparator.same_wim_parts, file, existing)
+            else:
+                future = executor.submit(comparator.same_file, file, existing[0])
+            comparisons.append((file, existing, future))
+
+        unchanged = []
+        changed = []
+        replaced = []
+        for file, existing, future in comparisons:
+            if future is not None and future.result():
+                unchanged.append(file)
+            else:
+                changed.append(file)
+                replaced.extend(target.path for target in existing)
+
+    owned = set(path.split(os.sep, 1)[0].lower() for path in source_manifest.directories)
+    obsolete = [file.path for file in target_manifest.files
+                if file.path.lower() not in expected
+                and os.sep in file.path
+                and file.path.split(os.sep, 1)[0].lower() in owned]
+
+    return RefreshPlan(source_manifest, unchanged, changed, obsolete, replaced)
+
+
+def apply_deletions(plan, target_directory):
+    """
+    Delete obsolete files and the old versions of changed files, then the directories of the old build left empty
+
+    :param plan: RefreshPlan
+    :param target_directory: Where the target filesystem is mounted
+    """
+    for path in plan.obsolete + plan.replaced:
+        try:
+            os.remove(os.path.join(target_directory, path))
+        except FileNotFoundError:
+            pass
+
+    kept = set(path.lower() for path in plan.source_manifest.directories)
+    owned = set(path.split(os.sep, 1)[0] for path in kept)
+    for top, directories, __ in os.walk(target_directory, topdown=False):
+        relative = os.path.relpath(top, target_directory)
+        if relative == "." or relative.split(os.sep, 1)[0].lower() not in owned or relative.lower() in kept:
+            continue
+        try:
+            os.rmdir(top)
+        except OSError:
+            # Not empty, something else lives there
+            pass
+
+
+def _existing_targets(file, target_files, split_wim):
+    """
+    :return: List of manifest.ManifestFile already on the target for a source file, whatever their content
+    """
+    if not (split_wim and wim.needs_split(file.path, file.size)):
+        target = target_files.get(file.path.lower())
+        return [target] if target is not None else []
+
+    directory, name = os.path.split(file.path)
+    prefix = os.path.join(directory, os.path.splitext(name)[0]).lower()
+    return [target for path, target in target_files.items() if path.startswith(prefix) and path.endswith(".swm")]
+
+
+def _always_rewritten(path):
+    return os.sep not in path or path.split(os.sep, 1)[0].lower() in ALWAYS_REWRITTEN
+
+
+class _Comparator:
+    """
+    Hashes a source file and its copy on the target, in the threads of plan_refresh
+    """
+
+    def __init__(self, buffer_size, hash_algorithm):
+        self.buffer_size = -(-buffer_size // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.hash_algorithm = hash_algorithm
+        self.__local = threading.local()
+
+    def same_file(self, file, target):
+        """
+        :param file: manifest.ManifestFile of the source
+        :param target: manifest.ManifestFile of the target
+        :return: True if the target holds the same bytes
+        """
+        if target.size != file.size:
+            return False
+
+        try:
+            target_size, target_digest = verify.read_digest(target.source, self.hash_algorithm, self.__buffer())
+        except OSError:
+            return False
+
+        return target_size == file.size and target_digest == self.source_digest(file.source)
+
+    def same_wim_parts(self, file, existing):
+        """
+        :param file: manifest.ManifestFile of an install.wim written as .swm parts
+        :param existing: List of manifest.ManifestFile of the parts on the target
+        :return: True if the target holds exactly the parts splitting the source would write
+        """
+        wim_source = wim.WimSource(file.source, self.buffer_size)
+        try:
+            parts = wim.plan_split(wim_source, file.path)
+
+            existing = {target.path.lower(): target for target in existing}
+            if len(existing) != len(parts):
+                return False
+
+            for part_path, part in parts:
+                target = existing.get(part_path.lower())
+                if target is None or target.size != part.size:
+                    return False
+
+                target_size, target_digest = verify.read_digest(target.source, self.hash_algorithm, self.__buffer())
+                hasher = hashlib.new(self.hash_algorithm)
+                for chunk in part.chunks():
+                    hasher.update(chunk)
+                if target_size != part.size or target_digest != hasher.hexdigest():
+                    return False
+
+            return True
+        except (wim.WimError, OSError):
+            return False
+        finally:
+            wim_source.close()
+
+    def source_digest(self, source):
+        """
+        :param source: Path of a source file, or an image_reader.ImageFile
+        :return: Hex digest
+        """
+        hasher = hashlib.new(self.hash_algorithm)
+
+        if not isinstance(source, str):
+            for chunk in source.chunks(self.buffer_size):
+                with chunk:
+                    hasher.update(chunk)
+            return hasher.hexdigest()
+
+        view = memoryview(self.__buffer())
+        fd = os.open(source, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                length = os.readv(fd, [view])
+                if length == 0:
+                    break
+                hasher.update(view[:length])
+        finally:
+            os.close(fd)
+            view.release()
+        return hasher.hexdigest()
+
+    def __buffer(self):
+        buffer = getattr(self.__local, "buffer", None)
+        if buffer is None:
+            buffer = self.__local.buffer = mmap.mmap(-1, self.buffer_size)
+        return buffer
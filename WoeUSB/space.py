@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Free space planning
+
+Filesystems allocate whole clusters: on FAT32 with 32KiB clusters a 1KiB file takes 32KiB, and every directory
+takes at least one cluster for its entries. The space a source needs is therefore computed per file and per
+directory from the manifest, rounded up to the cluster size of the target, instead of summing file sizes.
+"""
+
+import os
+import re
+
+from WoeUSB import fat32, wim
+
+#: Cluster size of NTFS volumes created by mkntfs up to 16TiB
+NTFS_CLUSTER_SIZE = 4096
+
+#: Every file and directory of an NTFS volume has a record in the MFT
+NTFS_FILE_RECORD_SIZE = 1024
+
+#: File data up to about this size is stored in the MFT record itself
+NTFS_RESIDENT_DATA_SIZE = 600
+
+#: $LogFile (up to 64MiB as created by mkntfs), $MFTMirr, $Bitmap, $Secure, $UpCase and the other metadata files
+NTFS_METADATA_SIZE = 72 * 1024 * 1024
+
+_FAT_DIRECTORY_ENTRY_SIZE = 32
+
+_FAT_SHORT_NAME_PART = re.compile(r"[A-Za-z0-9!#$%&'()@^_`{}~-]*$")
+
+_MIB = 1024 * 1024
+
+
+class SpacePlan:
+    """
+    Space a source takes on a filesystem
+    """
+
+    def __init__(self, filesystem_type, cluster_size, allocated_size, file_count, directory_count):
+        """
+        :param filesystem_type: "FAT" or "NTFS"
+        :param cluster_size: Cluster size in bytes the plan was computed for
+        :param allocated_size: Bytes allocated to files and directories, whole clusters and records
+        :param file_count: Number of files written, .swm parts counted one by one
+        :param directory_count: Number of directories, the root included
+        """
+        self.filesystem_type = filesystem_type
+        self.cluster_size = cluster_size
+        self.allocated_size = allocated_size
+        self.file_count = file_count
+        self.directory_count = directory_count
+
+
+def plan_space(source_manifest, filesystem_type, cluster_size, split_wim=False):
+    """
+    :param source_manifest: manifest.SourceManifest of the files to write
+    :param filesystem_type: "FAT" or "NTFS"
+    :param cluster_size: Cluster size of the target filesystem in bytes
+    :param split_wim: Whether an install.wim too large for FAT32 is written as .swm parts
+    :return: SpacePlan
+    """
+    children = {"": []}
+    for path in source_manifest.directories:
+        children[path] = []
+        children.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+
+    file_sizes = []
+    for file in source_manifest.files:
+        parent, name = os.path.split(file.path)
+        for part_name, size in _target_files(file, name, split_wim):
+            children.setdefault(parent, []).append(part_name)
+            file_sizes.append(size)
+
+    if filesystem_type == "FAT":
+        allocated = sum(_round_up(size, cluster_size) for size in file_sizes)
+        for directory, names in children.items():
+            # Volume label in the root, "." and ".." everywhere else
+            entries = (1 if directory == "" else 2) + sum(_fat_directory_entries(name) for name in names)
+            allocated += max(_round_up(entries * _FAT_DIRECTORY_ENTRY_SIZE, cluster_size), cluster_size)
+    else:
+        allocated = NTFS_FILE_RECORD_SIZE * (len(file_sizes) + len(children))
+        allocated += sum(_round_up(size, cluster_size) for size in file_sizes if size > NTFS_RESIDENT_DATA_SIZE)
+        for names in children.values():
+            # Index entries are about 82 bytes plus the name in UTF-16, large directories need index blocks
+            index_size = sum(82 + 2 * len(name) for name in names)
+            if index_size > NTFS_FILE_RECORD_SIZE // 2:
+                allocated += _round_up(index_size, cluster_size)
+
+    return SpacePlan(filesystem_type, cluster_size, allocated, len(file_sizes), len(children))
+
+
+def minimum_partition_size(source_manifest, filesystem_type, split_wim=False):
+    """
+    Smallest partition that holds the source once formatted, computed before anything is written to the target
+
+    :param source_manifest: manifest.SourceManifest of the source
+    :param filesystem_type: "FAT" or "NTFS"
+    :param split_wim: Whether an install.wim too large for FAT32 is written as .swm parts
+    :return: Size in bytes, a whole number of MiB
+    """
+    if filesystem_type != "FAT":
+        plan = plan_space(source_manifest, filesystem_type, NTFS_CLUSTER_SIZE, split_wim)
+        return _round_up(plan.allocated_size + NTFS_METADATA_SIZE, _MIB)
+
+    # The cluster size depends on the partition size and the space taken on the cluster size, grow the partition
+    # until the clusters it gets hold the source. Fat32Layout raises Fat32Error past the FAT32 size limit.
+    plans = {}
+    volume_size = 64 * _MIB
+    while True:
+        layout = fat32.Fat32Layout(volume_size)
+
+        if layout.cluster_size not in plans:
+            plans[layout.cluster_size] = plan_space(source_manifest, "FAT", layout.cluster_size, split_wim)
+        needed_clusters = plans[layout.cluster_size].allocated_size // layout.cluster_size
+
+        if needed_clusters <= layout.cluster_count:
+            return volume_size
+        volume_size += _round_up((needed_clusters - layout.cluster_count) * layout.cluster_size, _MIB)
+
+
+def filesystem_cluster_size(mountpoint):
+    """
+    :param mountpoint: Where a filesystem is mounted
+    :return: Allocation unit of the filesystem in bytes, the cluster size for vfat and ntfs
+    """
+    return os.statvfs(mountpoint).f_bsize
+
+
+def _target_files(file, name, split_wim):
+    """
+    :return: List of (name, size) of the files a source file is written as
+    """
+    if not (split_wim and wim.needs_split(file.path, file.size)):
+        return [(name, file.size)]
+
+    wim_source = wim.WimSource(file.source, 64 * 1024)
+    try:
+        parts = wim.plan_split(wim_source, name)
+    finally:
+        wim_source.close()
+
+    return [(part_path, part.size) for part_path, part in parts]
+
+
+def _fat_directory_entries(name):
+    """
+    :return: Number of 32 byte directory entries a name takes on FAT, long name entries included
+    """
+    base, dot, extension = name.rpartition(".")
+    if not dot or not base:
+        base, extension = name, ""
+
+    if 0 < len(base) <= 8 and len(extension) <= 3 and (extension or not dot) and \
+            all(_FAT_SHORT_NAME_PART.match(part) and not (part.lower() != part and part.upper() != part)
+                for part in (base, extension)):
+        return 1
+
+    # Long names are stored 13 UTF-16 code units per entry, after the short name entry
+    return 1 + -(-len(name.encode("utf-16-le")) // 26)
+
+
+def _round_up(size, unit):
+    return -(-size // unit) * unit
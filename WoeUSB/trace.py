@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+"""
+Timing spans of a job, written as a Chrome trace
+
+The states core.main goes through (enter-init, start-mounting, start-copying, start-unmounting...) become
+phase spans, every external tool and the expensive steps inside the phases (copy, verification, sync) get
+spans of their own with the bytes and files they handled. The trace is a Chrome trace event file that
+chrome://tracing and https://ui.perfetto.dev open as a timeline, one row per thread.
+
+Tracing is off unless start() is called, span() and run() then cost next to nothing.
+"""
+
+import contextlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+
+class Span:
+    """
+    A running span, arguments can be attached to it until it ends
+    """
+    __slots__ = ("args",)
+
+    def __init__(self, args):
+        self.args = args
+
+    def set(self, **args):
+        """
+        Attach arguments shown with the span, e.g. bytes=..., files=...
+        """
+        self.args.update(args)
+
+
+class Tracer:
+    """
+    Collects the spans of a job
+    """
+
+    def __init__(self):
+        self.__events = []
+        self.__lock = threading.Lock()
+        self.__pid = os.getpid()
+        self.__origin = time.monotonic()
+        self.__threads = set()
+
+        self.__phase = None
+
+    def add(self, name, category, start, end, args):
+        """
+        Record a complete span
+
+        :param name: Name shown on the span
+        :param category: "phase", "step" or "command"
+        :param start: time.monotonic() when it started
+        :param end: time.monotonic() when it ended
+        :param args: Dictionary of arguments shown with the span
+        """
+        thread = threading.current_thread()
+        event = {"name": name, "cat": category, "ph": "X", "pid": self.__pid, "tid": thread.ident,
+                 "ts": round((start - self.__origin) * 1e6), "dur": round((end - start) * 1e6), "args": args}
+
+        with self.__lock:
+            self.__events.append(event)
+            if thread.ident not in self.__threads:
+                self.__threads.add(thread.ident)
+                self.__events.append({"name": "thread_name", "ph": "M", "pid": self.__pid, "tid": thread.ident,
+                                      "args": {"name": thread.name}})
+
+    def phase(self, name):
+        """
+        End the current phase and start the next one
+
+        :param name: Name of the new phase, None to only end the current one
+        """
+        now = time.monotonic()
+        if self.__phase is not None:
+            self.add(self.__phase[0], "phase", self.__phase[1], now, {})
+        self.__phase = (name, now) if name is not None else None
+
+    def write(self, path):
+        """
+        End the current phase and write every span recorded so far
+
+        :param path: Where to write the Chrome trace JSON file
+        """
+        self.phase(None)
+        with self.__lock:
+            events = list(self.__events)
+
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+
+_tracer = None
+
+
+def start():
+    """
+    Start recording spans, until stop() is called
+    """
+    global _tracer
+    _tracer = Tracer()
+
+
+def stop(path):
+    """
+    Stop recording spans and write them
+
+    :param path: Where to write the Chrome trace JSON file
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.write(path)
+
+
+def phase(name):
+    """
+    End the current phase and start the next one, does nothing unless tracing
+
+    :param name: Name of the new phase, usually the new core.Job.state
+    """
+    tracer = _tracer
+    if tracer is not None:
+        tracer.phase(name)
+
+
+@contextlib.contextmanager
+def span(name, category="step", **args):
+    """
+    Time the body of a with statement
+
+    :param name: Name shown on the span
+    :param category: "step" for work inside a phase, "command" for external tools
+    :param args: Arguments shown with the span, more can be attached with the Span it yields
+    :return: Context manager yielding a Span
+    """
+    tracer = _tracer
+    current = Span(args)
+    if tracer is None:
+        yield current
+        return
+
+    start_time = time.monotonic()
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=str(e) or type(e).__name__)
+        raise
+    finally:
+        tracer.add(name, category, start_time, time.monotonic(), current.args)
+
+
+def run(command, **kwargs):
+    """
+    subprocess.run() in a span named after the tool
+
+    :param command: Command as a list, as given to subprocess.run()
+    :return: subprocess.CompletedProcess
+    """
+    with span(os.path.basename(command[0]), "command", command=" ".join(command)) as current:
+        completed = subprocess.run(command, **kwargs)
+        current.set(returncode=completed.returncode)
+    return completed
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+UEFI:NTFS bootloader image
+
+UEFI firmwares usually can't read NTFS, so NTFS targets get a small FAT partition holding the UEFI:NTFS
+bootloader from Rufus, which chain-loads Windows from the NTFS partition. The image is kept in a local
+content-addressed cache: every image is stored under its SHA-256 and is hashed again before it is used, and
+a small reference file names the image to use. The cache is looked up in the system-wide directory, then in
+the XDG cache directory of the user, and it can be seeded from a local file so offline stations never have
+to download it. The network is only used when neither cache has an image.
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+import tempfile
+
+#: Where the image is downloaded from when no cache has it
+IMAGE_URL = "https://github.com/pbatard/rufus/raw/master/res/uefi/uefi-ntfs.img"
+
+#: Cache shared by every user of the station
+SYSTEM_CACHE_DIRECTORY = "/var/cache/woeusb/uefi-ntfs"
+
+#: Seconds to wait for the download before giving up
+DOWNLOAD_TIMEOUT = 15
+
+#: Sanity bound on the size of an image, write_image() checks that it fits the partition
+MAX_IMAGE_SIZE = 4 * 1024 * 1024
+
+#: Name of the file holding the SHA-256 of the image to use
+_REFERENCE_NAME = "current"
+
+
+class UefiNtfsImageError(RuntimeError):
+    """
+    Raised when no valid UEFI:NTFS image can be found, seeded or downloaded
+    """
+
+
+def cache_directories():
+    """
+    :return: List of the cache directories, in lookup order
+    """
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return [SYSTEM_CACHE_DIRECTORY, os.path.join(xdg_cache_home, "woeusb", "uefi-ntfs")]
+
+
+def find_cached_image():
+    """
+    :return: Path of the cached image, None when no cache has a valid one
+    """
+    for directory in cache_directories():
+        try:
+            with open(os.path.join(directory, _REFERENCE_NAME)) as reference:
+                digest = reference.read().strip()
+        except OSError:
+            continue
+
+        path = os.path.join(directory, digest + ".img")
+        try:
+            # Content-addressed, an image that doesn't hash to its name is corrupted
+            if file_digest(path) == digest:
+                return path
+        except OSError:
+            continue
+
+    return None
+
+
+def seed_cache(image):
+    """
+    Add an image to the cache and make it the one to use
+
+    :param image: Path of a local uefi-ntfs.img
+    :return: Path of the cached copy
+    """
+    try:
+        with open(image, "rb") as file:
+            data = file.read(MAX_IMAGE_SIZE + 1)
+    except OSError as e:
+        raise UefiNtfsImageError("Unable to read UEFI:NTFS image {0}: {1}".format(image, e.strerror))
+
+    return _store(data, image)
+
+
+def download_image(url=IMAGE_URL, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Download the image into the cache
+
+    :return: Path of the cached copy
+    """
+    # Only NTFS targets without a cached image need it, and urllib.request is slow to import
+    import urllib.error
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            data = response.read(MAX_IMAGE_SIZE + 1)
+    except (urllib.error.URLError, OSError) as e:
+        raise UefiNtfsImageError("Unable to download the UEFI:NTFS image from {0}: {1}".format(url, e))
+
+    return _store(data, url)
+
+
+def get_image(seed=None):
+    """
+    :param seed: Path of a local image to add to the cache and use, e.g. from --uefi-ntfs-image
+    :return: Path of a verified image, from the cache whenever possible
+    """
+    if seed is not None:
+        return seed_cache(seed)
+
+    path = find_cached_image()
+    if path is not None:
+        return path
+
+    return download_image()
+
+
+def write_image(image, partition):
+    """
+    Write the image to the UEFI:NTFS partition in a single write, bypassing the page cache
+
+    :param image: Path of the image
+    :param partition: Device node of the UEFI:NTFS partition
+    """
+    with open(image, "rb") as file:
+        data = file.read()
+
+    try:
+        fd = os.open(partition, os.O_WRONLY | os.O_DIRECT)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        # Not every device accepts O_DIRECT, write through the page cache instead
+        fd = os.open(partition, os.O_WRONLY)
+
+    try:
+        partition_size = os.lseek(fd, 0, os.SEEK_END)
+        os.lseek(fd, 0, os.SEEK_SET)
+        if len(data) > partition_size:
+            raise UefiNtfsImageError("The UEFI:NTFS image doesn't fit in {0}".format(partition))
+
+        # O_DIRECT wants an aligned buffer and length, the image is padded with zeros to whole pages
+        length = min(-(-len(data) // mmap.PAGESIZE) * mmap.PAGESIZE, partition_size)
+        buffer = mmap.mmap(-1, -(-length // mmap.PAGESIZE) * mmap.PAGESIZE)
+        try:
+            buffer[:len(data)] = data
+            written = os.write(fd, memoryview(buffer)[:length])
+        finally:
+            buffer.close()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if written < len(data):
+        raise UefiNtfsImageError("Short write of the UEFI:NTFS image to {0}".format(partition))
+
+
+def file_digest(path):
+    """
+    :return: Hex SHA-256 of a file
+    """
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _store(data, origin):
+    if not data or len(data) > MAX_IMAGE_SIZE:
+        raise UefiNtfsImageError("{0} is not a UEFI:NTFS image, it must be between 1 and {1} bytes".format(
+            origin, MAX_IMAGE_SIZE))
+
+    digest = hashlib.sha256(data).hexdigest()
+
+    errors = []
+    for directory in cache_directories():
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, digest + ".img")
+            _write_atomically(path, data)
+            _write_atomically(os.path.join(directory, _REFERENCE_NAME), (digest + "\n").encode("ascii"))
+            return path
+        except OSError as e:
+            errors.append("{0}: {1}".format(directory, e.strerror))
+
+    raise UefiNtfsImageError("Unable to cache the UEFI:NTFS image ({0})".format(", ".join(errors)))
+
+
+def _write_atomically(path, data):
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".woeusb.")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
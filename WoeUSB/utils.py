@@ -1,25 +1,32 @@
+import functools
 import os
 import pathlib
-import re
 import shutil
-import subprocess
 import sys
-from xml.dom.minidom import parseString
 
-_ = lambda s: s  # Placeholder for translation function
-
-#: Disable message coloring when set to True, set by --no-color
-no_color = False
+from WoeUSB import \
+    copy_engine, \
+    discard, \
+    events, \
+    fanout, \
+    fat32, \
+    journal, \
+    manifest, \
+    mounts, \
+    probe, \
+    progress, \
+    refresh, \
+    space, \
+    trace, \
+    uefi_ntfs, \
+    verify, \
+    wim, \
+    workaround
 
-# External tools
-try:
-    import termcolor
-except ImportError:
-    print("Module termcolor is not installed, text coloring disabled")
-    no_color = True
+_ = lambda s: s  # Placeholder for translation function
 
-gui = None
-verbose = False
+#: termcolor module, imported by the first colored message; False when it is not installed
+_termcolor = None
 
 
 def check_runtime_dependencies(application_name):
@@ -29,7 +36,7 @@ def check_runtime_dependencies(application_name):
     """
     result = "success"
 
-    system_commands = ["mount", "umount", "wipefs", "lsblk", "blockdev", "df", "parted", "7z"]
+    system_commands = ["mount", "umount", "wipefs", "lsblk", "blockdev", "parted", "7z"]
     for command in system_commands:
         if shutil.which(command) is None:
             print_with_color(
@@ -100,10 +107,11 @@ def check_runtime_parameters(install_mode, source_media, target_media):
     return 0
 
 
-def determine_target_parameters(install_mode, target_media):
+def determine_target_parameters(install_mode, target_media, verbose=False):
     """
     :param install_mode:
     :param target_media:
+    :param verbose: Print the device and partition found
     :return:
     """
     if install_mode == "partition":
@@ -114,7 +122,8 @@ def determine_target_parameters(install_mode, target_media):
         target_device = target_media
     else:
         target_device = target_media
-        target_partition = target_media + str(1)
+        # Partitions of devices whose name ends with a digit, e.g. mmcblk0 or nvme0n1, get a "p" before their number
+        target_partition = target_media + ("p1" if target_media[-1].isdigit() else "1")
 
     if verbose:
         print_with_color(_("Info: Target device is {0}").format(target_device))
@@ -128,13 +137,12 @@ def check_is_target_device_busy(device):
     :param device:
     :return:
     """
-    mount = subprocess.run("mount", stdout=subprocess.PIPE).stdout.decode("utf-8").strip()
-    if re.findall(device, mount) != []:
-        mounts = re.findall(rf'{device}\S*', mount)
-        print_with_color(_("Warning: The following partitions will be unmounted: {0}").format(mounts), "yellow")
-        for partition in mounts:
-            if subprocess.run(["umount", partition]).returncode:
-                return 1
+    mounted = mounts.find_mounts(device)
+    if mounted:
+        print_with_color(_("Warning: The following partitions will be unmounted: {0}").format(
+            [entry.source for entry in mounted]), "yellow")
+        if mounts.unmount_all(mounted):
+            return 1
     return 0
 
 
@@ -164,25 +172,28 @@ def check_source_and_target_not_busy(install_mode, source_media, target_device,
             return 1
 
 
-def check_fat32_filesize_limitation(source_fs_mountpoint):
+def check_fat32_filesize_limitation(source_manifest):
     """
-    :param source_fs_mountpoint:
+    :param source_manifest: manifest.SourceManifest of the source
     :return:
     """
-    for dirpath, dirnames, filenames in os.walk(source_fs_mountpoint):
-        for file in filenames:
-            path = os.path.join(dirpath, file)
-            if os.path.getsize(path) > (2 ** 32) - 1:  # Max fat32 file size
-                print_with_color(
-                    _(
-                        "Warning: File {0} in source image has exceed the FAT32 Filesystem 4GiB Single File Size Limitation, switching to NTFS filesystem.").format(
-                        path),
-                    "yellow")
-                print_with_color(
-                    _(
-                        "Refer: https://github.com/slacka/WoeUSB/wiki/Limitations#fat32-filesystem-4gib-single-file-size-limitation for more info."),
-                    "yellow")
-                return 1
+    for file in source_manifest.files_larger_than(wim.FAT32_MAX_FILE_SIZE):
+        if wim.needs_split(file.path, file.size) and wim.is_splittable(file.source):
+            print_with_color(
+                _("Info: File {0} in source image has exceed the FAT32 Filesystem 4GiB Single File Size Limitation, it will be split into .swm parts.").format(
+                    file.path))
+            continue
+
+        print_with_color(
+            _(
+                "Warning: File {0} in source image has exceed the FAT32 Filesystem 4GiB Single File Size Limitation, switching to NTFS filesystem.").format(
+                file.path),
+            "yellow")
+        print_with_color(
+            _(
+                "Refer: https://github.com/slacka/WoeUSB/wiki/Limitations#fat32-filesystem-4gib-single-file-size-limitation for more info."),
+            "yellow")
+        return 1
     return 0
 
 
@@ -196,10 +207,11 @@ def check_target_partition(target_partition, target_device):
 _uefi_ntfs_support_partition
     :return:
     """
-    target_filesystem = subprocess.run(["lsblk",
-                                        "--output", "FSTYPE",
-                                        "--noheadings",
-                                        target_partition], stdout=subprocess.PIPE).stdout.decode("utf-8").strip()
+    try:
+        target_filesystem = probe.probe(target_partition).fstype
+    except RuntimeError as e:
+        print_with_color(str(e), "red")
+        return 1
 
     if target_filesystem == "vfat":
         pass  # supported
@@ -220,12 +232,9 @@ def check_uefi_ntfs_support_partition(target_device):
     :param target_device: The UEFI:NTFS partition residing entire device file
     :return:
     """
-    lsblk = subprocess.run(["lsblk",
-                            "--output", "LABEL",
-                            "--noheadings",
-                            target_device], stdout=subprocess.PIPE).stdout.decode("utf-8").strip()
+    labels = [info.label for info in probe.probe(target_device).walk()]
 
-    if re.findall("UEFI_NTFS", lsblk) != []:
+    if "UEFI_NTFS" not in labels:
         print_with_color(
             _("Warning: Your device doesn't seem to have a UEFI:NTFS partition, "
               "UEFI booting will fail if the motherboard firmware itself doesn't support NTFS filesystem!"))
@@ -233,29 +242,20 @@ def check_uefi_ntfs_support_partition(target_device):
             _("Info: You may recreate disk with a UEFI:NTFS partition by using the --device creation method"))
 
 
-def check_target_filesystem_free_space(target_fs_mountpoint, source_fs_mountpoint, target_partition):
+def check_target_filesystem_free_space(target_fs_mountpoint, source_manifest, target_partition, split_wim=False):
     """
     :param target_fs_mountpoint:
-    :param source_fs_mountpoint:
+    :param source_manifest: manifest.SourceManifest of the source
     :param target_partition:
+    :param split_wim: Whether an install.wim too large for FAT32 is written as .swm parts
     :return:
     """
-    df = subprocess.run(["df",
-                         "--block-size=1",
-                         target_fs_mountpoint], stdout=subprocess.PIPE).stdout
-    # free_space = int(df.strip().split()[4])
-
-    awk = subprocess.Popen(["awk", "{print $4}"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    free_space = awk.communicate(input=df)[0]
-    free_space = free_space.decode("utf-8").strip()
-    free_space = re.sub("[^0-9]", "", free_space)
-    free_space = int(free_space)
+    free_space = probe.filesystem_free_space(target_fs_mountpoint)
 
-    needed_space = 0
-    for dirpath, dirnames, filenames in os.walk(source_fs_mountpoint):
-        for file in filenames:
-            path = os.path.join(dirpath, file)
-            needed_space += os.path.getsize(path)
+    # Every file and directory takes whole clusters of the filesystem actually on the partition
+    filesystem_type = "NTFS" if probe.probe(target_partition).fstype == "ntfs" else "FAT"
+    needed_space = space.plan_space(source_manifest, filesystem_type,
+                                    space.filesystem_cluster_size(target_fs_mountpoint), split_wim).allocated_size
 
     additional_space_required_for_grub_installation = 1000 * 1000 * 10  # 10MiB
 
@@ -274,25 +274,348 @@ def check_target_filesystem_free_space(target_fs_mountpoint, source_fs_mountpoin
         return 1
 
 
+def check_target_device_size(source_manifest, target_device, filesystem_type, split_wim=False, verbose=False):
+    """
+    Check that the partition --device creates will hold the source, before anything is written to the device
+
+    :param source_manifest: manifest.SourceManifest of the source
+    :param target_device: The target device
+    :param filesystem_type: "FAT" or "NTFS"
+    :param split_wim: Whether an install.wim too large for FAT32 is written as .swm parts
+    :param verbose: Print the size needed and the size available
+    """
+    # Same layout as create_partition: starts at 4MiB, the last 1024 sectors are left to UEFI:NTFS with NTFS
+    partition_size = probe.probe(target_device).size - 4 * 1024 * 1024 - 512
+    if filesystem_type == "NTFS":
+        partition_size -= 1024 * 512
+
+    needed_size = space.minimum_partition_size(source_manifest, filesystem_type, split_wim)
+    if needed_size > partition_size:
+        raise RuntimeError(_("Error: {0} is too small, the source needs a {1} partition but only {2} is available")
+                           .format(target_device, convert_to_human_readable_format(needed_size),
+                                   convert_to_human_readable_format(max(partition_size, 0))))
+
+    if verbose:
+        print_with_color(_("Info: The source needs a partition of at least {0}, the target partition will be {1}")
+                         .format(convert_to_human_readable_format(needed_size),
+                                 convert_to_human_readable_format(partition_size)))
+
+
+def wipe_target_device(target_device):
+    """
+    Wipe all existing partition table and filesystem signatures of the target device
+
+    :param target_device: The target device
+    """
+    print_with_color(_("Wiping all existing partition table and filesystem signatures in {0}...").format(
+        target_device), "green")
+
+    if trace.run(["wipefs", "--all", target_device]).returncode != 0:
+        raise RuntimeError(_("Error: Unable to wipe {0}").format(target_device))
+    probe.invalidate(target_device)
+
+    if probe.probe_device(target_device).children:
+        raise RuntimeError(_("Error: Partition is still detected after wiping all signatures, this indicates that "
+                             "the drive might be locked into readonly mode due to end of lifespan."))
+
+
+def discard_target_device(target_device, should_stop=None, verbose=False):
+    """
+    Discard the blocks the new partitions will use, so the flash controller writes them as fresh blocks
+
+    The first 4MiB holding the partition table and the post-MBR gap are left to wipefs, parted and grub.
+
+    :param target_device: The target device
+    :param should_stop: Callable polled between two discards, the job is cancelled when it returns True
+    :param verbose: Print how much was discarded
+    :return: Whether the device was discarded, False when it doesn't support discard
+    """
+    if not discard.supports_discard(target_device):
+        print_with_color(_("Warning: {0} doesn't support discard, skipping it").format(target_device), "yellow")
+        return False
+
+    print_with_color(_("Discarding the blocks of {0}...").format(target_device), "green")
+
+    with trace.span("discard", device=target_device) as span:
+        discarded = discard.discard(target_device, start=4 * 1024 * 1024,
+                                    should_stop=should_stop)
+        span.set(bytes=discarded)
+    check_kill_signal(should_stop)
+
+    if verbose:
+        print_with_color(_("Info: Discarded {0}").format(convert_to_human_readable_format(discarded)))
+    return True
+
+
+def create_partition_table(target_device, partition_table_type):
+    """
+    :param target_device: The target device
+    :param partition_table_type: "legacy"/"msdos"/"mbr"/"pc", GUID partition table is not supported yet
+    """
+    print_with_color(_("Creating new partition table on {0}...").format(target_device), "green")
+
+    if partition_table_type in ["legacy", "msdos", "mbr", "pc"]:
+        parted_partition_table_argument = "msdos"
+    elif partition_table_type in ["gpt", "guid"]:
+        raise RuntimeError(_("Error: Currently GUID partition table is not supported."))
+    else:
+        raise RuntimeError(_("Error: Partition table not supported."))
+
+    # Create partition table(and overwrite the old one, whatever it was)
+    trace.run(["parted", "--script", target_device, "mklabel", parted_partition_table_argument], check=True)
+    probe.invalidate(target_device)
+
+
+def create_partition(target_device, target_partition, filesystem_type, filesystem_label, command_mkdosfs,
+                     command_mkntfs, create_filesystem=True):
+    """
+    Create the partition holding Windows files and its filesystem
+
+    :param target_device: The target device
+    :param target_partition: The partition to create
+    :param filesystem_type: "FAT" or "NTFS"
+    :param filesystem_label: Label of the new filesystem
+    :param command_mkdosfs: mkdosfs command found by check_runtime_dependencies
+    :param command_mkntfs: mkntfs command found by check_runtime_dependencies
+    :param create_filesystem: Leave the partition unformatted when False, write_fat32_filesystem fills it later
+    :return: Device node of the new partition, as the kernel named it
+    """
+    if filesystem_type in ["FAT", "vfat"]:
+        parted_mkpart_fs_type = "fat32"
+    elif filesystem_type in ["NTFS", "ntfs"]:
+        parted_mkpart_fs_type = "ntfs"
+    else:
+        raise RuntimeError(_("Error: Filesystem not supported"))
+
+    print_with_color(_("Creating target partition..."), "green")
+
+    # We start at 4MiB for grub (it needs a post-mbr gap for its code) and alignment of flash memory block erase
+    # segment in general. With NTFS we leave 512KiB (1024 512-byte sectors) at the end for the UEFI:NTFS partition.
+    # NOTE: Microsoft Windows only recognizes the first partition of removable storage devices,
+    # that's why this partition should always be the first one
+    if parted_mkpart_fs_type == "fat32":
+        end = "-1s"
+    else:
+        end = "-1025s"
+    trace.run(["parted", "--script", target_device, "mkpart", "primary", parted_mkpart_fs_type,
+               "4MiB", "--", end], check=True)
+
+    target_partition = workaround.make_system_realize_partition_table_changed(target_device, [1])[0]
+    probe.invalidate(target_device)
+
+    if not create_filesystem:
+        return target_partition
+
+    if parted_mkpart_fs_type == "fat32":
+        command = [command_mkdosfs, "-F", "32", "-n", filesystem_label[:11], target_partition]
+    else:
+        command = [command_mkntfs, "--quick", "--label", filesystem_label, target_partition]
+
+    returncode = trace.run(command).returncode
+    probe.invalidate(target_device)
+    if returncode != 0:
+        raise RuntimeError(_("Error: Unable to create filesystem on {0}").format(target_partition))
+
+    return target_partition
+
+
+def create_uefi_ntfs_support_partition(target_device):
+    """
+    Create the small partition at the end of the device holding the UEFI:NTFS bootloader
+
+    :param target_device: The target device
+    """
+    trace.run(["parted", "--script", target_device, "mkpart", "primary", "fat16", "--", "-1024s", "-1s"],
+              check=True)
+
+    workaround.make_system_realize_partition_table_changed(target_device, [1, 2])
+    probe.invalidate(target_device)
+
+
+def install_uefi_ntfs_support_partition(target_device, uefi_ntfs_image=None):
+    """
+    Write the UEFI:NTFS bootloader to the second partition of the device
+
+    :param target_device: The target device
+    :param uefi_ntfs_image: Path of a local uefi-ntfs.img to add to the cache and use, the cached image
+                            is used when None and downloaded only when there is none
+    """
+    uefi_ntfs_partition = workaround.find_partition_device_nodes(target_device, [2])[0]
+    if uefi_ntfs_partition is None:
+        raise RuntimeError(_("Error: The UEFI:NTFS partition of {0} is missing").format(target_device))
+
+    try:
+        image = uefi_ntfs.get_image(uefi_ntfs_image)
+    except uefi_ntfs.UefiNtfsImageError as e:
+        # An image given on the command line must be used, otherwise the target is still usable without it
+        if uefi_ntfs_image is not None:
+            raise
+        print_with_color(str(e), "yellow")
+        print_with_color(_("Warning: Unable to get the UEFI:NTFS partition image, installation skipped. Target "
+                           "device might not be bootable if the UEFI firmware doesn't support NTFS filesystem. "
+                           "Use --uefi-ntfs-image to provide a local copy."), "yellow")
+        return
+
+    print_with_color(_("Installing UEFI:NTFS support partition..."), "green")
+    uefi_ntfs.write_image(image, uefi_ntfs_partition)
+
+
+def mount(source, mountpoint):
+    """
+    Mount a block device or a disk image, creating the mountpoint if needed
+
+    :param source: Block device or disk image (mounted read-only through a loop device)
+    :param mountpoint: Where to mount it
+    """
+    try:
+        os.makedirs(mountpoint, exist_ok=True)
+    except OSError:
+        raise RuntimeError(_("Error: Unable to create {0} mountpoint directory").format(mountpoint))
+
+    if os.path.isfile(source):
+        command = ["mount", "--options", "loop,ro", "--types", "udf,iso9660", source, mountpoint]
+    else:
+        command = ["mount", source, mountpoint]
+
+    if trace.run(command).returncode != 0:
+        raise RuntimeError(_("Error: Unable to mount {0}").format(source))
+
+
+def unmount(mountpoint):
+    """
+    Unmount a filesystem and remove its mountpoint
+
+    :param mountpoint: Where the filesystem is mounted
+    """
+    if trace.run(["umount", mountpoint]).returncode != 0:
+        raise RuntimeError(_("Warning: Unable to unmount filesystem."))
+
+    os.rmdir(mountpoint)
+
+
+def report_progress(report, target=None):
+    """
+    Publish a copy progress report on the event bus
+
+    :param report: progress.ProgressReport
+    :param target: Target the report is about when several are written at once
+    """
+    event = events.Progress(report, target)
+    if not events.publish(event):
+        _print_unsubscribed(event)
+
+
 def print_with_color(text, color=""):
     """
-    Print function
-    This function takes into account no_color flag
-    Also if used by gui, sends information to it, rather than putting it into standard output
+    Publish a message on the event bus, the subscribers print it, show it in the gui or log it
+    Without any subscriber, e.g. when the engine is used as a library, it is printed right away
 
     :param text: Text to be printed
-    :param color: Color of the text
+    :param color: Color of the text, "red" for errors and "yellow" for warnings
     """
-    if gui is not None:
-        gui.state = text
-        if color == "red":
-            gui.error = text
-            sys.exit()
-    else:
-        if no_color or color == "":
-            sys.stdout.write(text + "\n")
+    event = events.Message(text, {"red": "error", "yellow": "warning"}.get(color, "info"), color)
+    if not events.publish(event):
+        _print_unsubscribed(event)
+
+
+def _import_termcolor():
+    """
+    :return: termcolor module, None when it is not installed
+    """
+    global _termcolor
+    if _termcolor is None:
+        try:
+            import termcolor
+            _termcolor = termcolor
+        except ImportError:
+            print("Module termcolor is not installed, text coloring disabled")
+            _termcolor = False
+    return _termcolor or None
+
+
+def print_event(event, progress_format="text", no_color=False):
+    """
+    Console subscriber: messages in color, progress on a single line according to progress_format
+    This function takes into account no_color flag
+
+    :param event: events.Event
+    :param progress_format: "text" to print progress, "none" to only print messages
+    :param no_color: Print messages without color, set by --no-color
+    """
+    if isinstance(event, events.Message):
+        termcolor = None if no_color or event.color == "" else _import_termcolor()
+        if termcolor is None:
+            sys.stdout.write(event.text + "\n")
         else:
-            termcolor.cprint(text, color)
+            termcolor.cprint(event.text, event.color)
+        sys.stdout.flush()
+    elif isinstance(event, events.Progress) and progress_format == "text":
+        report = event.report
+        text = _("Copying files: {0} of {1}, {2}/s, {3} remaining").format(
+            convert_to_human_readable_format(report.bytes_done),
+            convert_to_human_readable_format(report.bytes_total),
+            convert_to_human_readable_format(report.throughput),
+            progress.format_duration(report.eta))
+        if event.target is not None:
+            text = event.target + ": " + text
+
+        if sys.stdout.isatty():
+            sys.stdout.write("\r\033[K{0:5.1f}% {1}".format(report.percent, text) + ("\n" if report.finished else ""))
+            sys.stdout.flush()
+        elif report.finished:
+            sys.stdout.write(text + "\n")
+
+
+def event_as_dict(event):
+    """
+    :param event: events.Event
+    :return: Dictionary the JSON logger and the daemon write for the event, None for events they don't report
+    """
+    if isinstance(event, events.Progress):
+        line = event.report.as_dict()
+        if event.target is not None:
+            line["target"] = event.target
+    elif isinstance(event, events.Message):
+        line = {"event": "message", "level": event.level, "text": event.text}
+    elif isinstance(event, events.PhaseChanged):
+        line = {"event": "phase", "phase": event.phase}
+    else:
+        return None
+    if event.job is not None:
+        line["job"] = event.job
+    return line
+
+
+def log_event_json(event):
+    """
+    JSON subscriber for --progress json: one NDJSON line per event on standard output
+
+    :param event: events.Event
+    """
+    line = event_as_dict(event)
+    if line is None:
+        return
+
+    sys.stdout.write(progress.json_line(line))
+    sys.stdout.flush()
+
+
+def _print_unsubscribed(event):
+    print_event(event)
+
+
+def subscribe_output(progress_format="text", no_color=False):
+    """
+    Subscribe the console printer, or the JSON logger with --progress json, to the event bus
+
+    :param progress_format: How copy progress and messages are written to standard output: "text", "json"
+                            (NDJSON) or "none", set by --progress
+    :param no_color: Print messages without color, set by --no-color
+    :return: events.Subscriber, to unsubscribe once the job is over so everything is printed before exiting
+    """
+    if progress_format == "json":
+        return events.bus.subscribe(log_event_json)
+    return events.bus.subscribe(functools.partial(print_event, progress_format=progress_format, no_color=no_color))
 
 
 def convert_to_human_readable_format(num, suffix='B'):
@@ -304,26 +627,341 @@ def convert_to_human_readable_format(num, suffix='B'):
 
 
 def get_size(path):
-    total_size = 0
-    for dirpath, __, filenames in os.walk(path):
-        for file in filenames:
-            path = os.path.join(dirpath, file)
-            total_size += os.path.getsize(path)
-    return total_size
+    return manifest.scan_directory(path).total_size
 
 
-def check_kill_signal():
+def parse_size(text):
+    """
+    Parse a size given on the command line, e.g. "4M" or "512K"
+
+    :param text: Number of bytes, optionally followed by a K, M or G binary suffix
+    :return: Size in bytes
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+    text = text.strip().upper().rstrip("IB")
+    if text and text[-1] in units:
+        return int(text[:-1]) * units[text[-1]]
+    return int(text)
+
+
+def copy_files(source_manifest, target_fs_mountpoint, workers=copy_engine.DEFAULT_COPY_WORKERS,
+               buffer_size=copy_engine.DEFAULT_BUFFER_SIZE, split_wim=False, verify_files=False, job_journal=None,
+               dirty_limit=None, should_stop=None):
+    """
+    Copy all files from source filesystem to target filesystem
+
+    :param source_manifest: manifest.SourceManifest of a mounted source or of a disc image read without mounting
+    :param target_fs_mountpoint: Where target filesystem is mounted
+    :param workers: Number of files copied concurrently
+    :param buffer_size: Size in bytes of a single read/write
+    :param split_wim: Split an install.wim too large for FAT32 into .swm parts
+    :param verify_files: Read every file back from the target as soon as it is written and compare it
+                         with the hash computed while copying
+    :param job_journal: journal.Journal recording every completed file, for --resume
+    :param dirty_limit: Most bytes written to the target but not yet on the device, None to leave it to the kernel
+    :param should_stop: Callable polled between chunks, the job is cancelled when it returns True
+    """
+    print_with_color(_("Copying files from source media..."), "green")
+
+    # Reports come from the copy workers, they are published for the job that started the copy
+    tracker = progress.ProgressTracker(source_manifest.total_size, events.bind(report_progress))
+
+    verifier = None
+    if verify_files:
+        verifier = verify.Verifier(buffer_size=buffer_size)
+
+    on_file_copied = []
+    if verifier is not None:
+        on_file_copied.append(verifier.submit)
+    if job_journal is not None:
+        on_file_copied.append(job_journal.record)
+
+    def file_copied(target, size, digest):
+        for callback in on_file_copied:
+            callback(target, size, digest)
+
+    engine = copy_engine.CopyEngine(workers, buffer_size,
+                                    should_stop=should_stop,
+                                    split_wim=split_wim,
+                                    on_progress=tracker.add,
+                                    hash_algorithm=verify.DEFAULT_HASH_ALGORITHM if on_file_copied else None,
+                                    on_file_copied=file_copied if on_file_copied else None,
+                                    dirty_limit=dirty_limit)
+    try:
+        with trace.span("copy", files=len(source_manifest), bytes=source_manifest.total_size, workers=workers):
+            engine.copy_manifest(source_manifest, target_fs_mountpoint)
+
+        if not engine.cancelled:
+            tracker.finish()
+            if verifier is not None:
+                print_with_color(_("Verifying written files..."), "green")
+    finally:
+        # Files were verified in the background while the copy went on, wait for the last ones whatever happened
+        with trace.span("verify") as span:
+            mismatches = verifier.wait() if verifier is not None else []
+            span.set(files=verifier.verified if verifier is not None else 0)
+
+    check_kill_signal(should_stop)
+
+    if verifier is not None:
+        for mismatch in mismatches:
+            print_with_color(_("Warning: {0} does not match the source: {1}").format(
+                os.path.relpath(mismatch.path, target_fs_mountpoint), mismatch.reason), "yellow")
+        if mismatches:
+            raise RuntimeError(_("Error: Verification failed for {0} of {1} files").format(
+                len(mismatches), verifier.verified))
+        print_with_color(_("Verification passed: {0} files").format(verifier.verified), "green")
+
+
+def plan_resume(source_manifest, target_fs_mountpoint, job_journal, split_wim=False,
+                buffer_size=copy_engine.DEFAULT_BUFFER_SIZE):
+    """
+    Find the files of an interrupted job that are already on the target and correct
+
+    Journaled files are read back from the device and hashed, a file is skipped only when all of it
+    (every part of a split WIM) matches its journal record.
+
+    :param source_manifest: manifest.SourceManifest of the source
+    :param target_fs_mountpoint: Where target filesystem is mounted
+    :param job_journal: journal.Journal of the interrupted job
+    :param split_wim: Whether an install.wim too large for FAT32 is split into .swm parts
+    :param buffer_size: Size in bytes of a single read
+    :return: manifest.SourceManifest of the files left to copy
+    """
+    print_with_color(_("Checking files already written to the target..."), "green")
+
+    verifier = verify.Verifier(buffer_size=buffer_size, hash_algorithm=job_journal.header["hash"])
+
+    candidates = []
+    for file in source_manifest.files:
+        paths = journal.target_paths(file, split_wim)
+        records = [job_journal.records.get(path) for path in paths]
+        if None in records or (len(paths) == 1 and records[0][0] != file.size):
+            continue
+
+        candidates.append((file, paths))
+        for path, (size, digest) in zip(paths, records):
+            verifier.submit(os.path.join(target_fs_mountpoint, path), size, digest)
+
+    with trace.span("resume_check", files=len(candidates)):
+        mismatches = set(os.path.relpath(mismatch.path, target_fs_mountpoint) for mismatch in verifier.wait())
+    done = set(file.path for file, paths in candidates if mismatches.isdisjoint(paths))
+
+    remaining = manifest.SourceManifest(source_manifest.root, source_manifest.directories,
+                                        [file for file in source_manifest.files if file.path not in done])
+
+    print_with_color(_("Resuming: {0} of {1} files ({2}) are already on the target, {3} left to copy").format(
+        len(source_manifest) - len(remaining), len(source_manifest),
+        convert_to_human_readable_format(source_manifest.total_size - remaining.total_size),
+        convert_to_human_readable_format(remaining.total_size)), "green")
+
+    return remaining
+
+
+def check_resume_target(install_mode, target_device, target_partition, filesystem_type):
+    """
+    Check that the target still has the layout an interrupted job created, before resuming it
+
+    :param install_mode: "device" or "partition"
+    :param target_device: The target device
+    :param target_partition: The partition holding Windows files
+    :param filesystem_type: "FAT" or "NTFS"
+    """
+    expected_filesystem = {"FAT": "vfat", "NTFS": "ntfs"}[filesystem_type]
+
+    target_filesystem = probe.probe(target_partition).fstype
+    if target_filesystem != expected_filesystem:
+        raise RuntimeError(_("Error: Can't resume, {0} holds {1} instead of {2}").format(
+            target_partition, target_filesystem or _("no filesystem"), expected_filesystem))
+
+    if install_mode != "device":
+        return
+
+    # --device jobs always start the partition at 4MiB, anything else was partitioned by someone else since
+    if probe.probe(target_partition).start not in (None, 4 * 1024 * 1024):
+        raise RuntimeError(_("Error: Can't resume, the partition layout of {0} has changed").format(target_device))
+
+    if filesystem_type == "NTFS" and workaround.find_partition_device_nodes(target_device, [2])[0] is None:
+        raise RuntimeError(_("Error: Can't resume, the UEFI:NTFS partition of {0} is missing").format(target_device))
+
+
+def open_job_journal(target_fs_mountpoint, source_manifest, filesystem_type, split_wim, resume=False,
+                     buffer_size=copy_engine.DEFAULT_BUFFER_SIZE):
+    """
+    Start the journal of a new job on the target, or reopen the one of the interrupted job with --resume
+
+    :param target_fs_mountpoint: Where target filesystem is mounted
+    :param source_manifest: manifest.SourceManifest of the source
+    :param filesystem_type: "FAT" or "NTFS"
+    :param split_wim: Whether an install.wim too large for FAT32 is split into .swm parts
+    :param resume: Reopen the journal and skip the files it proves are already written
+    :param buffer_size: Size in bytes of a single read
+    :return: (journal.Journal, manifest.SourceManifest of the files to copy)
+    """
+    header = journal.job_header(source_manifest, filesystem_type, split_wim, verify.DEFAULT_HASH_ALGORITHM)
+
+    if not resume:
+        return journal.Journal.create(target_fs_mountpoint, header), source_manifest
+
+    job_journal = journal.Journal.load(target_fs_mountpoint, header)
+    try:
+        return job_journal, plan_resume(source_manifest, target_fs_mountpoint, job_journal, split_wim, buffer_size)
+    except BaseException:
+        job_journal.close()
+        raise
+
+
+def refresh_target(source_manifest, target_fs_mountpoint, split_wim=False,
+                   buffer_size=copy_engine.DEFAULT_BUFFER_SIZE):
+    """
+    Compare a new source with what an earlier job left on the target, and delete what the new source replaces
+
+    :param source_manifest: manifest.SourceManifest of the new source
+    :param target_fs_mountpoint: Where target filesystem is mounted
+    :param split_wim: Whether an install.wim too large for FAT32 is split into .swm parts
+    :param buffer_size: Size in bytes of a single read
+    :return: manifest.SourceManifest of the files left to copy
+    """
+    print_with_color(_("Comparing the source with the files already on the target..."), "green")
+
+    with trace.span("refresh_plan", files=len(source_manifest)) as span:
+        plan = refresh.plan_refresh(source_manifest, target_fs_mountpoint, split_wim, buffer_size=buffer_size)
+        span.set(changed=len(plan.changed), obsolete=len(plan.obsolete))
+    with trace.span("refresh_delete", files=len(plan.obsolete) + len(plan.replaced)):
+        refresh.apply_deletions(plan, target_fs_mountpoint)
+
+    files_to_copy = plan.files_to_copy
+    print_with_color(_("Refreshing: {0} of {1} files are unchanged, {2} files ({3}) to write, "
+                       "{4} obsolete files deleted").format(
+        len(plan.unchanged), len(source_manifest), len(files_to_copy),
+        convert_to_human_readable_format(files_to_copy.total_size), len(plan.obsolete)), "green")
+
+    return files_to_copy
+
+
+def fan_out_copy_files(source_manifest, targets, buffer_size=copy_engine.DEFAULT_BUFFER_SIZE, split_wim=False,
+                       dirty_limit=None, should_stop=None):
+    """
+    Copy all files from source filesystem to several target filesystems at once, reading the source only once
+
+    :param source_manifest: manifest.SourceManifest of a mounted source or of a disc image read without mounting
+    :param targets: List of (target device, where its filesystem is mounted)
+    :param buffer_size: Size in bytes of a single read/write
+    :param split_wim: Split an install.wim too large for FAT32 into .swm parts
+    :param dirty_limit: Most bytes written to each target but not yet on the device, None to leave it to the kernel
+    :param should_stop: Callable polled between chunks, the job is cancelled when it returns True
+    :return: Dictionary of target device to the exception that stopped the copy to it, None for complete copies
+    """
+    print_with_color(_("Copying files from source media to {0} targets...").format(len(targets)), "green")
+
+    trackers = {}
+    fan_out_targets = []
+    for target_device, target_fs_mountpoint in targets:
+        tracker = progress.ProgressTracker(source_manifest.total_size,
+                                           events.bind(lambda report, target_device=target_device:
+                                                       report_progress(report, target_device)))
+        trackers[target_device] = tracker
+        fan_out_targets.append(fanout.FanOutTarget(target_device, target_fs_mountpoint, tracker.add))
+
+    copier = fanout.FanOut(fan_out_targets, buffer_size,
+                           split_wim=split_wim,
+                           should_stop=should_stop,
+                           dirty_limit=dirty_limit)
+    with trace.span("fan_out_copy", files=len(source_manifest), bytes=source_manifest.total_size,
+                    targets=len(targets)):
+        copier.copy_manifest(source_manifest)
+
+    check_kill_signal(should_stop)
+
+    results = {}
+    for target in fan_out_targets:
+        results[target.name] = target.error
+        if target.error is None:
+            trackers[target.name].finish()
+        else:
+            print_with_color(_("Error: Copying to {0} failed: {1}").format(target.name, target.error), "red")
+
+    return results
+
+
+def write_fat32_filesystem(source_manifest, target_partition, filesystem_label,
+                           buffer_size=copy_engine.DEFAULT_BUFFER_SIZE, split_wim=True, should_stop=None):
+    """
+    Build a FAT32 filesystem holding all files of the source and write it to the partition in one sequential pass,
+    the partition is neither formatted nor mounted
+
+    :param source_manifest: manifest.SourceManifest of a mounted source or of a disc image read without mounting
+    :param target_partition: The unformatted target partition
+    :param filesystem_label: Label of the new filesystem
+    :param buffer_size: Size in bytes of a single read/write
+    :param split_wim: Split an install.wim too large for FAT32 into .swm parts
+    :param should_stop: Callable polled between chunks, the job is cancelled when it returns True
+    """
+    print_with_color(_("Writing FAT32 filesystem to {0}...").format(target_partition), "green")
+
+    tracker = progress.ProgressTracker(source_manifest.total_size, events.bind(report_progress))
+
+    fd = os.open(target_partition, os.O_WRONLY)
+    try:
+        with trace.span("write_fat32", files=len(source_manifest), bytes=source_manifest.total_size):
+            completed = fat32.write_volume(fd, source_manifest, filesystem_label,
+                                           partition_offset=get_partition_offset(target_partition),
+                                           split_wim=split_wim,
+                                           buffer_size=buffer_size,
+                                           should_stop=should_stop,
+                                           on_progress=tracker.add)
+        if completed:
+            # Only this partition is flushed, not every filesystem of the host
+            with trace.span("sync", partition=target_partition):
+                os.fsync(fd)
+    finally:
+        os.close(fd)
+        probe.invalidate(target_partition)
+
+    if completed:
+        tracker.finish()
+
+    check_kill_signal(should_stop)
+
+
+def get_partition_offset(partition):
+    """
+    :param partition: Device node of a partition
+    :return: Offset of the partition on its device in bytes, 0 when sysfs doesn't know it
+    """
+    name = os.path.basename(os.path.realpath(partition))
+    try:
+        with open(os.path.join(probe.SYSFS_CLASS_BLOCK, name, "start")) as start:
+            # sysfs counts 512-byte sectors whatever the logical sector size of the device
+            return int(start.read()) * 512
+    except (OSError, ValueError):
+        return 0
+
+
+def update_partition_info(target_device, target_partition):
+    """
+    Make the kernel re-read the partition table of the finished device
+
+    :param target_device: The target device
+    :param target_partition: The partition holding Windows files
+    """
+    workaround.make_system_realize_partition_table_changed(target_device, [1])
+
+
+def check_kill_signal(should_stop=None):
     """
     Ok, you may asking yourself, what the f**k is this, and why is it called everywhere. Let me explain
     In python you can't just stop or kill thread, it must end its execution,
     or recognize moment where you want it to stop and politely perform euthanasia on itself.
-    So, here, if gui is set, we throw an exception which is going to be (hopefully) caught by GUI,
+    So, here, if the job was cancelled, we throw an exception which is going to be (hopefully) caught by core.Job,
     simultaneously ending whatever script was doing meantime!
-    Everyone goes home happy and the user is left with a wrecked pendrive (just joking, next thing called by gui is cleanup)
+    Everyone goes home happy and the user is left with a wrecked pendrive (just joking, next thing called is cleanup)
+
+    :param should_stop: Callable returning True once the job is cancelled
     """
-    if gui is not None:
-        if gui.kill:
-            raise sys.exit()
+    if should_stop is not None and should_stop():
+        raise sys.exit()
 
 
 # noinspection DuplicatedCode
@@ -333,6 +971,8 @@ def update_policy_to_allow_for_running_gui_as_root(path):
 
     :param path: Path to the GUI executable
     """
+    from xml.dom.minidom import parseString
+
     dom = parseString(
         "<?xml version=\"1.0\" ?>"
         "<!DOCTYPE policyconfig  PUBLIC '-//freedesktop//DTD polkit Policy Configuration 1.0//EN'  "
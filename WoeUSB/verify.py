@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Post-write verification
+
+Source files are hashed while they are being copied: the copy engine feeds every chunk it writes into a hash,
+so the source is never read twice. As soon as a file is closed it is queued here and read back from the target
+by a pool of threads, while the copy of the other files goes on. Reading back through the page cache would
+only confirm the cached copy, so the target is opened with O_DIRECT, which makes the kernel write the dirty pages
+out and read the device. Where the filesystem doesn't support O_DIRECT the file is flushed and dropped from
+the page cache before it is read instead.
+"""
+
+import concurrent.futures
+import errno
+import hashlib
+import mmap
+import os
+import threading
+
+#: Hash used for the source and the target, hashlib releases the GIL while hashing so the pool scales
+DEFAULT_HASH_ALGORITHM = "sha256"
+
+#: Number of files read back concurrently
+DEFAULT_VERIFY_WORKERS = 4
+
+_ALIGNMENT = mmap.PAGESIZE
+
+
+class Mismatch:
+    """
+    A target file that doesn't match what was written
+    """
+    __slots__ = ("path", "reason")
+
+    def __init__(self, path, reason):
+        """
+        :param path: Path of the target file
+        :param reason: Human readable description of the difference
+        """
+        self.path = path
+        self.reason = reason
+
+
+class Verifier:
+    """
+    Reads written files back from the target and compares them to the hash of the source, in a thread pool
+    """
+
+    def __init__(self, workers=DEFAULT_VERIFY_WORKERS, buffer_size=4 * 1024 * 1024,
+                 hash_algorithm=DEFAULT_HASH_ALGORITHM):
+        """
+        :param workers: Number of files read back concurrently
+        :param buffer_size: Size in bytes of a single read, rounded up to the page size for O_DIRECT
+        :param hash_algorithm: hashlib name of the hash the source was hashed with
+        """
+        self.buffer_size = -(-buffer_size // _ALIGNMENT) * _ALIGNMENT
+        self.hash_algorithm = hash_algorithm
+
+        #: Number of files verified so far
+        self.verified = 0
+
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify")
+        self.__futures = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def submit(self, path, size, digest):
+        """
+        Queue a written file for verification, meant to be the on_file_copied callback of the copy engine
+
+        :param path: Path of the target file
+        :param size: Number of bytes written
+        :param digest: Hex digest of the bytes written
+        """
+        future = self.__executor.submit(self.verify_file, path, size, digest)
+        with self.__lock:
+            self.__futures.append(future)
+
+    def wait(self):
+        """
+        Wait until every queued file is verified
+
+        :return: List of Mismatch, sorted by path
+        """
+        self.__executor.shutdown(wait=True)
+
+        mismatches = [future.result() for future in self.__futures]
+        return sorted((mismatch for mismatch in mismatches if mismatch is not None), key=lambda item: item.path)
+
+    def verify_file(self, path, size, digest):
+        """
+        :return: Mismatch, or None when the target file matches
+        """
+        buffer = getattr(self.__local, "buffer", None)
+        if buffer is None:
+            # Anonymous mappings are page aligned, as O_DIRECT requires
+            buffer = self.__local.buffer = mmap.mmap(-1, self.buffer_size)
+
+        try:
+            target_size, target_digest = read_digest(path, self.hash_algorithm, buffer)
+        except OSError as e:
+            return Mismatch(path, f"unreadable: {e.strerror}")
+        finally:
+            with self.__lock:
+                self.verified += 1
+
+        if target_size != size:
+            return Mismatch(path, f"{target_size} bytes instead of {size}")
+        if target_digest != digest:
+            return Mismatch(path, "content differs")
+        return None
+
+
+def read_digest(path, hash_algorithm, buffer):
+    """
+    Hash a file as stored on the device rather than as cached in memory
+
+    :param path: File to read
+    :param hash_algorithm: hashlib name of the hash
+    :param buffer: Page aligned buffer, e.g. an anonymous mmap
+    :return: (size, hex digest)
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        return _read_digest_uncached(path, hash_algorithm, buffer)
+
+    try:
+        return _hash_fd(fd, hash_algorithm, buffer)
+    except OSError as e:
+        # Some filesystems accept O_DIRECT on open but not on read
+        if e.errno != errno.EINVAL:
+            raise
+    finally:
+        os.close(fd)
+
+    return _read_digest_uncached(path, hash_algorithm, buffer)
+
+
+def _read_digest_uncached(path, hash_algorithm, buffer):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # Only clean pages can be dropped, write the file out first
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return _hash_fd(fd, hash_algorithm, buffer)
+    finally:
+        os.close(fd)
+
+
+def _hash_fd(fd, hash_algorithm, buffer):
+    hasher = hashlib.new(hash_algorithm)
+    view = memoryview(buffer)
+    size = 0
+    try:
+        while True:
+            length = os.readv(fd, [view])
+            if length == 0:
+                break
+            hasher.update(view[:length])
+            size += length
+            # A short read is the end of the file, reading on from an unaligned offset would fail with O_DIRECT
+            if length < len(view):
+                break
+    finally:
+        view.release()
+    return size, hasher.hexdigest()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""
+Streaming WIM splitter
+
+Recent Windows images ship an install.wim larger than the 4GiB FAT32 single file size limitation.
+Instead of switching the whole target to NTFS, the image is split into install.swm, install2.swm, ... parts,
+which Windows Setup accepts in place of install.wim. Resources are copied verbatim (still compressed)
+from the source straight into the parts on the target, there is no temporary copy and no recompression.
+"""
+
+import hashlib
+import os
+import struct
+
+#: Largest file FAT32 can store
+FAT32_MAX_FILE_SIZE = (2 ** 32) - 1
+
+#: Largest part written, leaves some headroom below FAT32_MAX_FILE_SIZE
+SWM_PART_SIZE = 4000 * 1024 * 1024
+
+#: The only WIM Windows Setup accepts in split form, relative to the root of the source
+SPLITTABLE_WIM = os.path.join("sources", "install.wim")
+
+_HEADER_SIZE = 208
+_BLOB_ENTRY_SIZE = 50
+
+_HEADER_FLAG_SPANNED = 0x00000008
+
+_RESOURCE_FLAG_METADATA = 0x02
+_RESOURCE_FLAG_COMPRESSED = 0x04
+_RESOURCE_FLAG_SOLID = 0x10
+
+_BLOB_TABLE = 48
+_XML_DATA = 72
+_BOOT_METADATA = 96
+_INTEGRITY_TABLE = 124
+
+
+class WimError(RuntimeError):
+    """
+    Raised when a WIM file can't be split by this module
+    """
+
+
+class Resource:
+    """
+    A resource header (reshdr_disk): where a blob lives in the WIM file
+    """
+    __slots__ = ("size", "flags", "offset", "original_size")
+
+    def __init__(self, size, flags, offset, original_size):
+        self.size = size
+        self.flags = flags
+        self.offset = offset
+        self.original_size = original_size
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        size_and_flags, resource_offset, original_size = struct.unpack_from("<QQQ", data, offset)
+        return cls(size_and_flags & 0x00FFFFFFFFFFFFFF, size_and_flags >> 56, resource_offset, original_size)
+
+    def pack(self):
+        return struct.pack("<QQQ", self.size | (self.flags << 56), self.offset, self.original_size)
+
+
+class WimSource:
+    """
+    Random access to the WIM being split: a path, or an image_reader.ImageFile served from a disc image
+    """
+
+    def __init__(self, source, buffer_size):
+        self.source = source
+        self.buffer_size = buffer_size
+        self.__fd = None
+        self.__buffer = None
+
+        if isinstance(source, str):
+            self.__fd = os.open(source, os.O_RDONLY)
+            self.__buffer = bytearray(buffer_size)
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def read(self, offset, length):
+        """
+        :return: bytes
+        """
+        return b"".join(bytes(chunk) for chunk in self.chunks(offset, length))
+
+    def chunks(self, offset, length):
+        """
+        :return: Generator of memoryview, every chunk is only valid until the next one is requested
+        """
+        if self.__fd is None:
+            for chunk in self.source.chunks(self.buffer_size, offset, offset + length):
+                with chunk:
+                    yield chunk
+            if length and offset + length > self.source.size:
+                raise WimError("Unexpected end of WIM file")
+            return
+
+        view = memoryview(self.__buffer)
+        try:
+            end = offset + length
+            while offset < end:
+                read = os.preadv(self.__fd, [view[:min(len(view), end - offset)]], offset)
+                if read == 0:
+                    raise WimError("Unexpected end of WIM file")
+                yield view[:read]
+                offset += read
+        finally:
+            view.release()
+
+
+class WimFile:
+    """
+    Header, blob table and XML data of a standalone (not already split) WIM file
+    """
+
+    def __init__(self, source):
+        """
+        :param source: WimSource
+        """
+        self.source = source
+
+        header = source.read(0, _HEADER_SIZE)
+        if len(header) != _HEADER_SIZE or header[:8] != b"MSWIM\0\0\0":
+            raise WimError("Not a WIM file")
+
+        self.header = bytearray(header)
+        part_number, total_parts = struct.unpack_from("<HH", header, 40)
+        if part_number != 1 or total_parts != 1:
+            raise WimError("WIM file is already split")
+
+        blob_table = Resource.unpack(header, _BLOB_TABLE)
+        if blob_table.flags & _RESOURCE_FLAG_COMPRESSED:
+            raise WimError("Compressed blob table is not supported")
+        self.blob_table_flags = blob_table.flags
+
+        self.xml_data = Resource.unpack(header, _XML_DATA)
+        self.boot_metadata = Resource.unpack(header, _BOOT_METADATA)
+
+        #: List of [Resource, reference count, SHA-1 hash]
+        self.blobs = []
+        table = source.read(blob_table.offset, blob_table.size)
+        for offset in range(0, len(table) - _BLOB_ENTRY_SIZE + 1, _BLOB_ENTRY_SIZE):
+            resource = Resource.unpack(table, offset)
+            reference_count, = struct.unpack_from("<I", table, offset + 26)
+            if resource.flags & _RESOURCE_FLAG_SOLID:
+                raise WimError("Solid resources are not supported")
+            self.blobs.append([resource, reference_count, table[offset + 30:offset + 50]])
+
+    def plan_parts(self, part_size):
+        """
+        Distribute the blobs over parts no larger than part_size
+
+        Metadata resources must be in the first part, the others follow in source order
+        so the source is read front to back.
+
+        :return: List of parts, every part being a list of blobs
+        """
+        fixed_size = _HEADER_SIZE + self.xml_data.size
+
+        metadata = [blob for blob in self.blobs if blob[0].flags & _RESOURCE_FLAG_METADATA]
+        data = sorted((blob for blob in self.blobs if not blob[0].flags & _RESOURCE_FLAG_METADATA),
+                      key=lambda blob: blob[0].offset)
+
+        parts = [metadata]
+        size = fixed_size + sum(blob[0].size + _BLOB_ENTRY_SIZE for blob in metadata)
+        if size > part_size:
+            raise WimError("Metadata resources don't fit in a single part")
+
+        for blob in data:
+            cost = blob[0].size + _BLOB_ENTRY_SIZE
+            if fixed_size + cost > part_size:
+                raise WimError("A single resource is larger than the part size")
+            if size + cost > part_size:
+                parts.append([])
+                size = fixed_size
+            parts[-1].append(blob)
+            size += cost
+
+        return parts
+
+    def split(self, part_size):
+        """
+        :return: List of SwmPart no larger than part_size
+        """
+        parts = self.plan_parts(part_size)
+        xml_data = self.source.read(self.xml_data.offset, self.xml_data.size)
+        return [SwmPart(self, number, len(parts), blobs, xml_data) for number, blobs in enumerate(parts, start=1)]
+
+
+class SwmPart:
+    """
+    One .swm part, laid out up front so its size and header are known before any resource is copied
+    """
+
+    def __init__(self, wim, number, total_parts, blobs, xml_data):
+        """
+        :param wim: WimFile being split
+        :param number: Part number, starting at 1
+        :param total_parts: Number of parts
+        :param blobs: Blobs stored in this part, from WimFile.plan_parts
+        :param xml_data: XML data of the WIM, repeated in every part
+        """
+        self.wim = wim
+        self.number = number
+        self.blobs = blobs
+        self.xml_data = xml_data
+
+        table = bytearray()
+        offset = _HEADER_SIZE
+        boot_metadata = Resource(0, 0, 0, 0)
+        for resource, reference_count, sha1 in blobs:
+            moved = Resource(resource.size, resource.flags, offset, resource.original_size)
+            if resource.offset == wim.boot_metadata.offset and resource.flags & _RESOURCE_FLAG_METADATA:
+                boot_metadata = moved
+            table += moved.pack() + struct.pack("<HI", number, reference_count) + sha1
+            offset += resource.size
+
+        blob_table = Resource(len(table), wim.blob_table_flags, offset, len(table))
+        offset += len(table)
+        xml = Resource(len(xml_data), wim.xml_data.flags, offset, len(xml_data))
+
+        #: Size of the part file in bytes
+        self.size = offset + len(xml_data)
+
+        header = bytearray(wim.header)
+        struct.pack_into("<I", header, 16, struct.unpack_from("<I", header, 16)[0] | _HEADER_FLAG_SPANNED)
+        struct.pack_into("<HH", header, 40, number, total_parts)
+        header[_BLOB_TABLE:_BLOB_TABLE + 24] = blob_table.pack()
+        header[_XML_DATA:_XML_DATA + 24] = xml.pack()
+        header[_BOOT_METADATA:_BOOT_METADATA + 24] = boot_metadata.pack()
+        header[_INTEGRITY_TABLE:_INTEGRITY_TABLE + 24] = bytes(24)
+
+        self.header = bytes(header)
+        self.table = bytes(table)
+
+    def chunks(self, on_progress=None):
+        """
+        Content of the part, in order
+
+        :param on_progress: Callable taking the number of resource bytes just consumed
+        :return: Generator of bytes-like chunks, every chunk is only valid until the next one is requested
+        """
+        yield self.header
+
+        for resource, __, __ in self.blobs:
+            for chunk in self.wim.source.chunks(resource.offset, resource.size):
+                yield chunk
+                if on_progress is not None:
+                    on_progress(len(chunk))
+
+        yield self.table
+        yield self.xml_data
+
+
+def part_file_names(basename, total_parts):
+    """
+    :param basename: Name of the WIM without extension, e.g. "install"
+    :return: ["install.swm", "install2.swm", ...]
+    """
+    return [basename + (str(number) if number > 1 else "") + ".swm" for number in range(1, total_parts + 1)]
+
+
+def plan_split(wim_source, relative_path, part_size=SWM_PART_SIZE):
+    """
+    Plan the .swm parts a WIM is written as, nothing is read beyond its header and tables
+
+    :param wim_source: WimSource of the WIM, the caller closes it once the parts are read
+    :param relative_path: Path of the WIM relative to the root of the source, e.g. "sources/install.wim"
+    :param part_size: Largest part
+    :return: List of (path of the part relative to the root of the target, SwmPart)
+    """
+    parts = WimFile(wim_source).split(part_size)
+    directory, name = os.path.split(relative_path)
+    names = part_file_names(os.path.splitext(name)[0], len(parts))
+    return [(os.path.join(directory, part_name), part) for part_name, part in zip(names, parts)]
+
+
+def needs_split(relative_path, size):
+    """
+    :param relative_path: Path of a source file relative to the root of the source
+    :param size: Size of the file in bytes
+    :return: True if the file is the install image and is too large for FAT32
+    """
+    return size > FAT32_MAX_FILE_SIZE and os.path.normpath(relative_path).lower() == SPLITTABLE_WIM
+
+
+def is_splittable(source, part_size=SWM_PART_SIZE):
+    """
+    :param source: Path of the WIM or an image_reader.ImageFile
+    :return: True if split_wim can split it into parts no larger than part_size
+    """
+    wim_source = None
+    try:
+        wim_source = WimSource(source, 64 * 1024)
+        WimFile(wim_source).plan_parts(part_size)
+        return True
+    except (WimError, OSError, struct.error):
+        return False
+    finally:
+        if wim_source is not None:
+            wim_source.close()
+
+
+def split_wim(source, target_directory, basename, part_size=SWM_PART_SIZE, buffer_size=4 * 1024 * 1024,
+              should_stop=None, on_progress=None, hash_algorithm=None, on_part_written=None, dirty_limit=None):
+    """
+    Split a WIM into .swm parts written directly into target_directory
+
+    :param source: Path of the WIM or an image_reader.ImageFile
+    :param target_directory: Where to write the parts
+    :param basename: Name of the parts without extension, e.g. "install"
+    :param part_size: Largest part to write
+    :param buffer_size: Size in bytes of a single read/write
+    :param should_stop: Callable polled between chunks, splitting is abandoned when it returns True
+    :param on_progress: Callable taking the number of resource bytes just copied
+    :param hash_algorithm: hashlib name of a hash computed over every part while it is written
+    :param on_part_written: Callable taking the path, size and hex digest (None without hash_algorithm)
+                            of every part once it is complete and closed
+    :param dirty_limit: writeback.DirtyLimit keeping the data not yet on the device of the parts under a limit
+    :return: List of paths of the written parts
+    """
+    wim_source = WimSource(source, buffer_size)
+    try:
+        parts = WimFile(wim_source).split(part_size)
+
+        paths = [os.path.join(target_directory, name) for name in part_file_names(basename, len(parts))]
+        for path, part in zip(paths, parts):
+            hasher = hashlib.new(hash_algorithm) if hash_algorithm is not None else None
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            write_behind = dirty_limit.open(fd) if dirty_limit is not None else None
+            try:
+                for chunk in part.chunks(on_progress):
+                    if should_stop is not None and should_stop():
+                        return paths
+                    _write(fd, chunk)
+                    if write_behind is not None:
+                        write_behind.written(len(chunk))
+                    if hasher is not None:
+                        hasher.update(chunk)
+
+                if write_behind is not None:
+                    dirty_limit.close(write_behind)
+            finally:
+                os.close(fd)
+
+            if on_part_written is not None:
+                on_part_written(path, part.size, hasher.hexdigest() if hasher is not None else None)
+
+        return paths
+    finally:
+        wim_source.close()
+
+
+def _write(fd, data):
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
@@ -1,9 +1,12 @@
 import os
+import shutil
 import subprocess
 import time
 import logging
 import WoeUSB.utils as utils
 import WoeUSB.miscellaneous as miscellaneous
+import WoeUSB.probe as probe
+import WoeUSB.trace as trace
 
 _ = miscellaneous.i18n
 
@@ -11,15 +14,79 @@ _ = miscellaneous.i18n
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def make_system_realize_partition_table_changed(target_device):
+#: Seconds to wait for partition device nodes before giving up
+PARTITION_SETTLE_TIMEOUT = 30
+
+
+def make_system_realize_partition_table_changed(target_device, partition_numbers=(1,),
+                                                timeout=PARTITION_SETTLE_TIMEOUT):
     """
     Updates the system to recognize changes in the partition table.
     :param target_device: The target device.
+    :param partition_numbers: Partitions whose device nodes must exist before returning.
+    :param timeout: Seconds to wait for the device nodes.
+    :return: Device nodes of the partitions, in the order of partition_numbers.
     """
     logger.info(_("Making the system realize that the partition table has changed..."))
-    subprocess.run(["blockdev", "--rereadpt", target_device], check=True)
-    logger.info(_("Waiting 3 seconds for block device nodes to populate..."))
-    time.sleep(3)
+    trace.run(["blockdev", "--rereadpt", target_device], check=True)
+    logger.info(_("Waiting for block device nodes to populate..."))
+    return wait_for_partition_device_nodes(target_device, partition_numbers, timeout)
+
+
+def wait_for_partition_device_nodes(target_device, partition_numbers, timeout=PARTITION_SETTLE_TIMEOUT):
+    """
+    Waits until the kernel has registered the partitions and their device nodes exist.
+    Returns as soon as they do: `udevadm settle` is used when available to wait for the udev queue,
+    then sysfs and /dev are polled with an exponential backoff.
+    :param target_device: The target device.
+    :param partition_numbers: Partition numbers to wait for.
+    :param timeout: Seconds to wait.
+    :return: Device nodes of the partitions, in the order of partition_numbers.
+    """
+    deadline = time.monotonic() + timeout
+
+    if shutil.which("udevadm") is not None:
+        trace.run(["udevadm", "settle", "--timeout=" + str(timeout)])
+
+    delay = 0.01
+    while True:
+        nodes = find_partition_device_nodes(target_device, partition_numbers)
+        if all(node is not None and os.path.exists(node) for node in nodes):
+            return nodes
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RuntimeError(_("Error: Partitions {0} of {1} did not appear within {2} seconds").format(
+                ", ".join(str(number) for number in partition_numbers), target_device, timeout))
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.5)
+
+
+def find_partition_device_nodes(target_device, partition_numbers):
+    """
+    Looks up partitions of target_device in sysfs, which handles both sdX1 and mmcblkXp1/nvmeXnYp1 naming.
+    :param target_device: The target device.
+    :param partition_numbers: Partition numbers to look up.
+    :return: Device node of every partition, None for the ones the kernel doesn't know about yet.
+    """
+    device_name = os.path.basename(os.path.realpath(target_device))
+    sysfs_device_directory = os.path.join(probe.SYSFS_CLASS_BLOCK, device_name)
+
+    partitions = {}
+    try:
+        entries = os.listdir(sysfs_device_directory)
+    except OSError:
+        entries = []
+
+    for entry in entries:
+        try:
+            with open(os.path.join(sysfs_device_directory, entry, "partition")) as partition:
+                partitions[int(partition.read())] = os.path.join("/dev", entry)
+        except (OSError, ValueError):
+            continue
+
+    return [partitions.get(number) for number in partition_numbers]
 
 
 def buggy_motherboards_that_ignore_disks_without_boot_flag_toggled(target_device):
@@ -28,7 +95,7 @@ def buggy_motherboards_that_ignore_disks_without_boot_flag_toggled(target_device
     :param target_device: The target device.
     """
     logger.info(_("Applying workaround for buggy motherboards..."))
-    subprocess.run(["parted", "--script", target_device, "set", "1", "boot", "on"], check=True)
+    trace.run(["parted", "--script", target_device, "set", "1", "boot", "on"], check=True)
 
 
 def support_windows_7_uefi_boot(source_fs_mountpoint, target_fs_mountpoint):
@@ -53,7 +120,7 @@ def support_windows_7_uefi_boot(source_fs_mountpoint, target_fs_mountpoint):
             logger.info(_("No existing EFI bootloader detected. Applying workaround..."))
 
             # Extract Windows 7 EFI bootloader
-            bootmgfw_efi = subprocess.run(
+            bootmgfw_efi = trace.run(
                 ["7z", "e", "-so", os.path.join(source_fs_mountpoint, "sources", "install.wim"),
                  "Windows/Boot/EFI/bootmgfw.efi"], stdout=subprocess.PIPE, check=True).stdout
 
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+Flushing written data to the target, and only to the target
+
+`sync` flushes every filesystem of the host, busy unrelated disks included. syncfs(2) flushes the
+filesystem of the target alone. During the copy, DirtyLimit optionally keeps the data written but not yet on
+the device under a limit: large files start their writeback every window with sync_file_range(2) and wait for
+the window before, small files are flushed together once enough of them are written. The final flush is then
+short, and the progress reported is close to what is actually on the device.
+"""
+
+import os
+import threading
+
+_SYNC_FILE_RANGE_WAIT_BEFORE = 1
+_SYNC_FILE_RANGE_WRITE = 2
+_SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+#: Smallest writeback window, smaller ones only add system calls
+_MIN_WINDOW = 1024 * 1024
+
+_libc = None
+
+
+def _c_library():
+    global _libc
+    if _libc is None:
+        # Only loaded when the target is actually flushed, ctypes is slow to import
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.syncfs.argtypes = [ctypes.c_int]
+        libc.sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+        _libc = libc
+    return _libc
+
+
+def _raise_errno():
+    import ctypes
+
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error))
+
+
+def syncfs(fd):
+    """
+    Write out the dirty data of the filesystem holding fd
+
+    :param fd: Any file descriptor on the filesystem
+    """
+    try:
+        libc = _c_library()
+    except (OSError, AttributeError):
+        # No syncfs in this C library, fall back to flushing everything
+        os.sync()
+        return
+
+    if libc.syncfs(fd) != 0:
+        _raise_errno()
+
+
+def flush_filesystem(path):
+    """
+    :param path: Where the filesystem is mounted, or any directory on it
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        syncfs(fd)
+    finally:
+        os.close(fd)
+
+
+def flush_device(device):
+    """
+    :param device: Block device written directly, not through a mounted filesystem
+    """
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _sync_file_range(fd, offset, length, flags):
+    try:
+        libc = _c_library()
+    except (OSError, AttributeError):
+        if flags & _SYNC_FILE_RANGE_WAIT_AFTER:
+            os.fdatasync(fd)
+        return
+
+    if libc.sync_file_range(fd, offset, length, flags) != 0:
+        _raise_errno()
+
+
+class DirtyLimit:
+    """
+    Caps the data written to the target but not yet on the device, shared by all workers of a copy
+    """
+
+    def __init__(self, limit, writers):
+        """
+        :param limit: Most bytes written but not yet on the device, across all writers
+        :param writers: Number of files written concurrently
+        """
+        # Every writer has up to two windows in flight, the small files waiting for a flush take one more
+        self.window = max(limit // (2 * writers + 1), _MIN_WINDOW)
+
+        self.__small_files = 0
+        self.__lock = threading.Lock()
+
+    def open(self, fd):
+        """
+        :param fd: File descriptor of a target file just opened for writing
+        :return: FileWriteBehind to tell about every write
+        """
+        return FileWriteBehind(fd, self.window)
+
+    def close(self, file_write_behind):
+        """
+        Flush a complete file, before its descriptor is closed
+
+        :param file_write_behind: FileWriteBehind returned by open()
+        """
+        if file_write_behind.offset >= self.window:
+            os.fdatasync(file_write_behind.fd)
+            return
+
+        # Small files are flushed in batches, one fdatasync each would leave the device idle between them
+        with self.__lock:
+            self.__small_files += file_write_behind.offset
+            if self.__small_files < self.window:
+                return
+            self.__small_files = 0
+        syncfs(file_write_behind.fd)
+
+
+class FileWriteBehind:
+    """
+    Starts the writeback of a file being written window by window and waits for the window before
+    """
+    __slots__ = ("fd", "window", "offset", "started", "previous")
+
+    def __init__(self, fd, window):
+        self.fd = fd
+        self.window = window
+
+        #: Bytes written so far
+        self.offset = 0
+
+        self.started = 0
+        self.previous = None
+
+    def written(self, length):
+        """
+        :param length: Number of bytes just written at the end of the file
+        """
+        self.offset += length
+        if self.offset - self.started < self.window:
+            return
+
+        _sync_file_range(self.fd, self.started, self.offset - self.started, _SYNC_FILE_RANGE_WRITE)
+        if self.previous is not None:
+            start, end = self.previous
+            _sync_file_range(self.fd, start, end - start, _SYNC_FILE_RANGE_WAIT_BEFORE | _SYNC_FILE_RANGE_WRITE
+                             | _SYNC_FILE_RANGE_WAIT_AFTER)
+            # Written and clean, the pages are of no use in memory
+            os.posix_fadvise(self.fd, start, end - start, os.POSIX_FADV_DONTNEED)
+
+        self.previous = (self.started, self.offset)
+        self.started = self.offset
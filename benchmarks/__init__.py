@@ -0,0 +1,6 @@
+"""
+Benchmarks for WoeUSB-ng
+
+Every benchmark is a module that can be run with ``python3 -m benchmarks.<name>`` from the source tree,
+none of them requires root or real USB hardware unless a target is explicitly given.
+"""
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Copy throughput of the multi-worker copy engine against the single-threaded path
+
+Usage: python3 -m benchmarks.copy_throughput [--target DIR] [--workers 1,2,4,8] [--buffer-size 4M]
+
+Without --target the files are copied inside a temporary directory, point --target to a mounted
+USB stick to measure a real device. Page cache is not dropped between runs (that requires root),
+so use a source tree larger than RAM or drop caches manually for cold numbers.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from WoeUSB import copy_engine, utils
+
+
+def create_source_tree(directory, small_files=2000, small_file_size=16 * 1024, large_files=2,
+                       large_file_size=256 * 1024 * 1024):
+    """
+    Create a Windows-like tree: many small boot files and a few large images
+
+    :return: Total size in bytes
+    """
+    total = 0
+    chunk = os.urandom(1024 * 1024)
+
+    for index in range(small_files):
+        subdirectory = os.path.join(directory, "boot", str(index % 40))
+        os.makedirs(subdirectory, exist_ok=True)
+        with open(os.path.join(subdirectory, f"file{index}.mui"), "wb") as file:
+            file.write(chunk[:small_file_size])
+        total += small_file_size
+
+    os.makedirs(os.path.join(directory, "sources"), exist_ok=True)
+    for index in range(large_files):
+        with open(os.path.join(directory, "sources", f"image{index}.wim"), "wb") as file:
+            written = 0
+            while written < large_file_size:
+                length = min(len(chunk), large_file_size - written)
+                file.write(chunk[:length])
+                written += length
+        total += large_file_size
+
+    return total
+
+
+def measure(name, total_size, copy):
+    start = time.monotonic()
+    copy()
+    os.sync()
+    elapsed = time.monotonic() - start
+
+    print(f"{name:<24} {elapsed:8.2f} s {total_size / elapsed / 1024 / 1024:10.1f} MB/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", help="Directory to copy into, e.g. a mounted USB stick")
+    parser.add_argument("--workers", default="1,2,4,8", help="Comma separated worker counts to try")
+    parser.add_argument("--buffer-size", type=utils.parse_size, default=copy_engine.DEFAULT_BUFFER_SIZE)
+    parser.add_argument("--large-file-size", type=utils.parse_size, default=256 * 1024 * 1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="woeusb-bench.") as scratch:
+        source = os.path.join(scratch, "source")
+        total_size = create_source_tree(source, large_file_size=args.large_file_size)
+        target_root = args.target or scratch
+
+        print(f"Source tree: {utils.convert_to_human_readable_format(total_size)}")
+
+        def run(name, copy):
+            target = tempfile.mkdtemp(prefix="target.", dir=target_root)
+            try:
+                measure(name, total_size, lambda: copy(target))
+            finally:
+                shutil.rmtree(target)
+
+        run("single thread (shutil)", lambda target: shutil.copytree(source, target, dirs_exist_ok=True))
+
+        for workers in [int(workers) for workers in args.workers.split(",")]:
+            engine = copy_engine.CopyEngine(workers, args.buffer_size)
+            run(f"engine, {workers} worker(s)", lambda target: engine.copy_tree(source, target))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Import time of the command line entry points, checked against a budget
+
+Usage: python3 -m benchmarks.import_time [--runs 5] [--scale 1.0]
+
+Every entry point is imported in a fresh interpreter under ``python3 -X importtime`` and the best of the
+runs is reported. The exit status is 1 when an entry point takes longer than its budget, or when it imports
+a module that only a job needs, e.g. urllib.request for `woeusb --help`. Run it after touching the imports of
+the package; --scale gives slow machines more time, the list of deferred modules holds everywhere.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+#: Module of every entry point and its budget in milliseconds
+ENTRY_POINTS = {
+    # woeusb --help, --about and --version
+    "WoeUSB.core": 50,
+    # Device listing
+    "WoeUSB.list_devices": 25,
+}
+
+#: Modules none of the entry points may import, the first job or the first translated message loads them
+DEFERRED_MODULES = ("concurrent.futures", "ctypes", "logging", "pathlib", "subprocess", "termcolor",
+                    "urllib.request", "wx", "xml.dom.minidom")
+
+_SOURCE_TREE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module):
+    """
+    :param module: Name of the module to import
+    :return: (microseconds the import took, names of every module it imported)
+    """
+    environment = dict(os.environ, PYTHONPATH=_SOURCE_TREE)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            env=environment, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    cumulative = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        __, cumulative_time, name = line[len("import time:"):].split("|")
+        if not cumulative_time.strip().isdigit():
+            # Header
+            continue
+        imported.add(name.strip())
+        if name == " " + module:
+            cumulative = int(cumulative_time)
+
+    return cumulative, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="Factor applied to every budget")
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget in ENTRY_POINTS.items():
+        # The first run also writes the bytecode caches, it isn't counted
+        import_time(module)
+        runs = [import_time(module) for __ in range(args.runs)]
+        best = min(cumulative for cumulative, __ in runs) / 1000
+        imported = set.union(*(imported for __, imported in runs))
+
+        budget *= args.scale
+        print(f"{module:<24} {best:8.1f} ms  (budget {budget:.0f} ms)")
+        if best > budget:
+            print(f"  over budget by {best - budget:.1f} ms")
+            failed = True
+
+        deferred = sorted(name for name in imported if name in DEFERRED_MODULES)
+        if deferred:
+            print(f"  imports {', '.join(deferred)}, only jobs should")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
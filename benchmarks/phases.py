@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Time every phase of writing a stick, against file-backed stand-ins for the device
+
+Usage: python3 -m benchmarks.phases [--source DIR|ISO] [--scratch DIR] [--small-files 3000] [--wim-size 5G]
+                                    [--runs 3] [--target-partition PATH] [--output FILE] [--baseline FILE]
+
+Without --source a synthetic Windows-like tree is generated with a sparse multi-GB install.wim (see
+benchmarks.synthetic). Nothing requires root: the device is a sparse disk image partitioned with parted and
+formatted with mkfs.fat when they are installed, the copy goes to a directory standing in for the mounted
+target partition, and --direct-write builds the FAT32 volume in a partition image file, or in the block
+device given with --target-partition such as a null_blk device. The phases are manifest, partitioning,
+formatting, copying, sync, verification and direct_write; copying, sync, verification and direct_write
+are run --runs times and the fastest run is kept. Results are written as JSON so runs on different commits
+can be compared, --baseline prints the change against an earlier result file.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from WoeUSB import copy_engine, fat32, image_reader, manifest, space, utils, verify, writeback
+from benchmarks import synthetic
+
+#: Where the partition starts on the disk image, as create_partition lays it out
+PARTITION_OFFSET = 4 * 1024 * 1024
+
+
+class PhaseTimer:
+    """
+    Collects the wall time of every phase, the fastest of several runs is the one reported
+    """
+
+    def __init__(self):
+        #: Dictionary of phase name to its result
+        self.phases = {}
+
+    def run(self, name, function, size=None):
+        """
+        :param name: Phase name
+        :param function: Callable doing the phase
+        :param size: Bytes the phase handles, for a throughput
+        :return: What function returned
+        """
+        start = time.monotonic()
+        result = function()
+        elapsed = time.monotonic() - start
+
+        phase = self.phases.setdefault(name, {"samples": []})
+        phase["samples"].append(round(elapsed, 4))
+        phase["seconds"] = min(phase["samples"])
+        if size is not None:
+            phase["bytes"] = size
+            phase["mib_per_second"] = round(size / max(phase["seconds"], 1e-9) / 1024 / 1024, 1)
+        return result
+
+    def skip(self, name, reason):
+        self.phases[name] = {"skipped": reason}
+
+
+def environment():
+    """
+    :return: Dictionary describing what the benchmark ran on
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode("ascii").strip()
+    except OSError:
+        commit = ""
+
+    return {"commit": commit or None,
+            "python": platform.python_version(),
+            "kernel": platform.release(),
+            "cpu_count": os.cpu_count()}
+
+
+def partition_disk_image(disk_image):
+    subprocess.run(["parted", "--script", disk_image, "mklabel", "msdos", "mkpart", "primary", "fat32",
+                    "{0}B".format(PARTITION_OFFSET), "--", "-1s"], check=True, stdout=subprocess.DEVNULL)
+
+
+def format_disk_image(command_mkdosfs, disk_image):
+    subprocess.run([command_mkdosfs, "-F", "32", "--offset", str(PARTITION_OFFSET // 512), disk_image],
+                   check=True, stdout=subprocess.DEVNULL)
+
+
+def copy_to_directory(source_manifest, target_directory, workers, buffer_size, digests):
+    """
+    Copy as core.main does in --device mode with a FAT target, hashing every file for the verification phase
+    """
+    def file_copied(path, size, digest):
+        digests.append((path, size, digest))
+
+    engine = copy_engine.CopyEngine(workers, buffer_size, split_wim=True,
+                                    hash_algorithm=verify.DEFAULT_HASH_ALGORITHM, on_file_copied=file_copied)
+    engine.copy_manifest(source_manifest, target_directory)
+
+
+def verify_directory(digests, buffer_size):
+    verifier = verify.Verifier(buffer_size=buffer_size)
+    for path, size, digest in digests:
+        verifier.submit(path, size, digest)
+    mismatches = verifier.wait()
+    if mismatches:
+        raise SystemExit("{0} files failed verification".format(len(mismatches)))
+
+
+def direct_write(source_manifest, target_partition, buffer_size):
+    fd = os.open(target_partition, os.O_WRONLY)
+    try:
+        fat32.write_volume(fd, source_manifest, "Windows USB", split_wim=True, buffer_size=buffer_size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def compare(baseline, results):
+    """
+    :return: Lines comparing every phase timed in both results
+    """
+    lines = ["{0:<14} {1:>10} {2:>10} {3:>8}".format("phase", "baseline", "current", "change")]
+    for name, phase in results["phases"].items():
+        old = baseline.get("phases", {}).get(name, {})
+        if "seconds" not in phase or "seconds" not in old:
+            continue
+        change = (phase["seconds"] - old["seconds"]) * 100 / max(old["seconds"], 1e-9)
+        lines.append("{0:<14} {1:>9.2f}s {2:>9.2f}s {3:>+7.1f}%".format(name, old["seconds"], phase["seconds"],
+                                                                       change))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--source", help="Source tree or ISO image, a synthetic tree is generated by default")
+    parser.add_argument("--scratch", help="Directory for the source, the images and the copies (default: $TMPDIR)")
+    parser.add_argument("--small-files", type=int, default=3000)
+    parser.add_argument("--wim-size", type=utils.parse_size, default=5 * 1024 * 1024 * 1024)
+    parser.add_argument("--workers", type=int, default=copy_engine.DEFAULT_COPY_WORKERS)
+    parser.add_argument("--buffer-size", type=utils.parse_size, default=copy_engine.DEFAULT_BUFFER_SIZE)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--target-partition",
+                        help="Block device to write the FAT32 volume to instead of an image file, e.g. /dev/nullb0")
+    parser.add_argument("--output", help="Where to write the JSON results (default: standard output)")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    timer = PhaseTimer()
+    results = {"environment": environment(),
+               "parameters": {"workers": args.workers, "buffer_size": args.buffer_size, "runs": args.runs},
+               "phases": timer.phases}
+
+    with tempfile.TemporaryDirectory(prefix="woeusb-bench.", dir=args.scratch) as scratch:
+        source = args.source
+        if source is None:
+            source = os.path.join(scratch, "source")
+            synthetic.create_windows_tree(source, args.small_files, args.wim_size)
+            results["parameters"].update(small_files=args.small_files, wim_size=args.wim_size)
+
+        source_image = image_reader.open_image(source) if os.path.isfile(source) else None
+        source_manifest = timer.run("manifest", lambda: manifest.build_manifest(source_image or source))
+        results["source"] = {"files": len(source_manifest), "directories": len(source_manifest.directories),
+                             "bytes": source_manifest.total_size}
+        total_size = source_manifest.total_size
+
+        # Sized like the smallest stick the source fits on, with some room to spare
+        partition_size = space.minimum_partition_size(source_manifest, "FAT", split_wim=True) * 5 // 4
+        partition_size -= partition_size % (1024 * 1024)
+
+        disk_image = os.path.join(scratch, "disk.img")
+        with open(disk_image, "wb") as file:
+            file.truncate(PARTITION_OFFSET + partition_size + 512)
+
+        if shutil.which("parted") is None:
+            timer.skip("partitioning", "parted not found")
+        else:
+            timer.run("partitioning", lambda: partition_disk_image(disk_image))
+
+        command_mkdosfs = next((command for command in ["mkfs.fat", "mkfs.vfat", "mkdosfs"] if shutil.which(command)),
+                               None)
+        if command_mkdosfs is None:
+            timer.skip("formatting", "mkfs.fat not found")
+        else:
+            timer.run("formatting", lambda: format_disk_image(command_mkdosfs, disk_image))
+        os.unlink(disk_image)
+
+        target_partition = args.target_partition or os.path.join(scratch, "partition.img")
+        for __ in range(args.runs):
+            # Mounting needs root, a directory on the scratch filesystem stands in for the mounted partition
+            target_directory = os.path.join(scratch, "target")
+            os.mkdir(target_directory)
+            digests = []
+            timer.run("copying", lambda: copy_to_directory(source_manifest, target_directory, args.workers,
+                                                           args.buffer_size, digests), total_size)
+            timer.run("sync", lambda: writeback.flush_filesystem(target_directory))
+            timer.run("verification", lambda: verify_directory(digests, args.buffer_size), total_size)
+            shutil.rmtree(target_directory)
+
+            if args.target_partition is None:
+                with open(target_partition, "wb") as file:
+                    file.truncate(partition_size)
+            timer.run("direct_write", lambda: direct_write(source_manifest, target_partition, args.buffer_size),
+                      total_size)
+            if args.target_partition is None:
+                os.unlink(target_partition)
+
+        if source_image is not None:
+            source_image.close()
+
+    for name, phase in timer.phases.items():
+        if "skipped" in phase:
+            print("{0:<14} skipped: {1}".format(name, phase["skipped"]), file=sys.stderr)
+        else:
+            print("{0:<14} {1:9.2f} s".format(name, phase["seconds"]), file=sys.stderr)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline:
+            print("\n".join(compare(json.load(baseline), results)), file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+            output.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
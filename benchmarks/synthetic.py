@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic Windows installation media
+
+Builds a tree laid out like a mounted Windows ISO: thousands of small boot, EFI and setup files, and a
+sources/install.wim that is a valid uncompressed WIM made of large blobs. The blobs are sparse, only their
+last bytes are written, so a multi-GB WIM takes almost no disk space and no time to create while still being
+read, split and copied like a real one. The content only depends on the parameters, every run of a benchmark
+gets the same source.
+"""
+
+import hashlib
+import os
+import random
+import struct
+
+#: Small files per directory of the tree, names and sizes like those of a Windows ISO
+_SMALL_FILE_GROUPS = [
+    ("boot", "bootfix.bin", 1024),
+    ("boot/fonts", "{0}_boot.ttf", 2 * 1024 * 1024),
+    ("boot/resources", "bootres{0}.dll", 96 * 1024),
+    ("boot/{1}", "bootmgr.exe.mui", 80 * 1024),
+    ("efi/boot", "bootx64.efi", 1536 * 1024),
+    ("efi/microsoft/boot", "bcd", 16 * 1024),
+    ("efi/microsoft/boot/fonts", "{0}_boot.ttf", 2 * 1024 * 1024),
+    ("sources", "{0}.dll", 256 * 1024),
+    ("sources/{1}", "{0}.dll.mui", 32 * 1024),
+    ("support/logging", "{0}.dll", 64 * 1024),
+]
+
+_LANGUAGES = ["ar-sa", "bg-bg", "cs-cz", "da-dk", "de-de", "el-gr", "en-gb", "en-us", "es-es", "es-mx", "et-ee",
+              "fi-fi", "fr-ca", "fr-fr", "he-il", "hr-hr", "hu-hu", "it-it", "ja-jp", "ko-kr", "lt-lt", "lv-lv",
+              "nb-no", "nl-nl", "pl-pl", "pt-br", "pt-pt", "ro-ro", "ru-ru", "sk-sk", "sl-si", "sr-latn-rs",
+              "sv-se", "th-th", "tr-tr", "uk-ua", "zh-cn", "zh-tw"]
+
+_WIM_HEADER_SIZE = 208
+
+_BLOB_STAMP_SIZE = 32
+
+
+def create_windows_tree(directory, small_files=3000, wim_size=5 * 1024 * 1024 * 1024,
+                        wim_blob_size=64 * 1024 * 1024, seed=0):
+    """
+    :param directory: Where to create the tree, created if needed
+    :param small_files: Number of small files beside install.wim
+    :param wim_size: Approximate size of sources/install.wim in bytes
+    :param wim_blob_size: Size of a single resource of the WIM
+    :param seed: Seed of the file sizes and content
+    :return: (number of files, total size in bytes)
+    """
+    generator = random.Random(seed)
+    content = generator.randbytes(2 * 1024 * 1024)
+
+    total = 0
+    for index in range(small_files):
+        group_directory, name, size = _SMALL_FILE_GROUPS[index % len(_SMALL_FILE_GROUPS)]
+        language = _LANGUAGES[index // len(_SMALL_FILE_GROUPS) % len(_LANGUAGES)]
+        path = os.path.join(directory, group_directory.format(index, language), name.format(index, language))
+
+        # Sizes between a quarter and the full size of their group, mostly small
+        size = max(int(size * generator.uniform(0.25, 1.0) ** 3), 1)
+        if os.path.exists(path):
+            path = "{0}.{1}".format(path, index)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            offset = generator.randrange(len(content) - min(size, len(content)) + 1)
+            file.write(content[offset:offset + size])
+        total += size
+
+    wim_path = os.path.join(directory, "sources", "install.wim")
+    os.makedirs(os.path.dirname(wim_path), exist_ok=True)
+    total += create_sparse_wim(wim_path, wim_size, wim_blob_size, seed)
+
+    return small_files + 1, total
+
+
+def create_sparse_wim(path, size, blob_size=64 * 1024 * 1024, seed=0):
+    """
+    Write an uncompressed WIM of about size bytes whose data resources are sparse
+
+    Every resource is zeros ending with a unique stamp, so the blob table holds valid SHA-1 hashes and no two
+    blobs are alike.
+
+    :param path: Where to write the WIM
+    :param size: Approximate size in bytes
+    :param blob_size: Size of a single data resource, splitting needs it below the .swm part size
+    :param seed: Seed of the stamps
+    :return: Size of the WIM in bytes
+    """
+    generator = random.Random(seed)
+    blob_count = max(size // blob_size, 1)
+
+    # The hash of the zeros every blob starts with is computed once and continued with the stamp of each blob
+    zeros_hash = hashlib.sha1()
+    zeros = bytes(1024 * 1024)
+    remaining = blob_size - _BLOB_STAMP_SIZE
+    while remaining:
+        zeros_hash.update(zeros[:min(remaining, len(zeros))])
+        remaining -= min(remaining, len(zeros))
+
+    entries = []
+    with open(path, "wb") as file:
+        offset = _WIM_HEADER_SIZE
+        for __ in range(blob_count):
+            stamp = generator.randbytes(_BLOB_STAMP_SIZE)
+            blob_hash = zeros_hash.copy()
+            blob_hash.update(stamp)
+
+            # Everything before the stamp is left as a hole
+            file.seek(offset + blob_size - _BLOB_STAMP_SIZE)
+            file.write(stamp)
+            entries.append(_blob_entry(blob_size, 0, offset, blob_hash.digest()))
+            offset += blob_size
+
+        # Image metadata, WIM splitting keeps it in the first part
+        metadata = generator.randbytes(64 * 1024)
+        file.seek(offset)
+        file.write(metadata)
+        metadata_entry = _blob_entry(len(metadata), 0x02, offset, hashlib.sha1(metadata).digest())
+        entries.append(metadata_entry)
+        offset += len(metadata)
+
+        blob_table = b"".join(entries)
+        blob_table_offset = offset
+        file.write(blob_table)
+        offset += len(blob_table)
+
+        xml_data = "\ufeff<WIM><TOTALBYTES>{0}</TOTALBYTES><IMAGE INDEX=\"1\"><NAME>Synthetic</NAME></IMAGE></WIM>" \
+            .format(offset).encode("utf-16-le")
+        xml_data_offset = offset
+        file.write(xml_data)
+        offset += len(xml_data)
+
+        header = bytearray(_WIM_HEADER_SIZE)
+        header[:8] = b"MSWIM\0\0\0"
+        # Header size, version, flags (none: uncompressed), chunk size
+        struct.pack_into("<IIII", header, 8, _WIM_HEADER_SIZE, 0x10d00, 0, 32768)
+        header[24:40] = generator.randbytes(16)
+        # Part 1 of 1, one image
+        struct.pack_into("<HHI", header, 40, 1, 1, 1)
+        struct.pack_into("<QQQ", header, 48, len(blob_table) | (0x02 << 56), blob_table_offset, len(blob_table))
+        struct.pack_into("<QQQ", header, 72, len(xml_data), xml_data_offset, len(xml_data))
+        header[96:120] = metadata_entry[:24]
+        struct.pack_into("<I", header, 120, 1)
+        file.seek(0)
+        file.write(header)
+
+    return offset
+
+
+def _blob_entry(size, flags, offset, sha1):
+    # Resource header, part number 1, reference count 1, SHA-1
+    return struct.pack("<QQQHI", size | (flags << 56), offset, size, 1, 1) + sha1
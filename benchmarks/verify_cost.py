@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Cost of --verify as a percentage of the copy
+
+Usage: python3 -m benchmarks.verify_cost [--target DIR] [--workers 4] [--buffer-size 4M] [--runs 3]
+
+Every run copies the same tree twice, once plain and once with the source hashed while copying and
+every file read back as soon as it is written, and reports the extra wall time of the verified copy.
+Without --target the copy goes to a temporary directory; point --target to a mounted USB stick
+to include the device read back, which is what --verify costs in practice.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from WoeUSB import copy_engine, utils, verify
+from benchmarks.copy_throughput import create_source_tree
+
+
+def timed_copy(source, target, workers, buffer_size, verify_files):
+    """
+    :return: (seconds, number of mismatches)
+    """
+    verifier = verify.Verifier(buffer_size=buffer_size) if verify_files else None
+
+    start = time.monotonic()
+    engine = copy_engine.CopyEngine(workers, buffer_size,
+                                    hash_algorithm=verify.DEFAULT_HASH_ALGORITHM if verify_files else None,
+                                    on_file_copied=verifier.submit if verifier is not None else None)
+    engine.copy_tree(source, target)
+    mismatches = verifier.wait() if verifier is not None else []
+    os.sync()
+
+    return time.monotonic() - start, len(mismatches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", help="Directory to copy into, e.g. a mounted USB stick")
+    parser.add_argument("--workers", type=int, default=copy_engine.DEFAULT_COPY_WORKERS)
+    parser.add_argument("--buffer-size", type=utils.parse_size, default=copy_engine.DEFAULT_BUFFER_SIZE)
+    parser.add_argument("--large-file-size", type=utils.parse_size, default=256 * 1024 * 1024)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="woeusb-bench.") as scratch:
+        source = os.path.join(scratch, "source")
+        total_size = create_source_tree(source, large_file_size=args.large_file_size)
+        target_root = args.target or scratch
+
+        print(f"Source tree: {utils.convert_to_human_readable_format(total_size)}")
+
+        plain = []
+        verified = []
+        for __ in range(args.runs):
+            for results, verify_files in ((plain, False), (verified, True)):
+                target = tempfile.mkdtemp(prefix="target.", dir=target_root)
+                try:
+                    elapsed, mismatches = timed_copy(source, target, args.workers, args.buffer_size, verify_files)
+                finally:
+                    shutil.rmtree(target)
+                if mismatches:
+                    raise SystemExit(f"{mismatches} files failed verification")
+                results.append(elapsed)
+
+        plain_time = min(plain)
+        verified_time = min(verified)
+        print(f"{'copy':<24} {plain_time:8.2f} s")
+        print(f"{'copy + verify':<24} {verified_time:8.2f} s")
+        print(f"{'verify cost':<24} {(verified_time - plain_time) * 100 / plain_time:7.1f} %")
+
+
+if __name__ == "__main__":
+    main()